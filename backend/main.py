@@ -3,19 +3,66 @@
 from fastapi import FastAPI, HTTPException, Depends, Query
 from pydantic import BaseModel, Field, EmailStr
 from typing import Optional, List, Any, Dict
-from datetime import datetime, date
-from math import radians, sin, cos, sqrt, atan2
+from datetime import datetime, date, timedelta
+from math import radians, sin, cos, sqrt, atan2, floor, ceil, log, isfinite
+from collections import Counter, deque, OrderedDict
+from bisect import bisect_right
+from functools import partial
+from contextvars import Context, ContextVar
+from decimal import Decimal, ROUND_HALF_UP
+import asyncio
+import base64
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import queue
 import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import numpy as np
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Numeric
+    create_engine, event, func, inspect, text, tuple_, Column, Integer, BigInteger, String, Float, Date,
+    DateTime, Boolean, ForeignKey, UniqueConstraint, Index, LargeBinary, update
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import sessionmaker, relationship, aliased, Session
 
 
 from typing import Optional as Opt, List as PyList, Any as PyAny, Dict as PyDict
 
+
+# ---------------------------
+# Money helpers (amounts are integer cents everywhere)
+# ---------------------------
+
+def to_cents(amount) -> int:
+    """Major units (float/str/Decimal, e.g. 49.99) -> integer cents, rounded half-up."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+
+def format_money(cents: int) -> str:
+    return f"${cents / 100:.2f}"
+
+
 class User:
     """
     Represents a base user in the thrift system.
@@ -110,7 +157,7 @@ class Seller(User):
             print("No active listings.")
             return
         for product in self.product_listings:
-            print(f"  - ID: {product.product_id}, Name: {product.name}, Price: ${product.price}")
+            print(f"  - ID: {product.product_id}, Name: {product.name}, Price: {format_money(product.price_cents)}")
         print("-----------------------------")
 
 
@@ -162,11 +209,11 @@ class Product:
     """
     Plain Python product class (mirrors ORM fields; used for class diagram fidelity).
     """
-    def __init__(self, product_id: int, name: str, description: str, price: float, category: str, location: str, seller: 'Seller'):
+    def __init__(self, product_id: int, name: str, description: str, price_cents: int, category: str, location: str, seller: 'Seller'):
         self.product_id: int = product_id
         self.name: str = name
         self.description: str = description
-        self.price: float = price
+        self.price_cents: int = price_cents
         self.category: str = category
         self.images: PyList[str] = []
         self.location: str = location
@@ -176,11 +223,11 @@ class Product:
         print(f"Uploading image {image_url} for {self.name}...")
         self.images.append(image_url)
 
-    def update_product(self, new_price: Optional[float] = None, new_description: Optional[str] = None):
+    def update_product(self, new_price_cents: Optional[int] = None, new_description: Optional[str] = None):
         print(f"Updating product {self.product_id}...")
-        if new_price is not None:
-            self.price = new_price
-            print(f"Price updated to ${new_price}")
+        if new_price_cents is not None:
+            self.price_cents = new_price_cents
+            print(f"Price updated to {format_money(new_price_cents)}")
         if new_description is not None:
             self.description = new_description
             print("Description updated.")
@@ -212,15 +259,15 @@ class Order:
     def place_order(self):
         self.status = "Placed"
         print(f"Order {self.order_id} placed by {self.buyer.name} to {self.seller.name}.")
-        total_amount = sum(p.price for p in self.products) * self.quantity
+        total_cents = sum(p.price_cents for p in self.products) * self.quantity
         new_trans = Transaction(
             transaction_id=self.order_id * 10,
             order=self,
-            amount=total_amount,
+            amount_cents=total_cents,
             transaction_date=date.today()
         )
         self.transactions.append(new_trans)
-        print(f"Transaction {new_trans.transaction_id} created for ${total_amount}.")
+        print(f"Transaction {new_trans.transaction_id} created for {format_money(total_cents)}.")
         return new_trans
 
     def cancel_order(self):
@@ -246,14 +293,14 @@ class Order:
         print(f"Seller: {self.seller.name}")
         print("Products:")
         for p in self.products:
-            print(f"  - {p.name} (${p.price})")
+            print(f"  - {p.name} ({format_money(p.price_cents)})")
         print(f"Total Quantity: {self.quantity}")
         print(f"Order Date: {self.order_date}")
         if self.completion_date:
             print(f"Completion Date: {self.completion_date}")
         print("Transactions:")
         for t in self.transactions:
-            print(f"  - Trans ID: {t.transaction_id}, Status: {t.status}, Amount: ${t.amount}")
+            print(f"  - Trans ID: {t.transaction_id}, Status: {t.status}, Amount: {format_money(t.amount_cents)}")
         print("------------------------------")
 
 
@@ -261,9 +308,9 @@ class Transaction:
     """
     Plain Python transaction (diagram fidelity).
     """
-    def __init__(self, transaction_id: int, order: 'Order', amount: float, transaction_date: date):
+    def __init__(self, transaction_id: int, order: 'Order', amount_cents: int, transaction_date: date):
         self.transaction_id: int = transaction_id
-        self.amount: float = amount
+        self.amount_cents: int = amount_cents
         self.status: str = "Pending"
         self.date: date = transaction_date
         self.order: 'Order' = order
@@ -288,15 +335,15 @@ class Payment:
     """
     Base class for processing payments.
     """
-    def __init__(self, payment_id: int, transaction: 'Transaction', amount: float):
+    def __init__(self, payment_id: int, transaction: 'Transaction', amount_cents: int):
         self.payment_id: int = payment_id
         self.payment_status: str = "Pending"
-        self.amount: float = amount
+        self.amount_cents: int = amount_cents
         self.transaction: 'Transaction' = transaction
         self.transaction.payment = self
 
     def make_payment(self):
-        print(f"Initiating base payment {self.payment_id} for ${self.amount}...")
+        print(f"Initiating base payment {self.payment_id} for {format_money(self.amount_cents)}...")
         raise NotImplementedError("Subclass must implement the 'make_payment' method")
 
     def verify_payment(self) -> bool:
@@ -310,8 +357,8 @@ class Payment:
 
 
 class GooglePay(Payment):
-    def __init__(self, payment_id: int, transaction: 'Transaction', amount: float):
-        super().__init__(payment_id, transaction, amount)
+    def __init__(self, payment_id: int, transaction: 'Transaction', amount_cents: int):
+        super().__init__(payment_id, transaction, amount_cents)
 
     def process_payment(self):
         print(f"Processing Google Pay payment {self.payment_id}...")
@@ -340,6 +387,113 @@ SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 Base = declarative_base()
 
 
+# ---------------------------
+# Slow-query log (opt-in via SLOW_QUERY_MS)
+# ---------------------------
+
+# "METHOD /path/{param}" of the request being served; set by the route-tagging middleware
+current_route: ContextVar[Optional[str]] = ContextVar("current_route", default=None)
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+class SlowQueryLog:
+    """
+    Records statements slower than `threshold_ms` into a bounded ring buffer.
+    A sampled fraction of slow SELECTs also gets its plan captured with EXPLAIN
+    (EXPLAIN QUERY PLAN on SQLite) on the same connection.
+    Disabled while `threshold_ms` is None.
+    """
+    def __init__(self, threshold_ms: Optional[float] = None, maxlen: int = 100, explain_sample_rate: float = 1.0):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self._entries = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def install(self, target_engine):
+        event.listen(target_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(target_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(target_engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.threshold_ms is None:
+            return
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    @staticmethod
+    def _handle_error(exception_context):
+        # the statement failed, so after_cursor_execute won't pop its start time
+        conn = exception_context.connection
+        starts = conn.info.get("slow_query_start") if conn is not None else None
+        if starts:
+            starts.pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_start")
+        if self.threshold_ms is None or not starts:
+            return
+        duration_ms = (time.perf_counter() - starts.pop()) * 1000.0
+        if duration_ms < self.threshold_ms:
+            return
+        plan = None
+        if not executemany and statement.lstrip().upper().startswith("SELECT") and random.random() < self.explain_sample_rate:
+            plan = self._explain(conn, statement, parameters)
+        entry = {
+            "sql": statement,
+            "params": repr(parameters)[:500],
+            "route": current_route.get(),
+            "duration_ms": round(duration_ms, 3),
+            "plan": plan,
+            "recorded_at": datetime.utcnow().isoformat(),
+        }
+        with self._lock:
+            self._entries.append(entry)
+
+    @staticmethod
+    def _explain(conn, statement: str, parameters) -> Optional[PyList[str]]:
+        sqlite = conn.dialect.name == "sqlite"
+        prefix = "EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN "
+        # raw DBAPI cursor, so the EXPLAIN itself does not re-enter the event hooks;
+        # on Postgres a failed statement aborts the transaction, so it runs in a savepoint
+        cursor = conn.connection.cursor()
+        try:
+            if not sqlite:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [" | ".join(str(col) for col in row) for row in cursor.fetchall()]
+            except Exception as exc:
+                if not sqlite:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                plan = [f"EXPLAIN failed: {exc}"]
+            if not sqlite:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except Exception as exc:
+            return [f"EXPLAIN failed: {exc}"]
+        finally:
+            cursor.close()
+
+    def entries(self) -> PyList[PyDict[str, PyAny]]:
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog(
+    threshold_ms=_env_float("SLOW_QUERY_MS", None),
+    maxlen=int(os.getenv("SLOW_QUERY_LOG_SIZE", "100")),
+    explain_sample_rate=_env_float("SLOW_QUERY_EXPLAIN_SAMPLE", 1.0),
+)
+slow_query_log.install(engine)
+
+
 class UserORM(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -357,10 +511,11 @@ class UserORM(Base):
 
 class ProductORM(Base):
     __tablename__ = "products"
+    __table_args__ = (Index("ix_products_lat_lon", "lat", "lon"),)
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     description = Column(String, nullable=True)
-    price = Column(Numeric(12, 2), nullable=False)
+    price_cents = Column(BigInteger, nullable=False)
     category = Column(String, nullable=True)
     image_url = Column(String, nullable=True)
     seller_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -370,6 +525,14 @@ class ProductORM(Base):
     seller = relationship("UserORM", back_populates="products")
     orders = relationship("OrderORM", back_populates="product", cascade="all, delete-orphan")
 
+    @property
+    def price(self) -> float:
+        return from_cents(self.price_cents)
+
+    @property
+    def thumbnails(self) -> PyDict[str, str]:
+        return thumbnail_urls(self.image_url)
+
 
 class OrderORM(Base):
     __tablename__ = "orders"
@@ -389,15 +552,62 @@ class TransactionORM(Base):
     __tablename__ = "transactions"
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, unique=True)
-    amount = Column(Numeric(12,2), nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)
     status = Column(String, default="pending")
     date = Column(DateTime, default=datetime.utcnow)
 
     order = relationship("OrderORM", back_populates="transaction")
 
+    @property
+    def amount(self) -> float:
+        return from_cents(self.amount_cents)
+
+
+class OrderViewORM(Base):
+    """
+    Denormalised order history row: the order with a snapshot of its product
+    at order time, both parties' names and the payment state. Written by the
+    order/payment endpoints in the same transaction as the order itself.
+    """
+    __tablename__ = "order_views"
+    __table_args__ = (
+        Index("ix_order_views_buyer_id_id", "buyer_id", "id"),
+        Index("ix_order_views_seller_id_id", "seller_id", "id"),
+    )
+    id = Column(Integer, primary_key=True)  # orders.id
+    buyer_id = Column(Integer, nullable=False)
+    buyer_name = Column(String, nullable=False)
+    seller_id = Column(Integer, nullable=False)
+    seller_name = Column(String, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    product_name = Column(String, nullable=False)
+    product_image_url = Column(String, nullable=True)
+    unit_price_cents = Column(BigInteger, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String, nullable=False)
+    order_date = Column(DateTime, nullable=False)
+    completion_date = Column(DateTime, nullable=True)
+    transaction_id = Column(Integer, nullable=True)
+    transaction_status = Column(String, nullable=True)
+    amount_cents = Column(BigInteger, nullable=True)
+
+    @property
+    def unit_price(self) -> float:
+        return from_cents(self.unit_price_cents)
+
+    @property
+    def amount(self) -> Optional[float]:
+        return from_cents(self.amount_cents) if self.amount_cents is not None else None
+
 
 class ChatMessageORM(Base):
+    """Hot chat tier: only the last CHAT_HOT_DAYS; older rows move to chat_archive_chunks."""
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        Index("ix_chat_messages_sender_id_id", "sender_id", "id"),
+        Index("ix_chat_messages_receiver_id_id", "receiver_id", "id"),
+        Index("ix_chat_messages_timestamp", "timestamp"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -405,8 +615,177 @@ class ChatMessageORM(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
 
 
+class ProductChangeORM(Base):
+    """
+    Append-only log of product writes, one row per add/update/delete. `seq`
+    comes from next_change_seq, so seqs become visible in increasing order.
+    """
+    __tablename__ = "product_changes"
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    product_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ProductChangeCounterORM(Base):
+    """Single row: the last product_changes seq handed out."""
+    __tablename__ = "product_change_counter"
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, nullable=False, default=0)
+
+
+class ChatArchiveChunkORM(Base):
+    """
+    Cold chat tier: one user's archived messages from one archiver batch, as
+    zlib-compressed JSON rows [id, sender_id, receiver_id, message, timestamp].
+    A message is stored in both participants' chunks.
+    """
+    __tablename__ = "chat_archive_chunks"
+    __table_args__ = (Index("ix_chat_archive_chunks_user_last_id", "user_id", "last_id"),)
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+
+
+class ProductCellORM(Base):
+    """Per-grid-cell product aggregates for map clustering, maintained on product writes."""
+    __tablename__ = "product_cells"
+    __table_args__ = (UniqueConstraint("precision", "cell_x", "cell_y", name="uq_product_cells_cell"),)
+    id = Column(Integer, primary_key=True, index=True)
+    precision = Column(Integer, nullable=False)
+    cell_x = Column(Integer, nullable=False)
+    cell_y = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    sum_lat = Column(Float, nullable=False, default=0.0)
+    sum_lon = Column(Float, nullable=False, default=0.0)
+    rep_product_id = Column(Integer, nullable=True)
+
+
+class ProductFacetORM(Base):
+    """
+    Product counts per (grid cell, category, price bucket), maintained on
+    product writes. precision 0 holds a single world-wide cell (0, 0) that
+    also counts products without coordinates.
+    """
+    __tablename__ = "product_facets"
+    __table_args__ = (
+        UniqueConstraint("precision", "cell_x", "cell_y", "category", "price_bucket", name="uq_product_facets_key"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    precision = Column(Integer, nullable=False)
+    cell_x = Column(Integer, nullable=False)
+    cell_y = Column(Integer, nullable=False)
+    category = Column(String, nullable=False)  # "" for uncategorised
+    price_bucket = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    sum_lat = Column(Float, nullable=False, default=0.0)
+    sum_lon = Column(Float, nullable=False, default=0.0)
+
+
+class SellerDailySalesORM(Base):
+    """Per-seller daily sales rollup, updated by verify_payment."""
+    __tablename__ = "seller_daily_sales"
+    __table_args__ = (UniqueConstraint("seller_id", "day", name="uq_seller_daily_sales"),)
+    id = Column(Integer, primary_key=True, index=True)
+    seller_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    orders_approved = Column(Integer, nullable=False, default=0)
+    orders_denied = Column(Integer, nullable=False, default=0)
+    units_sold = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(BigInteger, nullable=False, default=0)
+
+
+class ProductDailySalesORM(Base):
+    """Per-product daily sales rollup, updated by verify_payment."""
+    __tablename__ = "product_daily_sales"
+    __table_args__ = (
+        UniqueConstraint("product_id", "day", name="uq_product_daily_sales"),
+        Index("ix_product_daily_sales_seller_day", "seller_id", "day"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, nullable=False)
+    seller_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    orders_approved = Column(Integer, nullable=False, default=0)
+    orders_denied = Column(Integer, nullable=False, default=0)
+    units_sold = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(BigInteger, nullable=False, default=0)
+
+
+class ProductSimilarORM(Base):
+    """Precomputed top-K similar products, one row per (product, rank)."""
+    __tablename__ = "product_similar"
+    __table_args__ = (
+        UniqueConstraint("product_id", "rank", name="uq_product_similar_rank"),
+        Index("ix_product_similar_similar_id", "similar_id"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, nullable=False)
+    rank = Column(Integer, nullable=False)
+    similar_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+
+class SimilarIndexStateORM(Base):
+    """Single row: how far into product_changes product_similar is, and a counter bumped by each full rebuild."""
+    __tablename__ = "similar_index_state"
+    id = Column(Integer, primary_key=True)
+    change_seq = Column(Integer, nullable=False, default=0)
+    generation = Column(Integer, nullable=False, default=0)
+
+
+class TrendingBucketORM(Base):
+    """Orders per product per minute, flushed from the in-process trending counters."""
+    __tablename__ = "trending_buckets"
+    __table_args__ = (UniqueConstraint("minute", "product_id", name="uq_trending_bucket"),)
+    id = Column(Integer, primary_key=True, index=True)
+    minute = Column(Integer, nullable=False, index=True)  # unix time // 60
+    product_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+
+
+def migrate_money_to_cents(bind):
+    """
+    Convert databases created with Numeric(12,2) `products.price` /
+    `transactions.amount` to BIGINT `price_cents` / `amount_cents`:
+    add the new column, backfill it exactly, then drop the old one.
+    Idempotent; a no-op on fresh databases.
+    """
+    columns = {t: {c["name"] for c in inspect(bind).get_columns(t)} for t in ("products", "transactions")}
+    with bind.begin() as conn:
+        for table, old, new in (("products", "price", "price_cents"), ("transactions", "amount", "amount_cents")):
+            if old not in columns[table]:
+                continue
+            if new not in columns[table]:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {new} BIGINT"))
+            conn.execute(text(f"UPDATE {table} SET {new} = CAST(ROUND({old} * 100) AS BIGINT) WHERE {new} IS NULL"))
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {old}"))
+            if bind.dialect.name == "postgresql":
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {new} SET NOT NULL"))
+
+
+def ensure_change_counter(bind):
+    """Start the product_changes counter after the seqs already logged (databases from before it existed)."""
+    with bind.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO product_change_counter (id, seq) SELECT 1, COALESCE(MAX(seq), 0) FROM product_changes "
+            "WHERE NOT EXISTS (SELECT 1 FROM product_change_counter)"
+        ))
+
+
 # Create tables
 Base.metadata.create_all(bind=engine)
+migrate_money_to_cents(engine)
+ensure_change_counter(engine)
+# create_all skips indexes added to tables that already exist
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # ---------------------------
 # Helpers to convert ORM -> OOP objects
@@ -424,7 +803,7 @@ def orm_product_to_oop(p: ProductORM, db: Session) -> Product:
     """Construct a minimal Product OOP from ProductORM. Seller becomes Seller OOP instance."""
     seller_orm = db.query(UserORM).filter(UserORM.id == p.seller_id).first()
     seller_oop = orm_user_to_oop(seller_orm) if seller_orm else Seller(0, "Unknown", "unknown@example.com")
-    return Product(product_id=p.id, name=p.name, description=(p.description or ""), price=float(p.price), category=(p.category or ""), location=(seller_oop.location or ""), seller=seller_oop)
+    return Product(product_id=p.id, name=p.name, description=(p.description or ""), price_cents=p.price_cents, category=(p.category or ""), location=(seller_oop.location or ""), seller=seller_oop)
 
 
 # ---------------------------
@@ -439,230 +818,3544 @@ def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * 2 * atan2(sqrt(a), sqrt(1 - a))
 
 
+def bounding_box(lat: float, lon: float, radius_km: float):
+    """(min_lat, max_lat, min_lon, max_lon) enclosing a circle of radius_km."""
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * max(cos(radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def products_in_box(db: Session, lat: float, lon: float, radius_km: float):
+    """Product query narrowed to the bounding box of a circle (uses ix_products_lat_lon)."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    q = db.query(ProductORM).filter(ProductORM.lat.between(min_lat, max_lat), ProductORM.lon != None)
+    if min_lon >= -180.0 and max_lon <= 180.0:
+        q = q.filter(ProductORM.lon.between(min_lon, max_lon))
+    return q
+
+
 # ---------------------------
-# Pydantic Schemas
+# k-nearest-neighbour search
 # ---------------------------
 
-class UserCreate(BaseModel):
-    name: str
-    email: EmailStr
-    role: str = Field(..., example="buyer")  # buyer or seller
-    phone: Optional[str] = None
-    location: Optional[str] = None
-    profile_pic: Optional[str] = None
-    lat: Optional[float] = None
-    lon: Optional[float] = None
+EARTH_HALF_CIRCUMFERENCE_KM = 20037.5
+KNN_INITIAL_RADIUS_KM = 2.0
 
 
-class UserOut(BaseModel):
-    id: int
-    name: str
-    email: EmailStr
-    role: str
-    phone: Optional[str] = None
-    location: Optional[str] = None
-    profile_pic: Optional[str] = None
-    lat: Optional[float] = None
-    lon: Optional[float] = None
+def encode_knn_cursor(distance: float, product_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{distance!r}:{product_id}".encode()).decode()
 
-    class Config:
-        orm_mode = True
 
+def decode_knn_cursor(cursor: str):
+    try:
+        distance, product_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return float(distance), int(product_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-class LoginRequest(BaseModel):
-    name: Optional[str] = None
-    email: Optional[EmailStr] = None
 
+def nearest_products(db: Session, lat: float, lon: float, k: int, after=None, max_radius: Optional[float] = None):
+    """
+    The k products nearest to (lat, lon), ordered by (distance, id) and
+    starting strictly after `after`. Grows a bounding-box search until the
+    circle it fully covers holds k hits, so only nearby index ranges are read.
+    Returns (hits, exhausted) where hits are (distance_km, ProductORM) pairs.
+    """
+    limit = min(max_radius, EARTH_HALF_CIRCUMFERENCE_KM) if max_radius is not None else EARTH_HALF_CIRCUMFERENCE_KM
+    radius = min(KNN_INITIAL_RADIUS_KM, limit)
+    while True:
+        hits = []
+        for p in products_in_box(db, lat, lon, radius):
+            d = distance_km(lat, lon, float(p.lat), float(p.lon))
+            if d <= radius and (after is None or (d, p.id) > after):
+                hits.append((d, p))
+        if len(hits) >= k or radius >= limit:
+            hits.sort(key=lambda h: (h[0], h[1].id))
+            return hits[:k], len(hits) <= k and radius >= limit
+        # hits grow with the covered area, so aim for k from the observed density
+        growth = sqrt(k / len(hits)) * 1.5 if hits else 4.0
+        radius = min(radius * max(growth, 2.0), limit)
 
-class ProductCreate(BaseModel):
-    name: str
-    description: Optional[str] = None
-    price: float
-    category: Optional[str] = None
-    image_url: Optional[str] = None
-    seller_id: int
-    lat: Optional[float] = None
-    lon: Optional[float] = None
 
+# ---------------------------
+# /search result cache
+# ---------------------------
 
-class ProductUpdate(BaseModel):
-    name: Optional[str] = None
-    description: Optional[str] = None
-    price: Optional[float] = None
-    category: Optional[str] = None
-    image_url: Optional[str] = None
-    lat: Optional[float] = None
-    lon: Optional[float] = None
+SEARCH_RADIUS_BUCKETS_KM = (1, 2, 5, 10, 25, 50, 100, 250)
 
 
-class ProductOut(BaseModel):
-    id: int
-    name: str
-    description: Optional[str]
-    price: float
-    category: Optional[str]
-    image_url: Optional[str]
-    seller_id: int
-    lat: Optional[float]
-    lon: Optional[float]
+def product_out_dict(p: ProductORM) -> PyDict[str, PyAny]:
+    return {
+        "id": p.id,
+        "name": p.name,
+        "description": p.description,
+        "price": from_cents(p.price_cents),
+        "price_cents": p.price_cents,
+        "category": p.category,
+        "image_url": p.image_url,
+        "thumbnails": thumbnail_urls(p.image_url),
+        "seller_id": p.seller_id,
+        "lat": float(p.lat) if p.lat is not None else None,
+        "lon": float(p.lon) if p.lon is not None else None,
+    }
 
-    class Config:
-        orm_mode = True
 
+class _Flight:
+    """One in-progress cache fill that concurrent identical misses wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[PyList[PyDict[str, PyAny]]] = None
 
-class OrderCreate(BaseModel):
-    buyer_id: int
-    product_id: int
-    quantity: int = 1
 
+class SearchCache:
+    """
+    Caches /search candidates per (query cell, radius bucket). An entry holds
+    every product within bucket + cell size of the cell centre, so any query
+    point inside the cell with radius <= bucket can be answered exactly by
+    filtering the entry. Identical concurrent misses share one DB query.
 
-class OrderOut(BaseModel):
-    id: int
-    buyer_id: int
-    product_id: int
-    quantity: int
-    status: str
-    order_date: datetime
-    completion_date: Optional[datetime]
+    Product writes drop entries covering the written coordinates once they
+    commit; writes made by other worker processes are only seen after `ttl`.
+    """
+    def __init__(self, cell_deg: float = 0.01, ttl: float = 30.0, maxsize: int = 1024):
+        self.cell_deg = cell_deg
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (expires, lat, lon, reach_km, candidates)
+        self._inflight: PyDict[tuple, _Flight] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+
+    def candidates(self, db: Session, lat: float, lon: float, radius: float) -> PyList[PyDict[str, PyAny]]:
+        """Superset of the products within `radius` km of (lat, lon)."""
+        bucket = next((b for b in SEARCH_RADIUS_BUCKETS_KM if radius <= b), None)
+        if bucket is None:
+            return self._load(db, lat, lon, radius)
+        cell_y, cell_x = floor(lat / self.cell_deg), floor(lon / self.cell_deg)
+        center_lat, center_lon = (cell_y + 0.5) * self.cell_deg, (cell_x + 0.5) * self.cell_deg
+        reach = bucket + self.cell_deg * 111.32
+        key = (cell_y, cell_x, bucket)
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[4]
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                    generation = self._generation
+                    self.stats["misses"] += 1
+                else:
+                    self.stats["coalesced"] += 1
+            if not leader:
+                flight.done.wait()
+                if flight.result is not None:
+                    return flight.result
+                continue  # leader failed; try again ourselves
+            try:
+                flight.result = self._load(db, center_lat, center_lon, reach)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                    # a write that committed while we were loading may not be in the result
+                    if flight.result is not None and generation == self._generation:
+                        self._entries[key] = (time.monotonic() + self.ttl, center_lat, center_lon, reach, flight.result)
+                        while len(self._entries) > self.maxsize:
+                            self._entries.popitem(last=False)
+                flight.done.set()
+            return flight.result
+
+    @staticmethod
+    def _load(db: Session, lat: float, lon: float, radius: float) -> PyList[PyDict[str, PyAny]]:
+        return [
+            product_out_dict(p) for p in products_in_box(db, lat, lon, radius)
+            if distance_km(lat, lon, float(p.lat), float(p.lon)) <= radius
+        ]
+
+    def invalidate_point(self, lat: float, lon: float):
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            stale = [key for key, (_, c_lat, c_lon, reach, _) in self._entries.items()
+                     if distance_km(c_lat, c_lon, lat, lon) <= reach]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def info(self) -> PyDict[str, int]:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+
+search_cache = SearchCache(
+    cell_deg=_env_float("SEARCH_CACHE_CELL_DEG", 0.01),
+    ttl=_env_float("SEARCH_CACHE_TTL", 30.0),
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "1024")),
+)
 
-    class Config:
-        orm_mode = True
 
+# ---------------------------
+# Map clustering cells
+# ---------------------------
 
-class TransactionCreate(BaseModel):
-    order_id: int
+# precision p splits the globe into cells of 180 / 2**p degrees (p=15 is roughly 600m)
+CLUSTER_PRECISIONS = range(1, 16)
 
 
-class TransactionOut(BaseModel):
-    id: int
-    order_id: int
-    amount: float
-    status: str
-    date: datetime
+def cell_size_deg(precision: int) -> float:
+    return 180.0 / (2 ** precision)
 
-    class Config:
-        orm_mode = True
 
+def cell_index(lat: float, lon: float, precision: int):
+    size = cell_size_deg(precision)
+    return int(floor((lon + 180.0) / size)), int(floor((lat + 90.0) / size))
 
-class ChatSend(BaseModel):
-    sender_id: int
-    receiver_id: int
-    message: str
 
+def _pick_representative(db: Session, precision: int, cell_x: int, cell_y: int, exclude_id: int) -> Optional[int]:
+    size = cell_size_deg(precision)
+    min_lat, min_lon = cell_y * size - 90.0, cell_x * size - 180.0
+    row = db.query(ProductORM.id).filter(
+        ProductORM.id != exclude_id,
+        ProductORM.lat >= min_lat, ProductORM.lat < min_lat + size,
+        ProductORM.lon >= min_lon, ProductORM.lon < min_lon + size,
+    ).first()
+    return row[0] if row else None
 
-class ChatOut(BaseModel):
-    id: int
-    sender_id: int
-    receiver_id: int
-    message: str
-    timestamp: datetime
 
-    class Config:
-        orm_mode = True
+def update_product_cells(db: Session, before: Optional[PyDict[str, PyAny]], after: Optional[PyDict[str, PyAny]]):
+    """Move a product's contribution between cells at every precision."""
+    old = (before["lat"], before["lon"]) if before and before["lat"] is not None and before["lon"] is not None else None
+    new = (after["lat"], after["lon"]) if after and after["lat"] is not None and after["lon"] is not None else None
+    if old == new:
+        return
+    product_id = (after or before)["id"]
+
+    # key -> [count delta, lat delta, lon delta, leaving, entering]
+    changes: PyDict[tuple, list] = {}
+    for coords, sign in ((old, -1), (new, 1)):
+        if coords is None:
+            continue
+        for precision in CLUSTER_PRECISIONS:
+            key = (precision, *cell_index(coords[0], coords[1], precision))
+            change = changes.setdefault(key, [0, 0.0, 0.0, False, False])
+            change[0] += sign
+            change[1] += sign * coords[0]
+            change[2] += sign * coords[1]
+            change[3 if sign < 0 else 4] = True
+
+    columns = (ProductCellORM.precision, ProductCellORM.cell_x, ProductCellORM.cell_y)
+    names = [c.key for c in columns]
+    for key, (dcount, dlat, dlon, _, _) in sorted(changes.items()):  # one lock order for every writer
+        # INSERT ... ON CONFLICT so two first products in a cell add up; the representative is only set on insert
+        upsert_add(db, ProductCellORM, {**dict(zip(names, key)), "rep_product_id": product_id}, names,
+                   {"count": dcount, "sum_lat": dlat, "sum_lon": dlon})
+    # the upserts hold the row locks until commit, so these follow-ups see settled counts
+    db.query(ProductCellORM).filter(tuple_(*columns).in_(list(changes)), ProductCellORM.count <= 0).delete(
+        synchronize_session=False)
+    for key, (_, _, _, leaving, entering) in sorted(changes.items()):
+        if not leaving or entering:
+            continue
+        represented = db.query(ProductCellORM).filter(
+            *(column == value for column, value in zip(columns, key)), ProductCellORM.rep_product_id == product_id)
+        if represented.first() is not None:
+            represented.update({"rep_product_id": _pick_representative(db, *key, exclude_id=product_id)},
+                               synchronize_session=False)
+
+
+def rebuild_product_cells(db: Session, batch_size: int = 1000):
+    """Recompute every cell from the products table (initial backfill / repair)."""
+    cells: PyDict[tuple, list] = {}
+    query = db.query(ProductORM.id, ProductORM.lat, ProductORM.lon).filter(
+        ProductORM.lat != None, ProductORM.lon != None
+    ).order_by(ProductORM.id).yield_per(batch_size)
+    for product_id, lat, lon in query:
+        for precision in CLUSTER_PRECISIONS:
+            cell = cells.setdefault((precision, *cell_index(lat, lon, precision)), [0, 0.0, 0.0, product_id])
+            cell[0] += 1
+            cell[1] += lat
+            cell[2] += lon
+    db.query(ProductCellORM).delete()
+    db.bulk_insert_mappings(ProductCellORM, [
+        {"precision": p, "cell_x": x, "cell_y": y, "count": c, "sum_lat": sl, "sum_lon": so, "rep_product_id": rep_id}
+        for (p, x, y), (c, sl, so, rep_id) in cells.items()
+    ])
+    db.commit()
+
+
+def ensure_product_cells(db: Session):
+    """Backfill the cell table once for catalogs that predate it."""
+    if db.query(ProductCellORM.id).first() is None and db.query(ProductORM.id).filter(ProductORM.lat != None).first() is not None:
+        rebuild_product_cells(db)
 
 
 # ---------------------------
-# FastAPI app & dependencies
+# Product facets
 # ---------------------------
 
-from fastapi.middleware.cors import CORSMiddleware
+# bucket i holds prices in [PRICE_BUCKET_EDGES_CENTS[i], PRICE_BUCKET_EDGES_CENTS[i + 1])
+PRICE_BUCKET_EDGES_CENTS = (0, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+# geo levels for radius-restricted facets (~310km, ~39km and ~5km cells); 0 is the global level
+FACET_PRECISIONS = (6, 9, 12)
+FACET_MAX_CELLS = 256
 
-app = FastAPI(title="Thrift Management System (OOP + SQLAlchemy single-file)")
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Your frontend URL
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+def price_bucket(price_cents: int) -> int:
+    # clamped so a negative legacy price counts in the lowest bucket instead of indexing from the end
+    return max(bisect_right(PRICE_BUCKET_EDGES_CENTS, price_cents) - 1, 0)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+def _facet_keys(state: PyDict[str, PyAny]):
+    """(precision, cell_x, cell_y, category, bucket) rows a product counts towards."""
+    category, bucket = state["category"] or "", price_bucket(state["price_cents"])
+    yield (0, 0, 0, category, bucket)
+    if state["lat"] is not None and state["lon"] is not None:
+        for precision in FACET_PRECISIONS:
+            yield (precision, *cell_index(state["lat"], state["lon"], precision), category, bucket)
 
-# ---------------------------
-# User routes
-# ---------------------------
 
-@app.post("/register", response_model=UserOut)
-def register(user_in: UserCreate, db: Session = Depends(get_db)):
-    if user_in.role not in ("buyer", "seller"):
-        raise HTTPException(status_code=400, detail="role must be 'buyer' or 'seller'")
-    existing = db.query(UserORM).filter(UserORM.email == user_in.email).first()
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    u = UserORM(
-        name=user_in.name,
-        email=user_in.email,
-        role=user_in.role,
-        phone=user_in.phone,
-        location=user_in.location,
-        profile_pic=user_in.profile_pic,
-        lat=user_in.lat,
-        lon=user_in.lon
-    )
-    db.add(u)
+def update_product_facets(db: Session, before: Optional[PyDict[str, PyAny]], after: Optional[PyDict[str, PyAny]]):
+    """Move a product's contribution between facet rows."""
+    # key -> [count delta, lat delta, lon delta]
+    changes: PyDict[tuple, list] = {}
+    for state, sign in ((before, -1), (after, 1)):
+        if state is None:
+            continue
+        for key in _facet_keys(state):
+            change = changes.setdefault(key, [0, 0.0, 0.0])
+            change[0] += sign
+            if key[0] != 0:
+                change[1] += sign * state["lat"]
+                change[2] += sign * state["lon"]
+    changes = {k: v for k, v in changes.items() if v != [0, 0.0, 0.0]}
+    if not changes:
+        return
+    columns = (ProductFacetORM.precision, ProductFacetORM.cell_x, ProductFacetORM.cell_y,
+               ProductFacetORM.category, ProductFacetORM.price_bucket)
+    names = [c.key for c in columns]
+    for key, (dcount, dlat, dlon) in sorted(changes.items()):  # one lock order for every writer
+        # INSERT ... ON CONFLICT: two first writers to a new row add up instead of colliding
+        upsert_add(db, ProductFacetORM, dict(zip(names, key)), names, {"count": dcount, "sum_lat": dlat, "sum_lon": dlon})
+    # our upserts hold the row locks, so nothing can be added to a row between here and commit
+    db.query(ProductFacetORM).filter(tuple_(*columns).in_(list(changes)), ProductFacetORM.count <= 0).delete(
+        synchronize_session=False)
+
+
+def rebuild_product_facets(db: Session, batch_size: int = 1000):
+    """Recompute every facet row from the products table (initial backfill / repair)."""
+    facets: PyDict[tuple, list] = {}
+    query = db.query(ProductORM.category, ProductORM.price_cents, ProductORM.lat, ProductORM.lon).yield_per(batch_size)
+    for category, price_cents, lat, lon in query:
+        state = {"category": category, "price_cents": price_cents, "lat": lat, "lon": lon}
+        for key in _facet_keys(state):
+            facet = facets.setdefault(key, [0, 0.0, 0.0])
+            facet[0] += 1
+            if key[0] != 0:
+                facet[1] += lat
+                facet[2] += lon
+    db.query(ProductFacetORM).delete()
+    db.bulk_insert_mappings(ProductFacetORM, [
+        {"precision": p, "cell_x": x, "cell_y": y, "category": c, "price_bucket": b, "count": n, "sum_lat": sl, "sum_lon": so}
+        for (p, x, y, c, b), (n, sl, so) in facets.items()
+    ])
     db.commit()
-    db.refresh(u)
-    # create OOP wrapper (for teacher/demo)
-    oop_user = orm_user_to_oop(u)
-    return u
 
 
-@app.post("/login", response_model=UserOut)
-def login(req: LoginRequest, db: Session = Depends(get_db)):
-    if not req.name and not req.email:
-        raise HTTPException(status_code=400, detail="Provide name or email to login")
-    q = db.query(UserORM)
-    user = None
-    if req.email:
-        user = q.filter(UserORM.email == req.email).first()
-    else:
-        user = q.filter(UserORM.name == req.name).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found (mock login failed)")
-    # Return ORM row; caller may convert to OOP class if needed
-    return user
+def ensure_product_facets(db: Session):
+    """Backfill the facet table once for catalogs that predate it."""
+    if db.query(ProductFacetORM.id).first() is None and db.query(ProductORM.id).first() is not None:
+        rebuild_product_facets(db)
 
 
-@app.get("/users", response_model=List[UserOut])
-def list_users(db: Session = Depends(get_db)):
-    return db.query(UserORM).all()
+def facet_precision(lat: float, lon: float, radius_km: float) -> int:
+    """Finest geo level whose cells covering the radius stay under FACET_MAX_CELLS."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    for precision in reversed(FACET_PRECISIONS):
+        size = cell_size_deg(precision)
+        if ((max_lat - min_lat) / size + 1) * ((max_lon - min_lon) / size + 1) <= FACET_MAX_CELLS:
+            return precision
+    return FACET_PRECISIONS[0]
+
+
+def product_facets(db: Session, category: Optional[str] = None, lat: Optional[float] = None,
+                   lon: Optional[float] = None, radius_km: Optional[float] = None) -> PyDict[str, PyAny]:
+    """
+    Category counts and a price histogram (restricted to `category` if given).
+    With a radius, facet rows count when their centroid lies inside it, as
+    for /search/clusters, so edges are approximate at the chosen cell size.
+    """
+    query = db.query(ProductFacetORM.category, ProductFacetORM.price_bucket, ProductFacetORM.count,
+                     ProductFacetORM.sum_lat, ProductFacetORM.sum_lon)
+    precision = 0
+    if radius_km is not None:
+        precision = facet_precision(lat, lon, radius_km)
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        min_x, min_y = cell_index(min_lat, min_lon, precision)
+        max_x, max_y = cell_index(max_lat, max_lon, precision)
+        query = query.filter(ProductFacetORM.cell_x.between(min_x, max_x), ProductFacetORM.cell_y.between(min_y, max_y))
+    categories: PyDict[str, int] = {}
+    histogram = [0] * len(PRICE_BUCKET_EDGES_CENTS)
+    for row in query.filter(ProductFacetORM.precision == precision):
+        if radius_km is not None and distance_km(lat, lon, row.sum_lat / row.count, row.sum_lon / row.count) > radius_km:
+            continue
+        categories[row.category] = categories.get(row.category, 0) + row.count
+        if category is None or row.category == category:
+            histogram[row.price_bucket] += row.count
+    edges = PRICE_BUCKET_EDGES_CENTS + (None,)
+    return {
+        "total": sum(categories.values()),
+        "categories": [
+            {"category": c or None, "count": n}
+            for c, n in sorted(categories.items(), key=lambda item: (-item[1], item[0]))
+        ],
+        "price_histogram": [
+            {"min_cents": edges[i], "max_cents": edges[i + 1], "count": n} for i, n in enumerate(histogram)
+        ],
+        "precision": precision,
+    }
 
 
 # ---------------------------
-# Product routes
+# Product write hooks
 # ---------------------------
 
-@app.get("/products", response_model=List[ProductOut])
-def list_products(db: Session = Depends(get_db)):
-    return db.query(ProductORM).all()
+def product_state(p: ProductORM) -> PyDict[str, PyAny]:
+    """Plain snapshot of a product row, taken before/after a write."""
+    return {
+        "id": p.id,
+        "name": p.name,
+        "description": p.description,
+        "price_cents": p.price_cents,
+        "category": p.category,
+        "seller_id": p.seller_id,
+        "lat": float(p.lat) if p.lat is not None else None,
+        "lon": float(p.lon) if p.lon is not None else None,
+    }
 
 
-@app.post("/products", response_model=ProductOut)
-def add_product(p_in: ProductCreate, db: Session = Depends(get_db)):
-    seller = db.query(UserORM).filter(UserORM.id == p_in.seller_id).first()
-    if not seller:
-        raise HTTPException(status_code=404, detail="Seller not found")
-    if seller.role != "seller":
-        raise HTTPException(status_code=403, detail="Only users with role 'seller' can add products")
-    p = ProductORM(
-        name=p_in.name,
-        description=p_in.description,
-        price=p_in.price,
-        category=p_in.category,
-        image_url=p_in.image_url,
+def after_commit(db: Session, callback):
+    """Run `callback` once the session's current transaction commits; dropped on rollback."""
+    db.info.setdefault("after_commit", []).append(callback)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _run_after_commit_callbacks(session):
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_after_commit_callbacks(session):
+    session.info.pop("after_commit", None)
+
+
+def on_product_write(db: Session, before: Optional[PyDict[str, PyAny]], after: Optional[PyDict[str, PyAny]]):
+    """
+    Keep derived product structures in step with an add (before=None),
+    update, or delete (after=None). Runs inside the caller's transaction.
+    """
+    db.add(ProductChangeORM(seq=next_change_seq(db), product_id=(before or after)["id"], deleted=after is None))
+    if after is None:
+        # the product's orders are deleted with it
+        db.query(OrderViewORM).filter(OrderViewORM.product_id == before["id"]).delete(synchronize_session=False)
+        db.query(TrendingBucketORM).filter(TrendingBucketORM.product_id == before["id"]).delete(synchronize_session=False)
+    update_product_cells(db, before, after)
+    update_product_facets(db, before, after)
+    for state in (before, after):
+        if state and state["lat"] is not None and state["lon"] is not None:
+            after_commit(db, partial(search_cache.invalidate_point, state["lat"], state["lon"]))
+    after_commit(db, partial(catalog.apply, before, after))
+    after_commit(db, partial(similar_index.mark, (before or after)["id"]))
+    if before is not None:
+        after_commit(db, partial(trending.apply, before, after))
+
+
+def next_change_seq(db: Session) -> int:
+    """
+    Allocate the next product_changes seq. The counter row stays locked until
+    the caller's transaction ends, so product writers take seqs one at a time
+    in commit order: a reader that has seen seq N will never later find a
+    smaller seq committed behind it.
+    """
+    upsert_add(db, ProductChangeCounterORM, {"id": 1}, ["id"], {"seq": 1})
+    return db.query(ProductChangeCounterORM.seq).filter(ProductChangeCounterORM.id == 1).scalar()
+
+
+def current_change_seq(db: Session) -> int:
+    return db.query(func.max(ProductChangeORM.seq)).scalar() or 0
+
+
+def encode_change_token(seq: int) -> str:
+    return base64.urlsafe_b64encode(f"c:{seq}".encode()).decode()
+
+
+def decode_change_token(token: str) -> int:
+    try:
+        prefix, seq = base64.urlsafe_b64decode(token.encode()).decode().split(":")
+        if prefix != "c":
+            raise ValueError(token)
+        return int(seq)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid change token")
+
+
+def product_changes_since(db: Session, since_seq: int, limit: int) -> PyDict[str, PyAny]:
+    """
+    Net effect of the next `limit` logged writes after `since_seq`: one entry
+    per product (its current row, or a tombstone if it no longer exists),
+    ordered by its latest change in the window.
+    """
+    rows = (db.query(ProductChangeORM.seq, ProductChangeORM.product_id)
+            .filter(ProductChangeORM.seq > since_seq).order_by(ProductChangeORM.seq).limit(limit + 1).all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {r.product_id: r.seq for r in rows}
+    order = sorted(latest, key=latest.get)
+    current = {p.id: p for p in db.query(ProductORM).filter(ProductORM.id.in_(order))} if order else {}
+    return {
+        "changes": [
+            {"id": product_id, "deleted": product_id not in current,
+             "product": product_out_dict(current[product_id]) if product_id in current else None}
+            for product_id in order
+        ],
+        "token": encode_change_token(rows[-1].seq if rows else since_seq),
+        "has_more": has_more,
+    }
+
+
+# ---------------------------
+# Columnar catalog (in-process, numpy)
+# ---------------------------
+
+def haversine_km_np(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Vectorised distance_km from one point to many; NaN coordinates give NaN."""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+CATALOG_SORTS = ("newest", "price", "-price", "distance")
+
+
+# column name -> (dtype, fill value for unused rows)
+CATALOG_COLUMNS = {
+    "ids": (np.int64, 0),
+    "seller_ids": (np.int64, 0),
+    "categories": (np.int32, -1),
+    "prices": (np.int64, 0),
+    "lats": (np.float64, np.nan),
+    "lons": (np.float64, np.nan),
+    "name_codes": (np.int32, 0),
+    "alive": (np.bool_, False),
+}
+CATALOG_SNAPSHOT_MAGIC = b"THRCAT01"
+_PAGE = 4096
+
+
+def _page_align(n: int) -> int:
+    return -(-n // _PAGE) * _PAGE
+
+
+def _headroom(n: int) -> int:
+    return n + max(n // 4, 1024)
+
+
+class CatalogStore:
+    """
+    Parallel numpy arrays (id, seller, category code, price, lat, lon, name
+    code) of the whole catalog, plus a table of interned lowercased UTF-8
+    names. Filters are evaluated as boolean masks and sorts as
+    argpartition/lexsort over the survivors, so a page of ids costs a few
+    vector ops instead of a table scan.
+
+    The arrays come either from a full query or from a snapshot file that is
+    memory-mapped copy-on-write, so forked workers share its pages and start
+    in time independent of catalog size. Either way the store then replays
+    product_changes past its stamp: local writes are patched in after commit,
+    and other workers' writes are pulled in once the last catch-up is older
+    than `max_age`. Rows are kept in id order; deletes leave a tombstone until
+    compaction.
+    """
+    def __init__(self, max_age: float = 60.0, snapshot_path: Optional[str] = None):
+        self.max_age = max_age
+        self.snapshot_path = snapshot_path
+        self.loaded_at: Optional[float] = None
+        self.checked_at: Optional[float] = None
+        self.source: Optional[str] = None
+        self.change_seq = 0
+        self.snapshot_stamp: Optional[PyDict[str, PyAny]] = None
+        self._lock = threading.RLock()
+        self._install(self._empty_columns(0), [], np.zeros(0, "S32"), 0, 0, 0)
+
+    # -- storage ------------------------------------------------------------
+
+    @staticmethod
+    def _empty_columns(capacity: int) -> PyDict[str, np.ndarray]:
+        return {name: np.full(capacity, fill, dtype) for name, (dtype, fill) in CATALOG_COLUMNS.items()}
+
+    def _install(self, columns: PyDict[str, np.ndarray], categories: PyList[str], name_table: np.ndarray,
+                 name_count: int, size: int, change_seq: int):
+        for name, array in columns.items():
+            setattr(self, name, array)
+        self.category_codes = {c: i for i, c in enumerate(categories)}
+        self.name_table = name_table
+        self.name_count = name_count
+        self.size = size  # rows in use, tombstones included
+        self.sorted_upto = size  # rows [0, sorted_upto) are in id order
+        self.extra_rows: PyDict[int, int] = {}  # id -> row for rows appended out of order
+        self.dead = 0  # snapshots and full loads hold live rows only
+        self.change_seq = change_seq
+
+    def _grow(self, capacity: int):
+        # copying out of a mapped snapshot makes the column private to this process
+        for name, (dtype, fill) in CATALOG_COLUMNS.items():
+            new = np.full(capacity, fill, dtype)
+            new[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, new)
+
+    def _category_code(self, category: Optional[str]) -> int:
+        if category is None:
+            return -1
+        return self.category_codes.setdefault(category, len(self.category_codes))
+
+    def _intern(self, name: str) -> int:
+        encoded = name.lower().encode()
+        if len(encoded) > self.name_table.dtype.itemsize:
+            self.name_table = self.name_table.astype(f"S{max(len(encoded), 2 * self.name_table.dtype.itemsize)}")
+        if self.name_count == len(self.name_table):
+            table = np.zeros(max(2 * len(self.name_table), 1024), self.name_table.dtype)
+            table[:self.name_count] = self.name_table[:self.name_count]
+            self.name_table = table
+        self.name_table[self.name_count] = encoded
+        self.name_count += 1
+        return self.name_count - 1
+
+    def _find_row(self, product_id: int) -> Optional[int]:
+        row = int(np.searchsorted(self.ids[:self.sorted_upto], product_id))
+        if row < self.sorted_upto and self.ids[row] == product_id:
+            return row
+        return self.extra_rows.get(product_id)
+
+    def _write_row(self, row: int, state: PyDict[str, PyAny]):
+        name = (state["name"] or "").lower().encode()
+        if not (self.alive[row] and self.name_table[self.name_codes[row]] == name):
+            self.name_codes[row] = self._intern(state["name"] or "")
+        self.ids[row] = state["id"]
+        self.seller_ids[row] = state["seller_id"]
+        self.categories[row] = self._category_code(state["category"])
+        self.prices[row] = state["price_cents"]
+        self.lats[row] = np.nan if state["lat"] is None else state["lat"]
+        self.lons[row] = np.nan if state["lon"] is None else state["lon"]
+        self.alive[row] = True
+
+    def _append(self, state: PyDict[str, PyAny]):
+        if self.size == len(self.ids):
+            self._grow(max(2 * len(self.ids), 1024))
+        row = self.size
+        self._write_row(row, state)
+        if self.sorted_upto == row and (row == 0 or self.ids[row - 1] < state["id"]):
+            self.sorted_upto += 1
+        else:
+            self.extra_rows[state["id"]] = row
+        self.size += 1
+
+    def _upsert(self, state: PyDict[str, PyAny]):
+        row = self._find_row(state["id"])
+        if row is None:
+            self._append(state)
+            return
+        if not self.alive[row]:
+            self.dead -= 1
+        self._write_row(row, state)
+
+    def _delete(self, product_id: int):
+        row = self._find_row(product_id)
+        if row is not None and self.alive[row]:
+            self.alive[row] = False
+            self.dead += 1
+            if self.dead > 1024 and self.dead > self.size // 2:
+                self._compact()
+
+    def _compact(self):
+        keep = np.flatnonzero(self.alive[:self.size])
+        keep = keep[np.argsort(self.ids[keep], kind="stable")]
+        columns = self._empty_columns(_headroom(len(keep)))
+        for name, column in columns.items():
+            column[:len(keep)] = getattr(self, name)[keep]
+        categories = sorted(self.category_codes, key=self.category_codes.get)
+        self._install(columns, categories, self.name_table, self.name_count, len(keep), self.change_seq)
+
+    # -- loading ------------------------------------------------------------
+
+    def _read_catalog(self, db: Session):
+        """Columns for every product, sized with headroom, plus the change seq they reflect."""
+        # read the stamp first: anything committed after it is replayed by catch_up
+        change_seq = current_change_seq(db)
+        rows = db.query(ProductORM.id, ProductORM.name, ProductORM.price_cents, ProductORM.category,
+                        ProductORM.seller_id, ProductORM.lat, ProductORM.lon).order_by(ProductORM.id).all()
+        columns = self._empty_columns(_headroom(len(rows)))
+        categories: PyDict[str, int] = {}
+        names: PyDict[bytes, int] = {}
+        for i, r in enumerate(rows):
+            columns["ids"][i] = r.id
+            columns["seller_ids"][i] = r.seller_id
+            columns["categories"][i] = -1 if r.category is None else categories.setdefault(r.category, len(categories))
+            columns["prices"][i] = r.price_cents
+            columns["lats"][i] = np.nan if r.lat is None else r.lat
+            columns["lons"][i] = np.nan if r.lon is None else r.lon
+            columns["name_codes"][i] = names.setdefault((r.name or "").lower().encode(), len(names))
+            columns["alive"][i] = True
+        width = max((len(n) for n in names), default=0)
+        name_table = np.zeros(_headroom(len(names)), f"S{max(width, 32)}")
+        name_table[:len(names)] = list(names)
+        return columns, list(categories), name_table, len(names), len(rows), change_seq
+
+    def load(self, db: Session):
+        catalog_columns = self._read_catalog(db)
+        with self._lock:
+            self._install(*catalog_columns)
+            self.loaded_at = self.checked_at = time.monotonic()
+            self.source = "database"
+
+    def write_snapshot(self, db: Session, path: Optional[str] = None) -> PyDict[str, PyAny]:
+        """
+        Write the current catalog to `path` (atomically replacing it). Layout:
+        magic, data offset and header length (uint64 LE), JSON header, then
+        one page-aligned block per column.
+        """
+        path = path or self.snapshot_path
+        columns, categories, name_table, name_count, size, change_seq = self._read_catalog(db)
+        blocks = dict(columns, name_table=name_table)
+        layout, offset = {}, 0
+        for name, array in blocks.items():
+            layout[name] = {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+            offset = _page_align(offset + array.nbytes)
+        header = {
+            "count": size,
+            "name_count": name_count,
+            "categories": categories,
+            "max_product_id": int(columns["ids"][size - 1]) if size else 0,
+            "change_seq": change_seq,
+            "created_at": datetime.utcnow().isoformat(),
+            "columns": layout,
+        }
+        header_bytes = json.dumps(header).encode()
+        data_start = _page_align(24 + len(header_bytes))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(CATALOG_SNAPSHOT_MAGIC + data_start.to_bytes(8, "little") + len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for name, array in blocks.items():
+                f.seek(data_start + layout[name]["offset"])
+                f.write(array.tobytes())
+        os.replace(tmp, path)  # readers keep their mapping of the old file
+        return {k: header[k] for k in ("count", "max_product_id", "change_seq", "created_at")}
+
+    def open_snapshot(self, path: Optional[str] = None) -> bool:
+        """Memory-map a snapshot copy-on-write; False if there is none (or it is unreadable)."""
+        path = path or self.snapshot_path
+        if not path or not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            prefix = f.read(24)
+            if prefix[:8] != CATALOG_SNAPSHOT_MAGIC:
+                return False
+            data_start = int.from_bytes(prefix[8:16], "little")
+            header = json.loads(f.read(int.from_bytes(prefix[16:24], "little")))
+        blocks = {
+            name: np.memmap(path, dtype=np.dtype(spec["dtype"]), mode="c",
+                            offset=data_start + spec["offset"], shape=(spec["length"],))
+            for name, spec in header["columns"].items()
+        }
+        name_table = blocks.pop("name_table")
+        with self._lock:
+            self._install(blocks, header["categories"], name_table, header["name_count"], header["count"], header["change_seq"])
+            self.loaded_at = self.checked_at = time.monotonic()
+            self.source = "snapshot"
+            self.snapshot_stamp = {k: header[k] for k in ("max_product_id", "change_seq", "created_at")}
+        return True
+
+    def catch_up(self, db: Session) -> int:
+        """Apply product_changes newer than our stamp; returns how many products were touched."""
+        changes = (db.query(ProductChangeORM.seq, ProductChangeORM.product_id, ProductChangeORM.deleted)
+                   .filter(ProductChangeORM.seq > self.change_seq).order_by(ProductChangeORM.seq).all())
+        latest = {c.product_id: c.deleted for c in changes}
+        live_ids = [product_id for product_id, deleted in latest.items() if not deleted]
+        states = {}
+        for start in range(0, len(live_ids), 500):
+            for p in db.query(ProductORM).filter(ProductORM.id.in_(live_ids[start:start + 500])):
+                states[p.id] = product_state(p)
+        with self._lock:
+            for product_id in latest:
+                if product_id in states:
+                    self._upsert(states[product_id])
+                else:
+                    self._delete(product_id)
+            if changes:
+                self.change_seq = max(self.change_seq, changes[-1].seq)
+            self.checked_at = time.monotonic()
+        return len(latest)
+
+    def ensure_fresh(self, db: Session):
+        if self.loaded_at is None:
+            if not self.open_snapshot():
+                self.load(db)
+            self.catch_up(db)
+        elif time.monotonic() - self.checked_at > self.max_age:
+            self.catch_up(db)
+
+    def warm(self, db: Session):
+        """Startup hook: map the snapshot if one exists; otherwise stay lazy."""
+        if self.loaded_at is None and self.open_snapshot():
+            self.catch_up(db)
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded_at = None
+
+    def apply(self, before: Optional[PyDict[str, PyAny]], after: Optional[PyDict[str, PyAny]]):
+        """Patch one product write (add: before=None, delete: after=None)."""
+        with self._lock:
+            if self.loaded_at is None:
+                return  # loads fresh on first use
+            if after is None:
+                self._delete(before["id"])
+            else:
+                self._upsert(after)
+
+    def info(self) -> PyDict[str, PyAny]:
+        with self._lock:
+            return {
+                "source": self.source,
+                "rows": self.size - self.dead,
+                "tombstones": self.dead,
+                "interned_names": self.name_count,
+                "change_seq": self.change_seq,
+                "mapped": isinstance(self.ids, np.memmap),
+                "snapshot": self.snapshot_stamp,
+            }
+
+    # -- queries ------------------------------------------------------------
+
+    def query(self, category: Optional[str] = None, seller_id: Optional[int] = None,
+              min_price_cents: Optional[int] = None, max_price_cents: Optional[int] = None, q: Optional[str] = None,
+              lat: Optional[float] = None, lon: Optional[float] = None, radius_km: Optional[float] = None,
+              sort: str = "newest", offset: int = 0, limit: int = 20):
+        """(total matches, [(product id, distance_km or None)] for the requested page)."""
+        with self._lock:
+            n = self.size
+            mask = self.alive[:n].copy()
+            if category is not None:
+                code = self.category_codes.get(category)
+                if code is None:
+                    return 0, []
+                mask &= self.categories[:n] == code
+            if seller_id is not None:
+                mask &= self.seller_ids[:n] == seller_id
+            if min_price_cents is not None:
+                mask &= self.prices[:n] >= min_price_cents
+            if max_price_cents is not None:
+                mask &= self.prices[:n] <= max_price_cents
+            if q:
+                hits = np.char.find(self.name_table[:self.name_count], q.lower().encode()) >= 0
+                mask &= hits[self.name_codes[:n]]
+            rows = np.flatnonzero(mask)
+            distances = None
+            if lat is not None and lon is not None:
+                distances = haversine_km_np(lat, lon, self.lats[rows], self.lons[rows])
+                if radius_km is not None:
+                    keep = distances <= radius_km  # NaN (no coordinates) drops out
+                    rows, distances = rows[keep], distances[keep]
+            total = len(rows)
+            if sort == "price":
+                key = self.prices[rows]
+            elif sort == "-price":
+                key = -self.prices[rows]
+            elif sort == "distance" and distances is not None:
+                key = np.where(np.isnan(distances), np.inf, distances)
+            else:
+                key = -self.ids[rows]
+            ids = self.ids[rows]
+            end = min(offset + limit, total)
+            if end <= 0 or offset >= total:
+                return total, []
+            candidates = np.arange(total)
+            if end < total:
+                # only the first `end` positions need ordering; take every row tied with the end-th key so the
+                # id tie-break below sees all of them (argpartition picks among ties arbitrarily)
+                boundary = key[np.argpartition(key, end - 1)[end - 1]]
+                candidates = np.flatnonzero(key <= boundary)
+            ordered = candidates[np.lexsort((ids[candidates], key[candidates]))][offset:end]
+            return total, [
+                (int(ids[i]), None if distances is None or np.isnan(distances[i]) else float(distances[i]))
+                for i in ordered
+            ]
+
+
+catalog = CatalogStore(
+    max_age=_env_float("CATALOG_MAX_AGE", 60.0),
+    snapshot_path=os.getenv("CATALOG_SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.snapshot")),
+)
+
+
+# ---------------------------
+# Similar products
+# ---------------------------
+
+try:
+    import fcntl
+except ImportError:  # no lock file: each process maintains the index itself
+    fcntl = None
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+SIMILAR_LOCK_KEY = 0x53494D  # pg_advisory_lock id of the index maintainer
+
+
+class SimilarityIndex:
+    """
+    Top-K similar products per product, stored in product_similar so the
+    detail view is a single keyed lookup.
+
+    Products are vectorised as TF-IDF over hashed tokens (name counted twice,
+    description once); the score blends text cosine with same-category,
+    price-ratio and distance closeness.
+
+    One process maintains the index: the first to take the maintainer lock (a
+    Postgres advisory lock, or a lock file beside an SQLite database) keeps it
+    until it exits, then another worker takes over. It follows product_changes
+    from the position saved in similar_index_state, so writes from every
+    worker reach it: `delay` seconds after a local write, or at the next
+    `poll`. It keeps each product's sparse term weights, the document
+    frequencies and each stored list's weakest score in memory, so a refresh
+    scores only the changed products and rewrites only the lists they enter
+    or leave. Stored scores keep the IDF weights they were computed with;
+    `rebuild` (or --rebuild-similar) resets them.
+    """
+    WEIGHTS = {"text": 0.6, "category": 0.2, "price": 0.1, "location": 0.1}
+
+    def __init__(self, session_factory, k: int = 10, dims: int = 1024, delay: float = 1.0, poll: float = 5.0,
+                 location_scale_km: float = 25.0, chunk: int = 256):
+        self.session_factory = session_factory
+        self.k = k
+        self.dims = dims
+        self.delay = delay
+        self.poll = poll
+        self.location_scale_km = location_scale_km
+        self.chunk = chunk
+        self.stats = {"refreshes": 0, "products_recomputed": 0, "errors": 0}
+        self._docs: Optional[PyDict[int, tuple]] = None  # product_id -> (buckets, tf, category, log_price, lat, lon)
+        self._df = np.zeros(dims, np.int64)
+        self._floors: PyDict[int, float] = {}  # product_id -> weakest stored score; -inf while the list is short
+        self._change_seq = 0
+        self._generation: Optional[int] = None
+        self._maintainer: Optional[tuple] = None  # (pid, release) while this process holds the lock
+        self._woken = False
+        self._cond = threading.Condition()
+        self._refresh_lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    # -- features ---------------------------------------------------------
+
+    def _hashed_counts(self, name: Optional[str], description: Optional[str]) -> PyDict[int, float]:
+        counts: PyDict[int, float] = {}
+        for text, weight in ((name, 2.0), (description, 1.0)):
+            for token in _TOKEN_RE.findall((text or "").lower()):
+                bucket = zlib.crc32(token.encode()) % self.dims
+                counts[bucket] = counts.get(bucket, 0.0) + weight
+        return counts
+
+    def _put(self, r):
+        counts = self._hashed_counts(r.name, r.description)
+        buckets = np.fromiter(counts.keys(), np.int32, len(counts))
+        tf = (1.0 + np.log(np.fromiter(counts.values(), np.float64, len(counts)))).astype(np.float32)
+        self._drop(r.id)
+        self._docs[r.id] = (
+            buckets, tf, r.category.lower() if r.category else None, float(np.log1p(r.price_cents)),
+            np.nan if r.lat is None else float(r.lat), np.nan if r.lon is None else float(r.lon),
+        )
+        self._df[buckets] += 1
+
+    def _drop(self, product_id: int):
+        doc = self._docs.pop(product_id, None)
+        if doc is not None:
+            self._df[doc[0]] -= 1
+
+    def _product_rows(self, db: Session):
+        return db.query(ProductORM.id, ProductORM.name, ProductORM.description, ProductORM.category,
+                        ProductORM.price_cents, ProductORM.lat, ProductORM.lon)
+
+    def _load_docs(self, db: Session):
+        self._docs, self._df = {}, np.zeros(self.dims, np.int64)
+        for r in self._product_rows(db).execution_options(yield_per=1000):
+            self._put(r)
+
+    def _reload(self, db: Session, product_ids: PyList[int]):
+        for start in range(0, len(product_ids), 500):
+            chunk = product_ids[start:start + 500]
+            found = set()
+            for r in self._product_rows(db).filter(ProductORM.id.in_(chunk)):
+                self._put(r)
+                found.add(r.id)
+            for product_id in chunk:
+                if product_id not in found:
+                    self._drop(product_id)
+
+    def _corpus(self) -> PyDict[str, PyAny]:
+        """Current documents as CSR arrays of unit-length TF-IDF weights plus the other features."""
+        ids = np.array(sorted(self._docs), np.int64)
+        n = len(ids)
+        docs = [self._docs[i] for i in ids.tolist()]
+        lengths = np.array([len(d[0]) for d in docs], np.int64)
+        buckets = np.concatenate([d[0] for d in docs]) if n else np.zeros(0, np.int32)
+        doc_index = np.repeat(np.arange(n), lengths)
+        idf = np.log((1 + n) / (1 + self._df)) + 1.0
+        weights = (np.concatenate([d[1] for d in docs]) if n else np.zeros(0, np.float32)) * idf[buckets]
+        norms = np.sqrt(np.bincount(doc_index, weights ** 2, minlength=n))
+        codes: PyDict[str, int] = {}
+        return {
+            "ids": ids,
+            "row_of": dict(zip(ids.tolist(), range(n))),
+            "offsets": np.concatenate(([0], np.cumsum(lengths))),
+            "buckets": buckets,
+            "weights": (weights / np.where(norms == 0, 1.0, norms)[doc_index]).astype(np.float32),
+            "doc_index": doc_index,
+            "categories": np.array([-1 if d[2] is None else codes.setdefault(d[2], len(codes)) for d in docs], np.int32),
+            "log_prices": np.array([d[3] for d in docs], np.float64),
+            "lats": np.array([d[4] for d in docs], np.float64),
+            "lons": np.array([d[5] for d in docs], np.float64),
+        }
+
+    def _dense(self, corpus: PyDict[str, PyAny]) -> np.ndarray:
+        vectors = np.zeros((len(corpus["ids"]), self.dims), np.float32)
+        vectors[corpus["doc_index"], corpus["buckets"]] = corpus["weights"]
+        return vectors
+
+    def _scores(self, corpus: PyDict[str, PyAny], rows: np.ndarray, dense: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Similarity of each product in `rows` to the whole corpus (len(rows) x N).
+        Sparse per row unless `dense` vectors are given (full rebuilds).
+        """
+        w = self.WEIGHTS
+        n = len(corpus["ids"])
+        if dense is not None:
+            text = dense[rows] @ dense.T
+        else:
+            offsets, buckets, weights = corpus["offsets"], corpus["buckets"], corpus["weights"]
+            text = np.empty((len(rows), n), np.float32)
+            for j, row in enumerate(rows):
+                query = np.zeros(self.dims, np.float32)
+                query[buckets[offsets[row]:offsets[row + 1]]] = weights[offsets[row]:offsets[row + 1]]
+                text[j] = np.bincount(corpus["doc_index"], query[buckets] * weights, minlength=n)
+        score = w["text"] * text
+        cats = corpus["categories"]
+        score += w["category"] * ((cats[rows, None] == cats[None, :]) & (cats[rows, None] >= 0))
+        score += w["price"] * np.exp(-np.abs(corpus["log_prices"][rows, None] - corpus["log_prices"][None, :]))
+        lats, lons = corpus["lats"], corpus["lons"]
+        for j, row in enumerate(rows):
+            if not np.isnan(lats[row]):
+                closeness = np.exp(-haversine_km_np(lats[row], lons[row], lats, lons) / self.location_scale_km)
+                score[j] += w["location"] * np.nan_to_num(closeness)
+        score[np.arange(len(rows)), rows] = -np.inf  # never similar to itself
+        return score
+
+    def _top(self, ids: np.ndarray, scores: np.ndarray) -> PyList[tuple]:
+        k = min(self.k, len(ids) - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((ids[top], -scores[top]))]
+        return [(int(ids[t]), float(scores[t])) for t in top]
+
+    def _top_k(self, corpus: PyDict[str, PyAny], rows: np.ndarray, dense: Optional[np.ndarray] = None) -> PyDict[int, PyList[tuple]]:
+        ids = corpus["ids"]
+        result: PyDict[int, PyList[tuple]] = {}
+        for start in range(0, len(rows), self.chunk):
+            block = rows[start:start + self.chunk]
+            scores = self._scores(corpus, block, dense)
+            for j, row in enumerate(block):
+                result[int(ids[row])] = self._top(ids, scores[j])
+        return result
+
+    def _load_lists(self, db: Session, product_ids: PyList[int], into: PyDict[int, PyList[tuple]]):
+        for start in range(0, len(product_ids), 500):
+            chunk = product_ids[start:start + 500]
+            for product_id in chunk:
+                into[product_id] = []
+            for r in (db.query(ProductSimilarORM.product_id, ProductSimilarORM.similar_id, ProductSimilarORM.score)
+                      .filter(ProductSimilarORM.product_id.in_(chunk))
+                      .order_by(ProductSimilarORM.product_id, ProductSimilarORM.rank)):
+                into[r.product_id].append((r.similar_id, r.score))
+
+    def _store(self, db: Session, neighbours: PyDict[int, PyList[tuple]]):
+        product_ids = list(neighbours)
+        for start in range(0, len(product_ids), 500):
+            chunk = product_ids[start:start + 500]
+            db.query(ProductSimilarORM).filter(ProductSimilarORM.product_id.in_(chunk)).delete(synchronize_session=False)
+        db.bulk_insert_mappings(ProductSimilarORM, [
+            {"product_id": product_id, "rank": rank, "similar_id": similar_id, "score": score}
+            for product_id, items in neighbours.items()
+            for rank, (similar_id, score) in enumerate(items)
+        ])
+
+    def _set_floors(self, neighbours: PyDict[int, PyList[tuple]]):
+        for product_id, items in neighbours.items():
+            if product_id in self._docs:
+                self._floors[product_id] = items[-1][1] if len(items) >= self.k else -np.inf
+            else:
+                self._floors.pop(product_id, None)
+
+    # -- maintenance ------------------------------------------------------
+
+    def _state(self, db: Session) -> Optional["SimilarIndexStateORM"]:
+        # the row lock serialises passes with a rebuild running in another process
+        return db.query(SimilarIndexStateORM).filter_by(id=1).with_for_update().first()
+
+    def _load_state(self, db: Session, state: Optional["SimilarIndexStateORM"]):
+        self._load_docs(db)
+        self._floors = {
+            product_id: floor if count >= self.k else -np.inf
+            for product_id, floor, count in db.query(ProductSimilarORM.product_id, func.min(ProductSimilarORM.score),
+                                                     func.count(ProductSimilarORM.id)).group_by(ProductSimilarORM.product_id)
+        }
+        self._change_seq, self._generation = (state.change_seq, state.generation) if state else (0, None)
+
+    def rebuild(self, db: Session) -> PyDict[str, int]:
+        """Recompute every product's list from scratch."""
+        with self._refresh_lock:
+            state = self._state(db)
+            if state is None:
+                state = SimilarIndexStateORM(id=1, generation=0)
+                db.add(state)
+            state.change_seq = current_change_seq(db)  # read first: later writes get replayed
+            state.generation += 1
+            self._load_docs(db)
+            corpus = self._corpus()
+            neighbours = self._top_k(corpus, np.arange(len(corpus["ids"])), self._dense(corpus))
+            db.query(ProductSimilarORM).delete(synchronize_session=False)
+            self._store(db, neighbours)
+            db.commit()
+            if self._is_maintainer():
+                self._floors = {}
+                self._set_floors(neighbours)
+                self._change_seq, self._generation = state.change_seq, state.generation
+            else:
+                self.reset()
+        return {"products": len(neighbours), "rows": sum(len(v) for v in neighbours.values())}
+
+    def refresh(self, db: Session, changed_ids) -> int:
+        """
+        Bring the lists up to date with writes to `changed_ids`. Their own
+        lists are recomputed; each changed product is then re-scored in the
+        lists that hold it and inserted into those whose weakest entry it now
+        beats. A list is recomputed only when it loses an entry: the product
+        was deleted, or re-scored below what the list used to hold. Returns
+        the number of lists rewritten.
+        """
+        with self._refresh_lock:
+            if self._docs is None:
+                self._load_state(db, self._state(db))
+            changed = sorted(set(changed_ids))
+            self._reload(db, changed)
+            corpus = self._corpus()
+            ids, row_of = corpus["ids"], corpus["row_of"]
+            holders: PyDict[int, set] = {}
+            for start in range(0, len(changed), 500):
+                for product_id, similar_id in (db.query(ProductSimilarORM.product_id, ProductSimilarORM.similar_id)
+                                               .filter(ProductSimilarORM.similar_id.in_(changed[start:start + 500]))):
+                    holders.setdefault(similar_id, set()).add(product_id)
+            lists: PyDict[int, PyList[tuple]] = {c: [] for c in changed if c not in row_of}
+            recompute = set().union(*(holders.get(c, set()) for c in lists))
+            live = np.array([row_of[c] for c in changed if c in row_of], np.int64)
+            if len(live):
+                floors = np.array([self._floors.get(i, -np.inf) for i in ids.tolist()])
+                scores = self._scores(corpus, live)
+                for j, row in enumerate(live):
+                    c = int(ids[row])
+                    lists[c] = self._top(ids, scores[j])
+                    # scores are symmetric, so this row also says where c now ranks in everyone else's list
+                    candidates = holders.get(c, set()) | {int(i) for i in ids[scores[j] > floors]}
+                    candidates = [p for p in candidates if p in row_of and p not in recompute and p not in changed]
+                    self._load_lists(db, [p for p in candidates if p not in lists], lists)
+                    for p in candidates:
+                        items, score = lists[p], float(scores[j][row_of[p]])
+                        held = dict(items)
+                        if not items and len(ids) > 2:
+                            recompute.add(p)  # never built; needs the full pass
+                        elif c in held:
+                            if len(items) >= self.k and score < min(held.values()):
+                                recompute.add(p)  # something outside the list may now outrank c
+                            else:
+                                held[c] = score
+                                lists[p] = sorted(held.items(), key=lambda e: (-e[1], e[0]))
+                        elif len(items) < self.k or score > items[-1][1]:
+                            held[c] = score
+                            lists[p] = sorted(held.items(), key=lambda e: (-e[1], e[0]))[:self.k]
+            rows = np.array([row_of[p] for p in sorted(recompute) if p in row_of and p not in changed], np.int64)
+            lists.update(self._top_k(corpus, rows))
+            self._store(db, lists)
+            db.commit()
+            self._set_floors(lists)
+            self.stats["refreshes"] += 1
+            self.stats["products_recomputed"] += len(lists)
+            return len(lists)
+
+    def _catch_up(self, db: Session) -> int:
+        with self._refresh_lock:
+            state = self._state(db)
+            if state is None:
+                return self.rebuild(db)["products"]
+            if self._docs is None or state.generation != self._generation:
+                self._load_state(db, state)
+            changes = (db.query(ProductChangeORM.seq, ProductChangeORM.product_id)
+                       .filter(ProductChangeORM.seq > self._change_seq).order_by(ProductChangeORM.seq).all())
+            if not changes:
+                db.rollback()
+                return 0
+            state.change_seq = changes[-1].seq  # committed with the lists
+            try:
+                refreshed = self.refresh(db, [c.product_id for c in changes])
+            except Exception:
+                self.reset()  # memory may be ahead of the rolled-back lists
+                raise
+            self._change_seq = changes[-1].seq
+            return refreshed
+
+    def ensure(self, db: Session):
+        """Build the index on first start against an existing catalog; only the maintainer does."""
+        if self._take_lock() and db.query(SimilarIndexStateORM.id).first() is None:
+            self.rebuild(db)
+
+    def reset(self):
+        """Forget the in-memory state; the next pass reloads it."""
+        with self._refresh_lock:
+            self._docs, self._floors, self._generation = None, {}, None
+
+    def info(self) -> PyDict[str, PyAny]:
+        return {
+            "k": self.k,
+            "maintainer": self._is_maintainer(),
+            "change_seq": self._change_seq,
+            "products": None if self._docs is None else len(self._docs),
+            "stats": self.stats,
+        }
+
+    # -- maintainer lock --------------------------------------------------
+
+    def _is_maintainer(self) -> bool:
+        return self._maintainer is not None and self._maintainer[0] == os.getpid()
+
+    def _take_lock(self) -> bool:
+        """Become the maintainer unless another process is; held until stop() or exit."""
+        with self._cond:
+            if self._is_maintainer():
+                return True
+            engine = self.session_factory.kw["bind"]
+            release = lambda: None
+            if engine.dialect.name == "postgresql":
+                conn = engine.connect()
+                taken = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": SIMILAR_LOCK_KEY}).scalar()
+                conn.commit()
+                if not taken:
+                    conn.close()
+                    return False
+                release = conn.invalidate  # drops the session and its lock rather than pooling them
+            elif engine.dialect.name == "sqlite" and fcntl is not None and engine.url.database not in (None, "", ":memory:"):
+                handle = open(f"{engine.url.database}.similar.lock", "a")
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    handle.close()
+                    return False
+                release = handle.close
+            self._maintainer = (os.getpid(), release)
+            self._generation = None  # whatever we hold in memory predates the last maintainer
+            return True
+
+    # -- background refresh ----------------------------------------------
+
+    def mark(self, product_id: int):
+        """A local product write: refresh after `delay` instead of at the next poll."""
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+        self.start()
+
+    def start(self):
+        # started from lifespan (or the first write) so that forked workers each get their own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="similar-refresh", daemon=True)
+                self._thread.start()
+
+    def flush(self) -> int:
+        """Apply every logged product write not in the index yet, in the calling thread; 0 unless we maintain it."""
+        with self._cond:
+            self._woken = False
+        if not self._take_lock():
+            return 0
+        db = self.session_factory()
+        try:
+            return self._catch_up(db)
+        except Exception:
+            db.rollback()
+            self.stats["errors"] += 1
+            raise
+        finally:
+            db.close()
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            self._thread.join()
+        with self._cond:
+            if self._is_maintainer():
+                self._maintainer[1]()
+                self._maintainer = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._woken and not self._stopping:
+                    self._cond.wait(self.poll)
+                if self._woken:
+                    # let a burst of writes collapse into one pass
+                    deadline = time.monotonic() + self.delay
+                    while not self._stopping and time.monotonic() < deadline:
+                        self._cond.wait(deadline - time.monotonic())
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                pass  # counted in stats; the log position didn't move, so the next pass retries
+
+
+similar_index = SimilarityIndex(
+    SessionLocal,
+    k=int(os.getenv("SIMILAR_PRODUCTS_K", "10")),
+    delay=_env_float("SIMILAR_REFRESH_DELAY", 1.0),
+    poll=_env_float("SIMILAR_POLL_INTERVAL", 5.0),
+)
+
+
+# ---------------------------
+# Chat write path (group commit)
+# ---------------------------
+
+class UserIdCache:
+    """
+    Ids of users known to exist, so chat sends skip the per-message user lookups.
+    Users are never deleted through the API, so cached ids do not go stale.
+    """
+    def __init__(self):
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def missing(self, db: Session, user_ids) -> set:
+        """Subset of `user_ids` that do not exist; only cache misses hit the DB."""
+        with self._lock:
+            unknown = {i for i in user_ids if i not in self._ids}
+        if not unknown:
+            return set()
+        found = {row[0] for row in db.query(UserORM.id).filter(UserORM.id.in_(unknown))}
+        with self._lock:
+            self._ids |= found
+        return unknown - found
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+class _PendingMessage:
+    __slots__ = ("row", "done", "error")
+
+    def __init__(self, row: ChatMessageORM):
+        self.row = row
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class ChatGroupCommitWriter:
+    """
+    Buffers chat message inserts for up to `max_delay` seconds (or `max_batch`
+    messages) and writes each batch as one multi-row INSERT in a single
+    transaction. Callers block until their batch commits and get back the row
+    with its id and timestamp filled in.
+    """
+    def __init__(self, session_factory, max_batch: int = 64, max_delay: float = 0.005):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = {"batches": 0, "messages": 0}
+        self._queue: "queue.Queue[Optional[_PendingMessage]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, sender_id: int, receiver_id: int, message: str) -> ChatMessageORM:
+        pending = _PendingMessage(ChatMessageORM(sender_id=sender_id, receiver_id=receiver_id, message=message, timestamp=datetime.utcnow()))
+        self._ensure_started()
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.row
+
+    def _ensure_started(self):
+        # started lazily so that forked workers each get their own flusher thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="chat-group-commit", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: PyList[_PendingMessage]):
+        error = None
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            db.add_all([p.row for p in batch])
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            error = exc
+        finally:
+            db.close()
+        if error is not None and len(batch) > 1:
+            # retry one by one so a single bad row only fails its own request
+            for p in batch:
+                self._flush([p])
+            return
+        if error is None:
+            self.stats["batches"] += 1
+            self.stats["messages"] += len(batch)
+        for p in batch:
+            p.error = error
+            p.done.set()
+
+
+known_users = UserIdCache()
+chat_writer = ChatGroupCommitWriter(
+    SessionLocal,
+    max_batch=int(os.getenv("CHAT_GROUP_COMMIT_MAX_BATCH", "64")),
+    max_delay=_env_float("CHAT_GROUP_COMMIT_MAX_DELAY_MS", 5.0) / 1000.0,
+)
+
+
+# ---------------------------
+# Chat archive (cold tier)
+# ---------------------------
+
+def _pack_messages(messages: PyList[ChatMessageORM]) -> bytes:
+    rows = [[m.id, m.sender_id, m.receiver_id, m.message, m.timestamp.isoformat() if m.timestamp else None] for m in messages]
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 6)
+
+
+def _unpack_messages(payload: bytes) -> PyList[PyDict[str, PyAny]]:
+    return [
+        {"id": i, "sender_id": s, "receiver_id": r, "message": m, "timestamp": datetime.fromisoformat(ts) if ts else None}
+        for i, s, r, m, ts in json.loads(zlib.decompress(payload))
+    ]
+
+
+class ChatArchiver:
+    """
+    Moves chat messages older than `hot_days` out of chat_messages into
+    compressed per-user chunks, `batch_size` messages per transaction, every
+    `interval` seconds. Several workers may run it: a batch whose rows were
+    already deleted by someone else rolls back.
+    """
+    def __init__(self, session_factory, hot_days: float = 30.0, batch_size: int = 5000, interval: float = 300.0):
+        self.session_factory = session_factory
+        self.hot_days = hot_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stats = {"batches": 0, "messages": 0, "chunks": 0, "conflicts": 0}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def cutoff(self) -> datetime:
+        return datetime.utcnow() - timedelta(days=self.hot_days)
+
+    def archive_batch(self, db: Session) -> int:
+        """Archive one batch of the oldest cold messages; returns how many moved."""
+        batch = (
+            db.query(ChatMessageORM)
+            .filter(ChatMessageORM.timestamp < self.cutoff())
+            .order_by(ChatMessageORM.id)
+            .limit(self.batch_size)
+            .all()
+        )
+        if not batch:
+            return 0
+        by_user: PyDict[int, PyList[ChatMessageORM]] = {}
+        for m in batch:
+            by_user.setdefault(m.sender_id, []).append(m)
+            if m.receiver_id != m.sender_id:
+                by_user.setdefault(m.receiver_id, []).append(m)
+        db.bulk_insert_mappings(ChatArchiveChunkORM, [
+            {"user_id": user_id, "first_id": ms[0].id, "last_id": ms[-1].id, "count": len(ms), "payload": _pack_messages(ms)}
+            for user_id, ms in by_user.items()
+        ])
+        ids = [m.id for m in batch]
+        deleted = db.query(ChatMessageORM).filter(ChatMessageORM.id.in_(ids)).delete(synchronize_session=False)
+        if deleted != len(ids):
+            db.rollback()
+            self.stats["conflicts"] += 1
+            return 0
+        db.commit()
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(ids)
+        self.stats["chunks"] += len(by_user)
+        return len(ids)
+
+    def run_once(self) -> int:
+        """Archive until no cold messages are left."""
+        total = 0
+        db = self.session_factory()
+        try:
+            while True:
+                moved = self.archive_batch(db)
+                total += moved
+                if moved < self.batch_size:
+                    return total
+        finally:
+            db.close()
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="chat-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                pass  # retried next interval
+
+
+def archived_messages(db: Session, user_id: int, before_id: Optional[int], limit: int) -> PyList[PyDict[str, PyAny]]:
+    """Newest-first archived messages of `user_id` with id < before_id, decompressing only the chunks needed."""
+    chunks = db.query(ChatArchiveChunkORM).filter(ChatArchiveChunkORM.user_id == user_id)
+    if before_id is not None:
+        chunks = chunks.filter(ChatArchiveChunkORM.first_id < before_id)
+    found: PyList[PyDict[str, PyAny]] = []
+    for chunk in chunks.order_by(ChatArchiveChunkORM.last_id.desc()).yield_per(16):
+        # chunks from different batches can interleave, so stop only once the next
+        # chunk ends below everything we would keep
+        if len(found) >= limit and chunk.last_id < found[limit - 1]["id"]:
+            break
+        found.extend(m for m in _unpack_messages(chunk.payload) if before_id is None or m["id"] < before_id)
+        found.sort(key=lambda m: m["id"], reverse=True)
+    return found[:limit]
+
+
+chat_archiver = ChatArchiver(
+    SessionLocal,
+    hot_days=_env_float("CHAT_HOT_DAYS", 30.0),
+    batch_size=int(os.getenv("CHAT_ARCHIVE_BATCH", "5000")),
+    interval=_env_float("CHAT_ARCHIVE_INTERVAL", 300.0),
+)
+
+
+# ---------------------------
+# Sales rollups
+# ---------------------------
+
+ROLLUP_COUNTERS = ("orders_approved", "orders_denied", "units_sold", "revenue_cents")
+
+
+def _sale_deltas(status: Optional[str], quantity: int, amount_cents: int, sign: int) -> PyDict[str, int]:
+    if status == "approved":
+        return {"orders_approved": sign, "units_sold": sign * quantity, "revenue_cents": sign * amount_cents}
+    if status == "denied":
+        return {"orders_denied": sign}
+    return {}
+
+
+def upsert_add(db: Session, model, key: PyDict[str, PyAny], conflict: PyList[str], deltas: PyDict[str, int]):
+    """
+    Add `deltas` to the row of `model` matching the unique `conflict` columns,
+    inserting it if missing, as one INSERT ... ON CONFLICT DO UPDATE so
+    concurrent first writers don't collide on the unique constraint.
+    """
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(model).values(**key, **deltas)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=conflict,
+        set_={counter: getattr(model, counter) + stmt.excluded[counter] for counter in deltas},
+    ))
+
+
+def _bump_rollup(db: Session, model, key: PyDict[str, PyAny], deltas: PyDict[str, int]):
+    conflict = ["seller_id", "day"] if model is SellerDailySalesORM else ["product_id", "day"]
+    upsert_add(db, model, key, conflict, {**dict.fromkeys(ROLLUP_COUNTERS, 0), **deltas})
+
+
+def record_sale_outcome(db: Session, tx: TransactionORM, order: OrderORM, seller_id: int,
+                        old_status: Optional[str], old_day: Optional[date]):
+    """
+    Move a transaction's contribution in the rollups from its previous verified
+    outcome (if it was verified before) to its current one. Runs inside the
+    caller's transaction.
+    """
+    per_day: PyDict[date, PyDict[str, int]] = {}
+    for status, day, sign in ((old_status, old_day, -1), (tx.status, tx.date.date(), 1)):
+        for counter, delta in _sale_deltas(status, order.quantity, tx.amount_cents, sign).items():
+            counters = per_day.setdefault(day, {})
+            counters[counter] = counters.get(counter, 0) + delta
+    for day, deltas in per_day.items():
+        if any(deltas.values()):
+            _bump_rollup(db, SellerDailySalesORM, {"seller_id": seller_id, "day": day}, deltas)
+            _bump_rollup(db, ProductDailySalesORM, {"product_id": order.product_id, "seller_id": seller_id, "day": day}, deltas)
+
+
+def rebuild_sales_rollups(db: Session, batch_size: int = 1000) -> PyDict[str, int]:
+    """
+    Backfill: recompute both rollup tables from transactions/orders, streaming
+    the source rows in batches. Run while verify traffic is quiet.
+    """
+    seller_rows: PyDict[tuple, PyDict[str, int]] = {}
+    product_rows: PyDict[tuple, PyDict[str, int]] = {}
+    query = db.query(
+        TransactionORM.status, TransactionORM.date, TransactionORM.amount_cents,
+        OrderORM.quantity, OrderORM.product_id, ProductORM.seller_id,
+    ).join(OrderORM, TransactionORM.order_id == OrderORM.id).join(ProductORM, OrderORM.product_id == ProductORM.id).filter(
+        TransactionORM.status.in_(("approved", "denied"))
+    ).order_by(TransactionORM.id).yield_per(batch_size)
+    for status, when, amount_cents, quantity, product_id, seller_id in query:
+        deltas = _sale_deltas(status, quantity, amount_cents, 1)
+        for rows, key in ((seller_rows, (seller_id, when.date())), (product_rows, (product_id, seller_id, when.date()))):
+            counters = rows.setdefault(key, dict.fromkeys(ROLLUP_COUNTERS, 0))
+            for counter, delta in deltas.items():
+                counters[counter] += delta
+    db.query(SellerDailySalesORM).delete()
+    db.query(ProductDailySalesORM).delete()
+    db.bulk_insert_mappings(SellerDailySalesORM, [
+        dict(counters, seller_id=seller_id, day=day) for (seller_id, day), counters in seller_rows.items()
+    ])
+    db.bulk_insert_mappings(ProductDailySalesORM, [
+        dict(counters, product_id=product_id, seller_id=seller_id, day=day)
+        for (product_id, seller_id, day), counters in product_rows.items()
+    ])
+    db.commit()
+    return {"seller_days": len(seller_rows), "product_days": len(product_rows)}
+
+
+# ---------------------------
+# Order read model
+# ---------------------------
+
+def sync_order_view(db: Session, order: OrderORM, tx: Optional[TransactionORM] = None,
+                    product: Optional[ProductORM] = None, buyer: Optional[UserORM] = None):
+    """Create or refresh the order_views row for `order` inside the caller's transaction."""
+    view = db.get(OrderViewORM, order.id)
+    if view is None:
+        product = product or order.product
+        buyer = buyer or db.get(UserORM, order.buyer_id)
+        view = OrderViewORM(
+            id=order.id,
+            buyer_id=order.buyer_id,
+            buyer_name=buyer.name,
+            seller_id=product.seller_id,
+            seller_name=product.seller.name,
+            product_id=product.id,
+            product_name=product.name,
+            product_image_url=product.image_url,
+            unit_price_cents=product.price_cents,
+        )
+        db.add(view)
+    view.quantity = order.quantity
+    view.status = order.status
+    view.order_date = order.order_date
+    view.completion_date = order.completion_date
+    tx = tx or order.transaction
+    if tx is not None:
+        view.transaction_id = tx.id
+        view.transaction_status = tx.status
+        view.amount_cents = tx.amount_cents
+
+
+def rebuild_order_views(db: Session, batch_size: int = 1000) -> PyDict[str, int]:
+    """
+    Backfill: rebuild order_views from orders, reading and writing keyset
+    batches of `batch_size` orders so memory stays flat however many there
+    are. One transaction, so readers never see a half-built table. The
+    product snapshot is taken from the product as it is now.
+    """
+    Seller = aliased(UserORM)
+    Buyer = aliased(UserORM)
+    query = db.query(
+        OrderORM.id, OrderORM.buyer_id, OrderORM.product_id, OrderORM.quantity, OrderORM.status, OrderORM.order_date,
+        OrderORM.completion_date, ProductORM.name, ProductORM.image_url, ProductORM.price_cents, ProductORM.seller_id,
+        Seller.name, Buyer.name, TransactionORM.id, TransactionORM.status, TransactionORM.amount_cents,
+    ).join(ProductORM, OrderORM.product_id == ProductORM.id).join(Seller, ProductORM.seller_id == Seller.id).join(
+        Buyer, OrderORM.buyer_id == Buyer.id
+    ).outerjoin(TransactionORM, TransactionORM.order_id == OrderORM.id)
+    db.query(OrderViewORM).delete()
+    total, last_id = 0, 0
+    while True:
+        batch = query.filter(OrderORM.id > last_id).order_by(OrderORM.id).limit(batch_size).all()
+        if not batch:
+            break
+        db.bulk_insert_mappings(OrderViewORM, [
+            {
+                "id": order_id, "buyer_id": buyer_id, "buyer_name": buyer_name, "seller_id": seller_id,
+                "seller_name": seller_name, "product_id": product_id, "product_name": name, "product_image_url": image_url,
+                "unit_price_cents": price_cents, "quantity": quantity, "status": status, "order_date": order_date,
+                "completion_date": completion_date, "transaction_id": tx_id, "transaction_status": tx_status,
+                "amount_cents": amount_cents,
+            }
+            for (order_id, buyer_id, product_id, quantity, status, order_date, completion_date, name, image_url,
+                 price_cents, seller_id, seller_name, buyer_name, tx_id, tx_status, amount_cents) in batch
+        ])
+        total += len(batch)
+        last_id = batch[-1][0]
+    db.commit()
+    return {"orders": total}
+
+
+def ensure_order_views(db: Session):
+    """Backfill the read model once for databases that predate it."""
+    if db.query(OrderViewORM.id).first() is None and db.query(OrderORM.id).first() is not None:
+        rebuild_order_views(db)
+
+
+# ---------------------------
+# Order status transitions
+# ---------------------------
+
+# status -> statuses an order may move to from it
+ORDER_TRANSITIONS: PyDict[str, set] = {
+    "created": {"processing", "cancelled"},
+    "processing": {"completed", "cancelled"},
+    "completed": set(),
+    "cancelled": set(),
+}
+BULK_STATUS_MAX_ORDERS = int(os.getenv("BULK_STATUS_MAX_ORDERS", "500"))
+
+
+def transition_orders(db: Session, seller_id: int, order_ids: PyList[int], status: str) -> PyList[PyDict[str, PyAny]]:
+    """
+    Move the seller's orders in `order_ids` to `status` with one guarded
+    UPDATE (only rows still in an allowed source status change) plus one
+    UPDATE of their order_views rows, in the caller's transaction. Returns a
+    result per id; orders that can't move are reported and left alone.
+    """
+    sources = [source for source, targets in ORDER_TRANSITIONS.items() if status in targets]
+    current = {
+        order_id: (order_status, owner)
+        for order_id, order_status, owner in db.query(OrderORM.id, OrderORM.status, ProductORM.seller_id)
+        .join(ProductORM, OrderORM.product_id == ProductORM.id).filter(OrderORM.id.in_(order_ids))
+    }
+    results: PyDict[int, PyDict[str, PyAny]] = {}
+    candidates = []
+    for order_id in order_ids:
+        order_status, owner = current.get(order_id, (None, None))
+        if order_status is None:
+            results[order_id] = {"id": order_id, "ok": False, "status": None, "detail": "Order not found"}
+        elif owner != seller_id:
+            results[order_id] = {"id": order_id, "ok": False, "status": None, "detail": "Order belongs to another seller"}
+        elif order_status == status:
+            results[order_id] = {"id": order_id, "ok": True, "status": status, "detail": f"Already {status}"}
+        elif order_status not in sources:
+            results[order_id] = {"id": order_id, "ok": False, "status": order_status,
+                                 "detail": f"Cannot move a {order_status} order to {status}"}
+        else:
+            candidates.append(order_id)
+    if candidates:
+        values: PyDict[str, PyAny] = {"status": status}
+        if status == "completed":
+            values["completion_date"] = datetime.utcnow()
+        elif status == "cancelled":
+            values["completion_date"] = None
+        moved = set(db.execute(
+            update(OrderORM).where(OrderORM.id.in_(candidates), OrderORM.status.in_(sources)).values(**values)
+            .returning(OrderORM.id).execution_options(synchronize_session=False)
+        ).scalars())
+        if moved:
+            db.execute(update(OrderViewORM).where(OrderViewORM.id.in_(moved)).values(**values)
+                       .execution_options(synchronize_session=False))
+        for order_id in candidates:
+            if order_id in moved:
+                results[order_id] = {"id": order_id, "ok": True, "status": status, "detail": None}
+            else:
+                results[order_id] = {"id": order_id, "ok": False, "status": None, "detail": "Order changed concurrently"}
+    return [results[order_id] for order_id in order_ids]
+
+
+# ---------------------------
+# Trending products (sliding window of order counts)
+# ---------------------------
+
+class TrendingCounter:
+    """
+    Orders per product over the last `window_minutes`, kept as a ring of
+    per-minute Counters plus running window totals. Top-`top_k` lists are
+    maintained incrementally, globally and per map cell at every
+    FACET_PRECISIONS level, so reading them never scans the window; they are
+    rebuilt only when a minute falls out of the window.
+
+    Each worker counts its own orders and flushes the per-minute deltas to
+    trending_buckets every `flush_interval` seconds, then reloads the window
+    from the table, so counts survive restarts and converge across workers.
+    """
+    def __init__(self, session_factory, window_minutes: int = 60, top_k: int = 50, flush_interval: float = 30.0):
+        self.session_factory = session_factory
+        self.window_minutes = window_minutes
+        self.top_k = top_k
+        self.flush_interval = flush_interval
+        self.stats = {"recorded": 0, "flushes": 0, "flushed_rows": 0}
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()  # (minute, product_id) -> orders not yet flushed
+        self._load_window({}, {})
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _load_window(self, minutes: PyDict[int, Counter], locations: PyDict[int, PyAny]):
+        self._buckets: deque = deque((minute, minutes[minute]) for minute in sorted(minutes))  # oldest first
+        self._totals: Counter = Counter()
+        for _, bucket in self._buckets:
+            self._totals.update(bucket)
+        self._locations: PyDict[int, PyAny] = dict(locations)  # product_id -> (lat, lon) or None
+        self._minute: Optional[int] = None
+        self._rebuild_top()
+
+    def _scopes(self, product_id: int):
+        """None for the global list, then the product's map cell at each precision."""
+        yield None
+        location = self._locations.get(product_id)
+        if location is not None:
+            for precision in FACET_PRECISIONS:
+                yield (precision, *cell_index(location[0], location[1], precision))
+
+    def _rebuild_top(self):
+        self._top: PyDict[PyAny, PyDict[int, int]] = {}
+        for product_id, count in self._totals.items():
+            for scope in self._scopes(product_id):
+                self._top.setdefault(scope, {})[product_id] = count
+        for scope, counts in self._top.items():
+            if len(counts) > self.top_k:
+                self._top[scope] = dict(heapq.nlargest(self.top_k, counts.items(), key=lambda kv: kv[1]))
+
+    def _bump_top(self, product_id: int, count: int):
+        for scope in self._scopes(product_id):
+            top = self._top.setdefault(scope, {})
+            if product_id in top or len(top) < self.top_k:
+                top[product_id] = count
+                continue
+            weakest = min(top, key=top.get)
+            if count > top[weakest]:
+                del top[weakest]
+                top[product_id] = count
+
+    def _advance(self, minute: int):
+        """Drop buckets that fell out of the window ending at `minute`."""
+        if self._minute is not None and minute <= self._minute:
+            return
+        self._minute = minute
+        expired = False
+        while self._buckets and self._buckets[0][0] <= minute - self.window_minutes:
+            _, bucket = self._buckets.popleft()
+            self._totals.subtract(bucket)
+            expired = True
+        if expired:
+            self._totals = +self._totals
+            for product_id in [p for p in self._locations if p not in self._totals]:
+                del self._locations[product_id]
+            self._rebuild_top()
+
+    def clear(self):
+        """Forget all in-memory counts, including unflushed ones."""
+        with self._lock:
+            self._pending.clear()
+            self._load_window({}, {})
+
+    def apply(self, before: PyDict[str, PyAny], after: Optional[PyDict[str, PyAny]]):
+        """Follow a product update (new map cell) or delete (counts dropped)."""
+        product_id = before["id"]
+        with self._lock:
+            if product_id not in self._locations:
+                return
+            if after is None:
+                for _, bucket in self._buckets:
+                    bucket.pop(product_id, None)
+                self._totals.pop(product_id, None)
+                del self._locations[product_id]
+                for key in [key for key in self._pending if key[1] == product_id]:
+                    del self._pending[key]
+            elif (before["lat"], before["lon"]) != (after["lat"], after["lon"]):
+                self._locations[product_id] = (after["lat"], after["lon"]) if after["lat"] is not None and after["lon"] is not None else None
+            else:
+                return
+            self._rebuild_top()
+
+    def record(self, product_id: int, lat: Optional[float], lon: Optional[float], now: Optional[float] = None):
+        minute = int((now if now is not None else time.time()) // 60)
+        with self._lock:
+            self._advance(minute)
+            if not self._buckets or self._buckets[-1][0] != minute:
+                self._buckets.append((minute, Counter()))
+            self._buckets[-1][1][product_id] += 1
+            self._totals[product_id] += 1
+            location = (lat, lon) if lat is not None and lon is not None else None
+            moved = product_id in self._locations and self._locations[product_id] != location
+            self._locations[product_id] = location
+            self._pending[(minute, product_id)] += 1
+            if moved:
+                self._rebuild_top()  # drop it from its old cells' lists
+            else:
+                self._bump_top(product_id, self._totals[product_id])
+            self.stats["recorded"] += 1
+
+    def top(self, limit: int = 10, lat: Optional[float] = None, lon: Optional[float] = None,
+            radius_km: Optional[float] = None, now: Optional[float] = None) -> PyList[tuple]:
+        """
+        [(product_id, orders)] most ordered in the window, optionally within
+        radius_km of lat/lon. Radius results are approximate: each covering cell
+        only keeps its top_k products, so in a busy border cell a product inside
+        the radius can be crowded out by busier ones just outside it.
+        """
+        with self._lock:
+            self._advance(int((now if now is not None else time.time()) // 60))
+            if radius_km is None:
+                candidates = dict(self._top.get(None, {}))
+            else:
+                precision = facet_precision(lat, lon, radius_km)
+                min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+                x0, y0 = cell_index(min_lat, min_lon, precision)
+                x1, y1 = cell_index(max_lat, max_lon, precision)
+                candidates = {}
+                for x in range(x0, x1 + 1):
+                    for y in range(y0, y1 + 1):
+                        for product_id, count in self._top.get((precision, x, y), {}).items():
+                            location = self._locations.get(product_id)
+                            # lists can briefly name a product whose location was cleared since
+                            if location is not None and distance_km(lat, lon, *location) <= radius_km:
+                                candidates[product_id] = count
+        return heapq.nlargest(limit, candidates.items(), key=lambda kv: (kv[1], kv[0]))
+
+    def flush(self):
+        """Write pending per-minute counts, prune expired rows and reload the window from the table."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        now_minute = int(time.time() // 60)
+        first_minute = now_minute - self.window_minutes + 1
+        db = self.session_factory()
+        try:
+            for (minute, product_id), n in pending.items():
+                upsert_add(db, TrendingBucketORM, {"minute": minute, "product_id": product_id}, ["minute", "product_id"], {"count": n})
+            db.query(TrendingBucketORM).filter(TrendingBucketORM.minute < first_minute).delete(synchronize_session=False)
+            db.commit()
+            rows = db.query(TrendingBucketORM.minute, TrendingBucketORM.product_id, TrendingBucketORM.count).filter(
+                TrendingBucketORM.minute >= first_minute).all()
+            ids = {product_id for _, product_id, _ in rows}
+            locations = {
+                product_id: (lat, lon) if lat is not None and lon is not None else None
+                for product_id, lat, lon in db.query(ProductORM.id, ProductORM.lat, ProductORM.lon).filter(ProductORM.id.in_(ids))
+            } if ids else {}
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        finally:
+            db.close()
+        minutes: PyDict[int, Counter] = {}
+        for minute, product_id, count in rows:
+            if product_id in locations:  # deleted products drop out here
+                minutes.setdefault(minute, Counter())[product_id] += count
+        with self._lock:
+            # orders recorded while we were writing are in memory but not in the table yet
+            for (minute, product_id), n in self._pending.items():
+                if minute >= first_minute:
+                    minutes.setdefault(minute, Counter())[product_id] += n
+                    locations.setdefault(product_id, self._locations.get(product_id))
+            self._load_window(minutes, locations)
+            self._advance(now_minute)
+            self.stats["flushes"] += 1
+            self.stats["flushed_rows"] += len(pending)
+
+    def info(self) -> PyDict[str, PyAny]:
+        with self._lock:
+            return {
+                "window_minutes": self.window_minutes,
+                "products": len(self._totals),
+                "buckets": len(self._buckets),
+                "pending": len(self._pending),
+                "stats": self.stats,
+            }
+
+    def start(self):
+        if self.flush_interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="trending-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                pass  # pending counts were put back; retried next interval
+
+
+trending = TrendingCounter(
+    SessionLocal,
+    window_minutes=int(os.getenv("TRENDING_WINDOW_MINUTES", "60")),
+    top_k=int(os.getenv("TRENDING_TOP_K", "50")),
+    flush_interval=_env_float("TRENDING_FLUSH_INTERVAL", 30.0),
+)
+
+
+# ---------------------------
+# Image store (content-addressed) & thumbnails
+# ---------------------------
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are skipped without Pillow; originals still work
+    Image = None
+
+IMAGE_TYPES = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+IMAGE_MEDIA_TYPES = {ext: media_type for media_type, ext in IMAGE_TYPES.items()}
+IMAGE_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP", "gif": "GIF"}  # Pillow's name for each
+THUMBNAIL_SIZES = (200, 400)
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+_STORED_IMAGE_URL = re.compile(r"^(?P<base>.*)/images/(?P<digest>[0-9a-f]{64})\.(?:jpg|png|webp|gif)$")
+
+
+def _render_thumbnail(src: str, dst: str, size: int) -> str:
+    """Runs in the thumbnail process pool."""
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((size, size))
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        im.save(tmp, "JPEG", quality=85, optimize=True)
+    os.replace(tmp, dst)
+    return dst
+
+
+def thumbnail_urls(image_url: Optional[str]) -> PyDict[str, str]:
+    """Thumbnail URLs by size for images held in the local store; {} for external URLs."""
+    match = _STORED_IMAGE_URL.match(image_url or "")
+    if not match or Image is None:
+        return {}
+    return {str(size): f"{match['base']}/images/thumbs/{size}/{match['digest']}.jpg" for size in THUMBNAIL_SIZES}
+
+
+class ImageStore:
+    """
+    Uploads are stored once under their SHA-256 (root/ab/<digest>.<ext>), so
+    re-uploads of the same bytes are free and URLs can be cached forever.
+    Thumbnails are rendered in a process pool, off the request threads.
+    """
+    def __init__(self, root: str, max_bytes: int, thumbnail_workers: int = 2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.thumbnail_workers = thumbnail_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._jobs: PyDict[tuple, PyAny] = {}
+        self._lock = threading.Lock()
+
+    def original_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}.{ext}")
+
+    def thumbnail_path(self, digest: str, size: int) -> str:
+        return os.path.join(self.root, "thumbs", str(size), f"{digest}.jpg")
+
+    @staticmethod
+    def _append(f, sha, chunk: bytes):
+        sha.update(chunk)
+        f.write(chunk)
+
+    def _verify(self, path: str, ext: str):
+        """415 unless the file decodes as the declared image type."""
+        if Image is None:
+            return  # can't check without Pillow
+        try:
+            with Image.open(path) as im:
+                fmt = im.format
+                im.verify()
+        except Exception:
+            raise HTTPException(status_code=415, detail=f"Upload is not a valid {IMAGE_MEDIA_TYPES[ext]} image")
+        if fmt != IMAGE_FORMATS[ext]:
+            raise HTTPException(status_code=415, detail=f"Upload is {fmt}, not {IMAGE_MEDIA_TYPES[ext]}")
+
+    def _store(self, tmp: str, digest: str, ext: str):
+        self._verify(tmp, ext)
+        dst = self.original_path(digest, ext)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            os.remove(tmp)  # already stored
+        else:
+            os.replace(tmp, dst)
+
+    async def save(self, chunks, ext: str) -> str:
+        """Stream `chunks` into the store and return the digest; hashing and disk I/O run in the threadpool."""
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".upload")
+        sha, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise HTTPException(status_code=413, detail=f"Image larger than {self.max_bytes} bytes")
+                    await run_in_threadpool(self._append, f, sha, chunk)
+            if size == 0:
+                raise HTTPException(status_code=400, detail="Empty upload")
+            digest = sha.hexdigest()
+            await run_in_threadpool(self._store, tmp, digest, ext)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.schedule_thumbnails(digest, ext)
+        return digest
+
+    def find_original(self, digest: str) -> Optional[str]:
+        for ext in IMAGE_MEDIA_TYPES:
+            path = self.original_path(digest, ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def schedule_thumbnails(self, digest: str, ext: str):
+        if Image is None:
+            return
+        for size in THUMBNAIL_SIZES:
+            self._submit(digest, self.original_path(digest, ext), size)
+
+    def _submit(self, digest: str, src: str, size: int):
+        dst = self.thumbnail_path(digest, size)
+        with self._lock:
+            job = self._jobs.get((digest, size))
+            if job is not None or os.path.exists(dst):
+                return job
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.thumbnail_workers)
+            job = self._jobs[(digest, size)] = self._pool.submit(_render_thumbnail, src, dst, size)
+        job.add_done_callback(lambda _: self._jobs.pop((digest, size), None))
+        return job
+
+    def thumbnail(self, digest: str, size: int, timeout: float = 10.0) -> Optional[str]:
+        """Path of the thumbnail, rendering it first (and waiting) if needed."""
+        dst = self.thumbnail_path(digest, size)
+        if os.path.exists(dst):
+            return dst
+        src = self.find_original(digest)
+        if src is None or Image is None:
+            return None
+        job = self._submit(digest, src, size)
+        if job is not None:
+            job.result(timeout=timeout)
+        return dst if os.path.exists(dst) else None
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
+image_store = ImageStore(
+    os.getenv("IMAGE_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media")),
+    max_bytes=int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024))),
+    thumbnail_workers=int(os.getenv("THUMBNAIL_WORKERS", "2")),
+)
+
+
+# ---------------------------
+# Payment gateway (bulkheaded client)
+# ---------------------------
+
+class GatewayError(Exception):
+    """Transient provider failure (network error, 5xx); safe to retry."""
+
+
+class GatewayUnavailable(Exception):
+    """The provider can't be called right now: circuit open, pool saturated or retries exhausted."""
+    def __init__(self, reason: str, retry_after: float = 1.0):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class PaymentGateway:
+    """
+    Provider interface. Calls block and run on the payment pool, never on a
+    request thread; both must be idempotent per transaction so they can be
+    retried.
+    """
+    def submit(self, transaction_id: int, amount_cents: int) -> None:
+        raise NotImplementedError
+
+    def verify(self, transaction_id: int, amount_cents: int) -> bool:
+        raise NotImplementedError
+
+
+class SimulatedGateway(PaymentGateway):
+    """
+    Local stand-in for load testing: log-normal latency with median
+    `latency_ms`, a share `error_rate` of calls failing transiently, and
+    `approve_rate` of verifications approved.
+    """
+    def __init__(self, latency_ms: float = 0.0, latency_sigma: float = 0.5, error_rate: float = 0.0, approve_rate: float = 0.7):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.approve_rate = approve_rate
+
+    def _call(self):
+        if self.latency_ms > 0:
+            time.sleep(random.lognormvariate(log(self.latency_ms / 1000.0), self.latency_sigma))
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            raise GatewayError("simulated provider error")
+
+    def submit(self, transaction_id: int, amount_cents: int) -> None:
+        self._call()
+
+    def verify(self, transaction_id: int, amount_cents: int) -> bool:
+        self._call()
+        return random.choices([True, False], weights=[self.approve_rate, 1 - self.approve_rate])[0]
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and fails fast for
+    `reset_timeout` seconds; then lets a single trial call through, closing
+    again if it succeeds.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open":
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise GatewayUnavailable("payment provider circuit open", retry_after=remaining)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_running:
+                    raise GatewayUnavailable("payment provider circuit half-open")
+                self._trial_running = True
+
+    def abandon_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.state, self.failures, self._trial_running = "closed", 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class PaymentClient:
+    """
+    Calls `gateway` on its own pool of `pool_size` threads with at most
+    `max_queue` calls waiting, so a slow provider can only tie up this pool,
+    not the request threads or the DB pool. Each attempt gets `timeout`
+    seconds; transient failures are retried up to `retries` times with
+    jittered exponential backoff, behind a circuit breaker. A timed-out call
+    keeps its pool slot until the provider actually returns.
+    """
+    def __init__(self, gateway: PaymentGateway, pool_size: int = 8, max_queue: int = 16, timeout: float = 5.0,
+                 retries: int = 2, backoff: float = 0.1, breaker: Optional[CircuitBreaker] = None):
+        self.gateway = gateway
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.in_flight = 0
+        self.stats = {"calls": 0, "retries": 0, "timeouts": 0, "errors": 0, "rejected": 0}
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None  # created lazily so pre-forked workers get their own
+
+    def _release(self, _future):
+        with self._lock:
+            self.in_flight -= 1
+
+    async def _attempt(self, method: str, *args):
+        with self._lock:
+            if self.in_flight >= self.pool_size + self.max_queue:
+                self.stats["rejected"] += 1
+                raise GatewayUnavailable("payment pool saturated")
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.pool_size, thread_name_prefix="payment")
+            self.in_flight += 1
+        future = self._pool.submit(getattr(self.gateway, method), *args)
+        future.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    async def call(self, method: str, *args):
+        """Run gateway.<method>(*args); raises GatewayUnavailable when it can't get an answer."""
+        self.stats["calls"] += 1
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+            try:
+                result = await self._attempt(method, *args)
+            except GatewayUnavailable:
+                self.breaker.abandon_trial()  # never reached the provider
+                raise
+            except (GatewayError, asyncio.TimeoutError) as exc:
+                self.stats["timeouts" if isinstance(exc, asyncio.TimeoutError) else "errors"] += 1
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise GatewayUnavailable(f"payment provider failed: {type(exc).__name__}") from exc
+                self.stats["retries"] += 1
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    def info(self) -> PyDict[str, PyAny]:
+        return {
+            "gateway": type(self.gateway).__name__,
+            "pool_size": self.pool_size,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "breaker": self.breaker.state,
+            "stats": self.stats,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+payments = PaymentClient(
+    SimulatedGateway(
+        latency_ms=_env_float("PAYMENT_SIM_LATENCY_MS", 0.0),
+        latency_sigma=_env_float("PAYMENT_SIM_LATENCY_SIGMA", 0.5),
+        error_rate=_env_float("PAYMENT_SIM_ERROR_RATE", 0.0),
+        approve_rate=_env_float("PAYMENT_SIM_APPROVE_RATE", 0.7),
+    ),
+    pool_size=int(os.getenv("PAYMENT_POOL_SIZE", "8")),
+    max_queue=int(os.getenv("PAYMENT_MAX_QUEUE", "16")),
+    timeout=_env_float("PAYMENT_TIMEOUT", 5.0),
+    retries=int(os.getenv("PAYMENT_RETRIES", "2")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("PAYMENT_BREAKER_FAILURES", "5")),
+        reset_timeout=_env_float("PAYMENT_BREAKER_RESET", 30.0),
+    ),
+)
+
+
+# ---------------------------
+# Pydantic Schemas
+# ---------------------------
+
+class UserCreate(BaseModel):
+    name: str
+    email: EmailStr
+    role: str = Field(..., example="buyer")  # buyer or seller
+    phone: Optional[str] = None
+    location: Optional[str] = None
+    profile_pic: Optional[str] = None
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+
+class UserOut(BaseModel):
+    id: int
+    name: str
+    email: EmailStr
+    role: str
+    phone: Optional[str] = None
+    location: Optional[str] = None
+    profile_pic: Optional[str] = None
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+    class Config:
+        orm_mode = True
+
+
+class LoginRequest(BaseModel):
+    name: Optional[str] = None
+    email: Optional[EmailStr] = None
+
+
+class ProductCreate(BaseModel):
+    name: str
+    description: Optional[str] = None
+    price: Optional[float] = Field(None, ge=0, allow_inf_nan=False)  # major units; converted to cents on the way in
+    price_cents: Optional[int] = Field(None, ge=0)
+    category: Optional[str] = None
+    image_url: Optional[str] = None
+    seller_id: int
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+
+class ProductUpdate(BaseModel):
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
+    price_cents: Optional[int] = Field(None, ge=0)
+    category: Optional[str] = None
+    image_url: Optional[str] = None
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+
+class ProductOut(BaseModel):
+    id: int
+    name: str
+    description: Optional[str]
+    price: float  # price_cents / 100, kept for existing clients
+    price_cents: int
+    category: Optional[str]
+    image_url: Optional[str]
+    thumbnails: Dict[str, str] = {}  # size -> URL, for images in the local store
+    seller_id: int
+    lat: Optional[float]
+    lon: Optional[float]
+
+    class Config:
+        orm_mode = True
+
+
+class ProductNearOut(ProductOut):
+    distance_km: float
+
+
+class TrendingProductOut(ProductOut):
+    orders: int  # orders in the trending window
+
+
+class OrderCreate(BaseModel):
+    buyer_id: int
+    product_id: int
+    quantity: int = 1
+
+
+class OrderOut(BaseModel):
+    id: int
+    buyer_id: int
+    product_id: int
+    quantity: int
+    status: str
+    order_date: datetime
+    completion_date: Optional[datetime]
+
+    class Config:
+        orm_mode = True
+
+
+class OrderStatusBulk(BaseModel):
+    seller_id: int
+    order_ids: List[int]
+    status: str
+
+
+class OrderTransitionOut(BaseModel):
+    id: int
+    ok: bool
+    status: Optional[str]  # the order's status afterwards, when known
+    detail: Optional[str] = None
+
+
+class OrderStatusBulkOut(BaseModel):
+    updated: int
+    results: List[OrderTransitionOut]
+
+
+class OrderViewOut(BaseModel):
+    id: int
+    buyer_id: int
+    buyer_name: str
+    seller_id: int
+    seller_name: str
+    product_id: int
+    product_name: str
+    product_image_url: Optional[str]
+    unit_price: float
+    unit_price_cents: int
+    quantity: int
+    status: str
+    order_date: datetime
+    completion_date: Optional[datetime]
+    transaction_id: Optional[int]
+    transaction_status: Optional[str]
+    amount: Optional[float]
+    amount_cents: Optional[int]
+
+    class Config:
+        orm_mode = True
+
+
+class TransactionCreate(BaseModel):
+    order_id: int
+
+
+class TransactionOut(BaseModel):
+    id: int
+    order_id: int
+    amount: float  # amount_cents / 100
+    amount_cents: int
+    status: str
+    date: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class SalesCounters(BaseModel):
+    orders_approved: int = 0
+    orders_denied: int = 0
+    units_sold: int = 0
+    revenue_cents: int = 0
+
+
+class DailySalesOut(SalesCounters):
+    day: date
+
+    class Config:
+        orm_mode = True
+
+
+class ProductSalesOut(SalesCounters):
+    product_id: int
+
+
+class SellerStatsOut(BaseModel):
+    seller_id: int
+    since: date
+    totals: SalesCounters
+    daily: List[DailySalesOut]
+    products: List[ProductSalesOut]
+
+
+class ImageOut(BaseModel):
+    digest: str
+    url: str
+    thumbnails: Dict[str, str]
+
+
+class ProductPage(BaseModel):
+    total: int
+    items: List[ProductOut]
+
+
+class SimilarProductOut(ProductOut):
+    score: float
+
+
+class ProductChangeOut(BaseModel):
+    id: int
+    deleted: bool
+    product: Optional[ProductOut] = None
+
+
+class ProductChangesOut(BaseModel):
+    changes: List[ProductChangeOut]
+    token: str
+    has_more: bool
+
+
+class CategoryCount(BaseModel):
+    category: Optional[str]
+    count: int
+
+
+class PriceBucket(BaseModel):
+    min_cents: int
+    max_cents: Optional[int]  # None for the open-ended top bucket
+    count: int
+
+
+class FacetsOut(BaseModel):
+    total: int
+    categories: List[CategoryCount]
+    price_histogram: List[PriceBucket]
+    precision: int
+
+
+class ClusterOut(BaseModel):
+    cell: str
+    precision: int
+    count: int
+    lat: float
+    lon: float
+    representative: Optional[ProductOut] = None
+
+
+class ChatSend(BaseModel):
+    sender_id: int
+    receiver_id: int
+    message: str
+
+
+class ChatOut(BaseModel):
+    id: int
+    sender_id: int
+    receiver_id: int
+    message: str
+    timestamp: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class BatchOperation(BaseModel):
+    id: Optional[str] = None  # echoed back so the client can match results
+    path: str  # e.g. "/chat/3" or "/products/browse?q=lamp"
+    params: Dict[str, Any] = {}
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+
+class BatchResult(BaseModel):
+    id: Optional[str]
+    status: int
+    headers: Dict[str, str]
+    body: Any
+
+
+# ---------------------------
+# FastAPI app & dependencies
+# ---------------------------
+
+from contextlib import asynccontextmanager
+from fastapi import Header, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
+from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+
+try:
+    import brotli
+except ImportError:  # gzip only without the brotli package
+    brotli = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db = SessionLocal()
+    try:
+        ensure_product_cells(db)
+        ensure_product_facets(db)
+        ensure_order_views(db)
+        similar_index.ensure(db)
+        catalog.warm(db)
+    finally:
+        db.close()
+    trending.flush()
+    chat_archiver.start()
+    trending.start()
+    similar_index.start()
+    yield
+    chat_archiver.stop()
+    trending.stop()
+    trending.flush()
+    chat_writer.stop()
+    similar_index.stop()
+    image_store.shutdown()
+    payments.shutdown()
+
+
+app = FastAPI(title="Thrift Management System (OOP + SQLAlchemy single-file)", lifespan=lifespan)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    # the default handler echoes each input back, and NaN/Infinity can't be encoded as JSON
+    errors = [
+        {**error, "input": str(error["input"])} if isinstance(error.get("input"), float) and not isfinite(error["input"]) else error
+        for error in exc.errors()
+    ]
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
+
+
+def route_label(scope) -> str:
+    """Route template for a request scope, e.g. 'GET /chat/{user_id}'."""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return f"{scope['method']} {route.path}"
+    return f"{scope['method']} {scope['path']}"
+
+
+# ---------------------------
+# Sampling profiler (on demand, admin only)
+# ---------------------------
+
+def _context_of_frame(frame) -> Optional[Context]:
+    """
+    The contextvars.Context a frame is running code under, for the two frames
+    that switch context: asyncio's Handle._run (event loop callbacks, i.e.
+    task steps) and anyio's worker-thread loop (sync endpoints and
+    serialization run via run_in_threadpool).
+    """
+    code = frame.f_code
+    if code is asyncio.events.Handle._run.__code__:
+        return getattr(frame.f_locals.get("self"), "_context", None)
+    if code.co_name == "run" and "context" in code.co_varnames and "anyio" in code.co_filename:
+        context = frame.f_locals.get("context")
+        return context if isinstance(context, Context) else None
+    return None
+
+
+class StackSampler:
+    """
+    Statistical profiler for this worker process: the sampling thread wakes
+    every `interval` seconds, reads every other thread's stack from
+    sys._current_frames() and counts (route, stack) pairs. No tracing hooks
+    are installed, so the request threads pay nothing between samples; the
+    cost is one stack walk per thread per tick. The route comes from the
+    current_route ContextVar of the context the stack is running under.
+    """
+    def __init__(self, max_depth: int = 96):
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+
+    def _sample(self, counts: Counter, skip: int, all_threads: bool):
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            stack, route = [], None
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")  # co_qualname is 3.11+
+                if route is None:
+                    context = _context_of_frame(frame)
+                    if context is not None:
+                        route = context.get(current_route, None)
+                frame = frame.f_back
+            if route is None and not all_threads:
+                continue  # idle pool threads, the event loop waiting in select, background workers
+            stack.append(route or "(no route)")
+            counts[";".join(reversed(stack))] += 1
+
+    def run(self, seconds: float, interval: float, all_threads: bool = False) -> Optional[PyDict[str, PyAny]]:
+        """Sample from the calling thread for `seconds`; None if another profile is running."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            counts: Counter = Counter()
+            ticks = 0
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self._sample(counts, me, all_threads)
+                ticks += 1
+                time.sleep(interval)
+            return {"ticks": ticks, "interval": interval, "stacks": counts}
+        finally:
+            self._lock.release()
+
+
+def collapsed_stacks(stacks: Counter, route: Optional[str] = None) -> str:
+    """Brendan Gregg's collapsed format ('root;frame;leaf count' per line); the route is the root frame."""
+    lines = [
+        f"{stack} {count}"
+        for stack, count in stacks.most_common()
+        if route is None or stack.split(";", 1)[0] == route
+    ]
+    return "\n".join(lines) + "\n"
+
+
+stack_sampler = StackSampler()
+
+
+# ---------------------------
+# Allocation tracking (opt-in via ALLOC_TRACKING)
+# ---------------------------
+
+alloc_log = logging.getLogger("thrift.alloc")
+
+
+class AllocationTracker:
+    """
+    Per-route memory accounting with tracemalloc. A sampled request records
+    its net allocated bytes and blocks, and its peak above the starting level;
+    a snapshot diff taken before the response leaves attributes the net growth
+    to allocation sites. tracemalloc counters are process-wide, so only one
+    request is measured at a time and overlapping ones are skipped. Requests
+    whose peak passes `budget_bytes` are logged with their top sites.
+    Tracing slows allocation-heavy code noticeably; keep it off in normal
+    operation.
+    """
+    def __init__(self, sample_rate: float = 0.1, budget_bytes: Optional[int] = None,
+                 frames: int = 8, top_sites: int = 20, enabled: bool = False):
+        self.sample_rate = sample_rate
+        self.budget_bytes = budget_bytes
+        self.frames = frames
+        self.top_sites = top_sites
+        self.routes: PyDict[str, PyDict[str, PyAny]] = {}
+        self.sites: PyDict[str, Counter] = {}
+        self.over_budget: deque = deque(maxlen=100)
+        self.stats = {"tracked": 0, "skipped_concurrent": 0}
+        self._busy = threading.Lock()
+        self.enabled = False
+        if enabled:
+            self.enable()
+
+    def enable(self, sample_rate: Optional[float] = None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        self.routes.clear()
+        self.sites.clear()
+        self.over_budget.clear()
+
+    def should_track(self) -> bool:
+        return self.enabled and random.random() < self.sample_rate
+
+    def begin(self):
+        """Start measuring; None if another request is being measured. Blocking: call off the event loop."""
+        if not self._busy.acquire(blocking=False):
+            self.stats["skipped_concurrent"] += 1
+            return None
+        try:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            return current, tracemalloc.take_snapshot()
+        except Exception:
+            self._busy.release()
+            if not tracemalloc.is_tracing():
+                return None  # disabled since should_track()
+            raise
+
+
+    def end(self, route: str, started):
+        """Record the request measured since begin(). Blocking (snapshot diff): call off the event loop."""
+        try:
+            if not tracemalloc.is_tracing():
+                return  # disabled while this request was running
+            base, before = started
+            current, peak = tracemalloc.get_traced_memory()
+            diff = [d for d in tracemalloc.take_snapshot().compare_to(before, "lineno") if d.size_diff > 0]
+        finally:
+            self._busy.release()
+        net_bytes, peak_bytes = current - base, peak - base
+        net_blocks = sum(d.count_diff for d in diff)
+        self.stats["tracked"] += 1
+        agg = self.routes.setdefault(route, {"requests": 0, "net_bytes": 0, "net_blocks": 0, "peak_bytes": 0,
+                                             "max_peak_bytes": 0, "over_budget": 0})
+        agg["requests"] += 1
+        agg["net_bytes"] += net_bytes
+        agg["net_blocks"] += net_blocks
+        agg["peak_bytes"] += peak_bytes
+        agg["max_peak_bytes"] = max(agg["max_peak_bytes"], peak_bytes)
+        sites = self.sites.setdefault(route, Counter())
+        for d in diff:
+            frame = d.traceback[0]
+            sites[f"{frame.filename}:{frame.lineno}"] += d.size_diff
+        if len(sites) > 5 * self.top_sites:
+            self.sites[route] = Counter(dict(sites.most_common(self.top_sites)))
+        if self.budget_bytes is not None and peak_bytes > self.budget_bytes:
+            agg["over_budget"] += 1
+            top = [f"{d.traceback[0].filename}:{d.traceback[0].lineno} +{d.size_diff}B" for d in diff[:5]]
+            event = {"route": route, "peak_bytes": peak_bytes, "net_bytes": net_bytes, "at": datetime.utcnow().isoformat(), "top_sites": top}
+            self.over_budget.append(event)
+            alloc_log.warning("%s peaked at %d bytes (budget %d, net %+d); top sites: %s",
+                              route, peak_bytes, self.budget_bytes, net_bytes, "; ".join(top))
+
+    def info(self) -> PyDict[str, PyAny]:
+        routes = {}
+        for route, agg in self.routes.items():
+            n = agg["requests"]
+            routes[route] = {
+                "requests": n,
+                "avg_net_bytes": agg["net_bytes"] // n,
+                "avg_net_blocks": agg["net_blocks"] // n,
+                "avg_peak_bytes": agg["peak_bytes"] // n,
+                "max_peak_bytes": agg["max_peak_bytes"],
+                "over_budget": agg["over_budget"],
+                "top_sites": [{"site": site, "net_bytes": size} for site, size in self.sites[route].most_common(self.top_sites)],
+            }
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "budget_bytes": self.budget_bytes,
+            "stats": self.stats,
+            "routes": routes,
+            "over_budget": list(self.over_budget),
+        }
+
+
+_alloc_budget_mb = _env_float("ALLOC_BUDGET_MB", None)
+alloc_tracker = AllocationTracker(
+    sample_rate=_env_float("ALLOC_TRACK_SAMPLE", 0.1),
+    budget_bytes=int(_alloc_budget_mb * 1024 * 1024) if _alloc_budget_mb is not None else None,
+    enabled=os.getenv("ALLOC_TRACKING", "0") == "1",
+)
+
+
+# ---------------------------
+# Admission control & load shedding
+# ---------------------------
+
+class RouteLimiter:
+    """
+    At most `max_concurrent` requests in flight, at most `max_queue` waiting
+    for a slot, and nobody waits longer than `queue_timeout` seconds.
+    """
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self) -> bool:
+        with self._lock:
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                return False
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            # otherwise a slot was already handed over; _grant passes it on
+            return False
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    # hand the slot straight to the next waiter (active stays the same)
+                    waiter.get_loop().call_soon_threadsafe(self._grant, waiter)
+                    return
+            self.active -= 1
+
+    def _grant(self, waiter):
+        if waiter.done():
+            self.release()
+        else:
+            waiter.set_result(True)
+
+
+class TokenBuckets:
+    """Per-client token buckets: `rate` tokens/second, up to `burst` saved."""
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # client -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def take(self, client: str) -> float:
+        """0 if the request may proceed, else seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+# Only expensive reads are limited; cheap endpoints and checkout are never shed.
+ADMISSION_POLICIES = {
+    "GET /search": {"max_concurrent": 16, "max_queue": 32, "rate": 5.0, "burst": 20},
+    "GET /search/clusters": {"max_concurrent": 16, "max_queue": 32, "rate": 5.0, "burst": 20},
+    "GET /products": {"max_concurrent": 16, "max_queue": 32, "rate": 5.0, "burst": 20},
+    "GET /chat/{user_id}": {"max_concurrent": 32, "max_queue": 64, "rate": 2.0, "burst": 10},
+}
+
+
+class AdmissionController:
+    def __init__(self, policies: PyDict[str, PyDict[str, float]], queue_timeout: float = 2.0, enabled: bool = True):
+        self.enabled = enabled
+        self.limiters: PyDict[str, RouteLimiter] = {}
+        self.buckets: PyDict[str, TokenBuckets] = {}
+        for route, policy in policies.items():
+            self.set_policy(route, queue_timeout=queue_timeout, **policy)
+        self.stats = {"rejected_busy": 0, "rejected_rate": 0}
+
+    def set_policy(self, route: str, max_concurrent: int, max_queue: int, rate: float, burst: float, queue_timeout: float = 2.0):
+        self.limiters[route] = RouteLimiter(max_concurrent, max_queue, queue_timeout)
+        self.buckets[route] = TokenBuckets(rate, burst)
+
+    def remove_policy(self, route: str):
+        self.limiters.pop(route, None)
+        self.buckets.pop(route, None)
+
+    async def admit(self, route: Optional[str], client: str):
+        """
+        Apply `route`'s policy to one request from `client`. Returns (limiter,
+        None) once admitted, and the caller releases the limiter when done (it
+        is None for unlimited routes); or (None, the 429/503 response).
+        """
+        limiter = self.limiters.get(route)
+        if not self.enabled or limiter is None:
+            return None, None
+        retry_after = self.buckets[route].take(client)
+        if retry_after:
+            self.stats["rejected_rate"] += 1
+            return None, JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"},
+                                      headers={"Retry-After": str(ceil(retry_after))})
+        if not await limiter.acquire():
+            self.stats["rejected_busy"] += 1
+            return None, JSONResponse(status_code=503, content={"detail": "Server busy, retry shortly"},
+                                      headers={"Retry-After": "1"})
+        return limiter, None
+
+
+admission = AdmissionController(
+    ADMISSION_POLICIES,
+    queue_timeout=_env_float("ADMISSION_QUEUE_TIMEOUT", 2.0),
+    enabled=os.getenv("ADMISSION_CONTROL", "1") != "0",
+)
+
+
+@app.middleware("http")
+async def track_allocations(request: Request, call_next):
+    if not alloc_tracker.should_track():
+        return await call_next(request)
+    # snapshots and their diff take a while on a big heap; keep them off the event loop
+    started = await run_in_threadpool(alloc_tracker.begin)
+    if started is None:
+        return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        await run_in_threadpool(alloc_tracker.end, current_route.get() or request.url.path, started)
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    limiter, rejected = await admission.admit(current_route.get(), request.client.host if request.client else "unknown")
+    if rejected is not None:
+        return rejected
+    if limiter is None:
+        return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        limiter.release()
+
+
+# registered after admission_control and track_allocations so it runs first and the route is known there
+@app.middleware("http")
+async def tag_route(request: Request, call_next):
+    token = current_route.set(route_label(request.scope))
+    try:
+        return await call_next(request)
+    finally:
+        current_route.reset(token)
+
+
+# ---------------------------
+# Response compression
+# ---------------------------
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+# GET routes whose bodies only change with the catalog, so compressed bytes can be reused
+COMPRESSION_CACHE_ROUTES = {"GET /products", "GET /products/browse", "GET /products/facets", "GET /search/clusters"}
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Best of br/gzip the client accepts (q > 0), preferring br on ties; None for identity."""
+    q: PyDict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        q[name.strip().lower()] = weight
+    offers = [("br", 2)] if brotli is not None else []
+    offers.append(("gzip", 1))
+    best = max(offers, key=lambda offer: (q.get(offer[0], q.get("*", 0.0)), offer[1]))[0]
+    return best if q.get(best, q.get("*", 0.0)) > 0 else None
+
+
+def _compress(body: bytes, encoding: str, level: int) -> tuple:
+    """(compressed bytes, CPU seconds spent)."""
+    started = time.thread_time()
+    if encoding == "br":
+        data = brotli.compress(body, quality=level)
+    else:
+        data = gzip.compress(body, compresslevel=level, mtime=0)
+    return data, time.thread_time() - started
+
+
+class ResponseCompressor:
+    """
+    gzip/brotli for compressible bodies of at least `minimum_size` bytes.
+    Responses of COMPRESSION_CACHE_ROUTES are compressed once at a higher
+    level and kept (LRU, up to `cache_bytes`) under the catalog version the
+    endpoint reports in X-Change-Token, or a digest of the body if it has
+    none, so repeat hits send stored bytes. Large bodies are compressed off
+    the event loop.
+    """
+    LEVELS = {"gzip": 6, "br": 5}
+    CACHED_LEVELS = {"gzip": 9, "br": 9}
+    OFFLOAD_BYTES = 256 * 1024
+
+    def __init__(self, minimum_size: int = 1024, cache_bytes: int = 32 * 1024 * 1024):
+        self.minimum_size = minimum_size
+        self.cache_bytes = cache_bytes
+        self.stats = {"compressed": 0, "skipped_small": 0, "cache_hits": 0, "cache_misses": 0,
+                      "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._cached_size = 0
+
+    async def encode(self, scope, encoding: str, status: int, headers: MutableHeaders, body: bytes) -> Optional[bytes]:
+        """Compressed body, or None to send `body` as is."""
+        if len(body) < self.minimum_size:
+            self.stats["skipped_small"] += 1
+            return None
+        key = None
+        if status == 200 and route_label(scope) in COMPRESSION_CACHE_ROUTES:
+            version = headers.get("x-change-token") or hashlib.blake2b(body, digest_size=16).hexdigest()
+            key = (scope["path"], scope.get("query_string", b""), encoding, version)
+        data = self._cache.get(key) if key else None
+        if data is not None:
+            self._cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+        else:
+            level = (self.CACHED_LEVELS if key else self.LEVELS)[encoding]
+            if len(body) >= self.OFFLOAD_BYTES:
+                data, cpu = await run_in_threadpool(_compress, body, encoding, level)
+            else:
+                data, cpu = _compress(body, encoding, level)
+            self.stats["cpu_seconds"] += cpu
+            if key:
+                self.stats["cache_misses"] += 1
+                self._store(key, data)
+        self.stats["compressed"] += 1
+        self.stats["bytes_in"] += len(body)
+        self.stats["bytes_out"] += len(data)
+        return data
+
+    def _store(self, key: tuple, data: bytes):
+        if len(data) > self.cache_bytes:
+            return
+        self._cache[key] = data
+        self._cached_size += len(data)
+        while self._cached_size > self.cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_size -= len(evicted)
+
+    def info(self) -> PyDict[str, PyAny]:
+        stats = dict(self.stats)
+        stats["ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 4) if stats["bytes_in"] else None
+        stats["cached_entries"] = len(self._cache)
+        stats["cached_bytes"] = self._cached_size
+        stats["encodings"] = ["br", "gzip"] if brotli is not None else ["gzip"]
+        return stats
+
+
+class CompressionMiddleware:
+    """ASGI wrapper: buffers compressible responses and hands them to the compressor."""
+    def __init__(self, app, compressor: ResponseCompressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        start: PyDict[str, PyAny] = {}
+        chunks: PyList[bytes] = []
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if ("content-encoding" in headers or message["status"] in (204, 304)
+                        or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start.update(message)
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            data = await self.compressor.encode(scope, encoding, start["status"], headers, body)
+            if data is not None:
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(data))
+                body = data
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+compressor = ResponseCompressor(
+    minimum_size=int(os.getenv("COMPRESS_MIN_BYTES", "1024")),
+    cache_bytes=int(os.getenv("COMPRESS_CACHE_MB", "32")) * 1024 * 1024,
+)
+app.add_middleware(CompressionMiddleware, compressor=compressor)
+
+
+# Add CORS middleware (added last so it wraps everything, including 429/503 responses)
+# Credentialed requests (the read-your-writes cookie) can't use "*"; without CORS_ORIGINS any
+# origin is still allowed, but echoed back so the browser accepts the credentials
+cors_origins = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "").split(",") if origin.strip()]
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=cors_origins,
+    allow_origin_regex=None if cors_origins else ".*",
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "X-Change-Token", "Retry-After"],
+)
+
+
+class DatabaseRouter:
+    """
+    Picks the session for a request: GET/HEAD go to a random read replica,
+    everything else to the primary. After a write the client is pinned to the
+    primary for `sticky_seconds` (via a cookie, so it holds across workers) so
+    it reads its own writes despite replication lag.
+    """
+    STICKY_COOKIE = "rw_primary_until"
+    READ_METHODS = ("GET", "HEAD")
+
+    def __init__(self, primary_factory, replica_urls: PyList[str], sticky_seconds: float = 5.0):
+        self.primary_factory = primary_factory
+        self.sticky_seconds = sticky_seconds
+        self.replica_factories = []
+        for url in replica_urls:
+            self.add_replica(url)
+
+    def add_replica(self, url: str):
+        replica_engine = create_engine(url, echo=False)
+        slow_query_log.install(replica_engine)
+        factory = sessionmaker(bind=replica_engine, autocommit=False, autoflush=False)
+        self.replica_factories.append(factory)
+        return factory
+
+    def _pinned_to_primary(self, request: Request) -> bool:
+        try:
+            return float(request.cookies.get(self.STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def read_session(self, request: Request) -> Session:
+        if self.replica_factories and not self._pinned_to_primary(request):
+            return random.choice(self.replica_factories)()
+        return self.primary_factory()
+
+    def session_for(self, request: Request, response: Response) -> Session:
+        if not self.replica_factories:
+            return self.primary_factory()
+        if request.method in self.READ_METHODS:
+            return self.read_session(request)
+        elif request.method != "OPTIONS":
+            response.set_cookie(self.STICKY_COOKIE, str(time.time() + self.sticky_seconds),
+                                max_age=ceil(self.sticky_seconds), httponly=True, samesite="lax")
+        return self.primary_factory()
+
+
+replica_urls = os.getenv("DEV_DB_REPLICA_URLS" if dev else "DB_REPLICA_URLS", "")
+db_router = DatabaseRouter(
+    SessionLocal,
+    [url.strip() for url in replica_urls.split(",") if url.strip()],
+    sticky_seconds=_env_float("READ_YOUR_WRITES_SECONDS", 5.0),
+)
+
+
+# set by POST /batch so every operation in the batch shares one session
+batch_session: ContextVar[Optional[Session]] = ContextVar("batch_session", default=None)
+
+
+def get_db(request: Request, response: Response):
+    shared = batch_session.get()
+    if shared is not None:
+        yield shared
+        return
+    db = db_router.session_for(request, response)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin routes need ADMIN_TOKEN configured and sent back as X-Admin-Token."""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN not set)")
+    if x_admin_token != admin_token:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+# ---------------------------
+# User routes
+# ---------------------------
+
+@app.post("/register", response_model=UserOut)
+def register(user_in: UserCreate, db: Session = Depends(get_db)):
+    if user_in.role not in ("buyer", "seller"):
+        raise HTTPException(status_code=400, detail="role must be 'buyer' or 'seller'")
+    existing = db.query(UserORM).filter(UserORM.email == user_in.email).first()
+    if existing:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    u = UserORM(
+        name=user_in.name,
+        email=user_in.email,
+        role=user_in.role,
+        phone=user_in.phone,
+        location=user_in.location,
+        profile_pic=user_in.profile_pic,
+        lat=user_in.lat,
+        lon=user_in.lon
+    )
+    db.add(u)
+    db.commit()
+    db.refresh(u)
+    # create OOP wrapper (for teacher/demo)
+    oop_user = orm_user_to_oop(u)
+    return u
+
+
+@app.post("/login", response_model=UserOut)
+def login(req: LoginRequest, db: Session = Depends(get_db)):
+    if not req.name and not req.email:
+        raise HTTPException(status_code=400, detail="Provide name or email to login")
+    q = db.query(UserORM)
+    user = None
+    if req.email:
+        user = q.filter(UserORM.email == req.email).first()
+    else:
+        user = q.filter(UserORM.name == req.name).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found (mock login failed)")
+    # Return ORM row; caller may convert to OOP class if needed
+    return user
+
+
+@app.get("/users", response_model=List[UserOut])
+def list_users(db: Session = Depends(get_db)):
+    return db.query(UserORM).all()
+
+
+# ---------------------------
+# Product routes
+# ---------------------------
+
+@app.get("/products", response_model=List[ProductOut])
+def list_products(response: Response, db: Session = Depends(get_db)):
+    # token taken first, so a write racing the listing is replayed rather than missed
+    response.headers["X-Change-Token"] = encode_change_token(current_change_seq(db))
+    return db.query(ProductORM).all()
+
+
+@app.get("/products/facets", response_model=FacetsOut)
+def get_product_facets(category: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None,
+                       radius: Optional[float] = Query(None, gt=0), db: Session = Depends(get_db)):
+    """Per-category counts and a price histogram from the facet table, optionally within `radius` km."""
+    if radius is not None and (lat is None or lon is None):
+        raise HTTPException(status_code=400, detail="radius needs lat and lon")
+    return product_facets(db, category=category, lat=lat, lon=lon, radius_km=radius)
+
+
+@app.get("/products/changes", response_model=ProductChangesOut)
+def product_changes(since: Optional[str] = Query(None, description="token from /products or a previous call"),
+                    limit: int = Query(500, ge=1, le=5000), db: Session = Depends(get_db)):
+    """
+    Upserts and tombstones after `since`, plus the token to send next time.
+    Without `since` only the current token is returned; pair it with a full
+    /products load. Keep calling while has_more is true.
+    """
+    if since is None:
+        return {"changes": [], "token": encode_change_token(current_change_seq(db)), "has_more": False}
+    return product_changes_since(db, decode_change_token(since), limit)
+
+
+@app.get("/products/browse", response_model=ProductPage)
+def browse_products(category: Optional[str] = None, seller_id: Optional[int] = None,
+                    min_price: Optional[float] = Query(None, ge=0, allow_inf_nan=False),
+                    max_price: Optional[float] = Query(None, ge=0, allow_inf_nan=False),
+                    q: Optional[str] = Query(None, description="case-insensitive name substring"),
+                    lat: Optional[float] = None, lon: Optional[float] = None, radius: Optional[float] = Query(None, gt=0),
+                    sort: str = Query("newest", pattern="^(newest|price|-price|distance)$"),
+                    offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=100),
+                    db: Session = Depends(get_db)):
+    """Combined filters and sorting over the columnar catalog; one PK lookup for the page."""
+    if sort == "distance" and (lat is None or lon is None):
+        raise HTTPException(status_code=400, detail="sort=distance needs lat and lon")
+    catalog.ensure_fresh(db)
+    total, page = catalog.query(
+        category=category, seller_id=seller_id,
+        min_price_cents=to_cents(min_price) if min_price is not None else None,
+        max_price_cents=to_cents(max_price) if max_price is not None else None,
+        q=q, lat=lat, lon=lon, radius_km=radius, sort=sort, offset=offset, limit=limit,
+    )
+    ids = [product_id for product_id, _ in page]
+    rows = {p.id: p for p in db.query(ProductORM).filter(ProductORM.id.in_(ids))} if ids else {}
+    return {"total": total, "items": [rows[i] for i in ids if i in rows]}
+
+
+@app.get("/products/{product_id}/similar", response_model=List[SimilarProductOut])
+def similar_products(product_id: int, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    rows = (
+        db.query(ProductORM, ProductSimilarORM.score)
+        .join(ProductSimilarORM, ProductSimilarORM.similar_id == ProductORM.id)
+        .filter(ProductSimilarORM.product_id == product_id)
+        .order_by(ProductSimilarORM.rank)
+        .limit(limit)
+        .all()
+    )
+    if not rows and db.get(ProductORM, product_id) is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return [{**product_out_dict(p), "score": score} for p, score in rows]
+
+
+@app.get("/products/trending", response_model=List[TrendingProductOut])
+def trending_products(lat: Optional[float] = None, lon: Optional[float] = None, radius: Optional[float] = Query(None, gt=0),
+                      limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    """Most ordered products over the trending window, optionally within `radius` km; read from memory, then one PK lookup."""
+    if radius is not None and (lat is None or lon is None):
+        raise HTTPException(status_code=400, detail="radius needs lat and lon")
+    top = trending.top(limit, lat=lat, lon=lon, radius_km=radius)
+    ids = [product_id for product_id, _ in top]
+    rows = {p.id: p for p in db.query(ProductORM).filter(ProductORM.id.in_(ids))} if ids else {}
+    return [{**product_out_dict(rows[i]), "orders": n} for i, n in top if i in rows]
+
+
+@app.post("/products", response_model=ProductOut)
+def add_product(p_in: ProductCreate, db: Session = Depends(get_db)):
+    seller = db.query(UserORM).filter(UserORM.id == p_in.seller_id).first()
+    if not seller:
+        raise HTTPException(status_code=404, detail="Seller not found")
+    if seller.role != "seller":
+        raise HTTPException(status_code=403, detail="Only users with role 'seller' can add products")
+    if p_in.price_cents is None and p_in.price is None:
+        raise HTTPException(status_code=400, detail="Provide price or price_cents")
+    p = ProductORM(
+        name=p_in.name,
+        description=p_in.description,
+        price_cents=p_in.price_cents if p_in.price_cents is not None else to_cents(p_in.price),
+        category=p_in.category,
+        image_url=p_in.image_url,
         seller_id=p_in.seller_id,
         lat=p_in.lat,
         lon=p_in.lon
     )
     db.add(p)
+    db.flush()
+    on_product_write(db, None, product_state(p))
     db.commit()
     db.refresh(p)
     # Optionally instantiate OOP Product for diagram fidelity:
@@ -676,9 +4369,18 @@ def update_product(product_id: int, p_in: ProductUpdate, db: Session = Depends(g
     p = db.query(ProductORM).filter(ProductORM.id == product_id).first()
     if not p:
         raise HTTPException(status_code=404, detail="Product not found")
-    for field, value in p_in.dict(exclude_unset=True).items():
+    before = product_state(p)
+    updates = p_in.dict(exclude_unset=True)
+    if "price" in updates:
+        price = updates.pop("price")
+        if price is not None and updates.get("price_cents") is None:
+            updates["price_cents"] = to_cents(price)
+    if updates.get("price_cents", 0) is None:
+        raise HTTPException(status_code=400, detail="price_cents cannot be null")
+    for field, value in updates.items():
         setattr(p, field, value)
     db.add(p)
+    on_product_write(db, before, product_state(p))
     db.commit()
     db.refresh(p)
     return p
@@ -689,25 +4391,119 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
     p = db.query(ProductORM).filter(ProductORM.id == product_id).first()
     if not p:
         raise HTTPException(status_code=404, detail="Product not found")
+    before = product_state(p)
     db.delete(p)
+    on_product_write(db, before, None)
     db.commit()
     return {"detail": "Product deleted"}
 
 
-@app.get("/search", response_model=List[ProductOut])
-def search_products(lat: float = Query(...), lon: float = Query(...), radius: float = Query(5.0), db: Session = Depends(get_db)):
-    products = db.query(ProductORM).filter(ProductORM.lat != None, ProductORM.lon != None).all()
+@app.get("/search", response_model=List[ProductNearOut])
+def search_products(response: Response, lat: float = Query(...), lon: float = Query(...),
+                    radius: Optional[float] = Query(None, description="km; defaults to 5 without k"),
+                    k: Optional[int] = Query(None, ge=1, le=200, description="return the k nearest products"),
+                    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous k page"),
+                    db: Session = Depends(get_db)):
+    if k is not None:
+        after = decode_knn_cursor(cursor) if cursor else None
+        hits, exhausted = nearest_products(db, float(lat), float(lon), k, after=after, max_radius=radius)
+        if hits and not exhausted:
+            response.headers["X-Next-Cursor"] = encode_knn_cursor(hits[-1][0], hits[-1][1].id)
+        return [dict(product_out_dict(p), distance_km=d) for d, p in hits]
+
+    radius = 5.0 if radius is None else float(radius)
     nearby = []
-    for p in products:
-        # p.lat and p.lon may be Decimal/float; convert safely
-        if p.lat is None or p.lon is None:
-            continue
-        d = distance_km(float(lat), float(lon), float(p.lat), float(p.lon))
-        if d <= float(radius):
-            nearby.append(p)
+    for p in search_cache.candidates(db, float(lat), float(lon), radius):
+        d = distance_km(float(lat), float(lon), p["lat"], p["lon"])
+        if d <= radius:
+            nearby.append(dict(p, distance_km=d))
     return nearby
 
 
+@app.get("/search/clusters", response_model=List[ClusterOut])
+def search_clusters(lat: float = Query(...), lon: float = Query(...), radius: float = Query(5.0),
+                    precision: int = Query(10, ge=CLUSTER_PRECISIONS.start, le=CLUSTER_PRECISIONS.stop - 1),
+                    db: Session = Depends(get_db)):
+    """Products within `radius` km aggregated into grid cells; reads only the cell table."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius)
+    min_x, min_y = cell_index(min_lat, min_lon, precision)
+    max_x, max_y = cell_index(max_lat, max_lon, precision)
+    cells = db.query(ProductCellORM).filter(
+        ProductCellORM.precision == precision,
+        ProductCellORM.cell_x.between(min_x, max_x),
+        ProductCellORM.cell_y.between(min_y, max_y),
+    ).all()
+    clusters = []
+    for c in cells:
+        c_lat, c_lon = c.sum_lat / c.count, c.sum_lon / c.count
+        if distance_km(lat, lon, c_lat, c_lon) <= radius:
+            clusters.append((c, c_lat, c_lon))
+    rep_ids = [c.rep_product_id for c, _, _ in clusters if c.rep_product_id is not None]
+    reps = {p.id: p for p in db.query(ProductORM).filter(ProductORM.id.in_(rep_ids))} if rep_ids else {}
+    return [
+        {
+            "cell": f"{precision}:{c.cell_x}:{c.cell_y}",
+            "precision": precision,
+            "count": c.count,
+            "lat": c_lat,
+            "lon": c_lon,
+            "representative": reps.get(c.rep_product_id),
+        }
+        for c, c_lat, c_lon in clusters
+    ]
+
+
+# ---------------------------
+# Image routes
+# ---------------------------
+
+@app.post("/images", response_model=ImageOut)
+async def upload_image(request: Request):
+    """
+    Raw image bytes in the body (Content-Type image/jpeg, png, webp or gif).
+    Set the returned url as a product's image_url to get its thumbnails.
+    """
+    ext = IMAGE_TYPES.get(request.headers.get("content-type", "").split(";")[0].strip().lower())
+    if ext is None:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(IMAGE_TYPES)}")
+    digest = await image_store.save(request.stream(), ext)
+    url = f"{str(request.base_url).rstrip('/')}/images/{digest}.{ext}"
+    return {"digest": digest, "url": url, "thumbnails": thumbnail_urls(url)}
+
+
+def _immutable_file(request: Request, path: str, digest: str, media_type: str):
+    etag = f'"{digest}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+    return FileResponse(path, media_type=media_type, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+
+
+@app.get("/images/thumbs/{size}/{digest}.jpg")
+def get_thumbnail(size: int, digest: str, request: Request):
+    if size not in THUMBNAIL_SIZES or not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    try:
+        path = image_store.thumbnail(digest, size)
+    except FutureTimeout:
+        raise HTTPException(status_code=503, detail="Thumbnail is still being generated", headers={"Retry-After": "1"})
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    except Exception:
+        # originals stored before uploads were verified may not decode
+        raise HTTPException(status_code=415, detail="Original image can't be decoded")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return _immutable_file(request, path, f"{digest}-{size}", "image/jpeg")
+
+
+@app.get("/images/{digest}.{ext}")
+def get_image(digest: str, ext: str, request: Request):
+    path = image_store.original_path(digest, ext) if re.fullmatch(r"[0-9a-f]{64}", digest) and ext in IMAGE_MEDIA_TYPES else None
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return _immutable_file(request, path, digest, IMAGE_MEDIA_TYPES[ext])
+
+
 # ---------------------------
 # Orders, Transactions, Payment
 # ---------------------------
@@ -730,6 +4526,9 @@ def place_order(order_in: OrderCreate, db: Session = Depends(get_db)):
         order_date=datetime.utcnow()
     )
     db.add(o)
+    db.flush()
+    sync_order_view(db, o, product=product, buyer=buyer)
+    after_commit(db, partial(trending.record, product.id, product.lat, product.lon))
     db.commit()
     db.refresh(o)
     # buyer_oop = orm_user_to_oop(buyer)
@@ -737,6 +4536,24 @@ def place_order(order_in: OrderCreate, db: Session = Depends(get_db)):
     return o
 
 
+@app.post("/orders/status", response_model=OrderStatusBulkOut)
+def bulk_order_status(body: OrderStatusBulk, db: Session = Depends(get_db)):
+    """Move many of a seller's orders to one status along ORDER_TRANSITIONS; per-order results."""
+    if body.status not in ORDER_TRANSITIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown order status: {body.status}")
+    order_ids = list(dict.fromkeys(body.order_ids))
+    if len(order_ids) > BULK_STATUS_MAX_ORDERS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_STATUS_MAX_ORDERS} orders per request")
+    seller = db.get(UserORM, body.seller_id)
+    if not seller:
+        raise HTTPException(status_code=404, detail="Seller not found")
+    if seller.role != "seller":
+        raise HTTPException(status_code=403, detail="Only sellers can update order status")
+    results = transition_orders(db, body.seller_id, order_ids, body.status)
+    db.commit()
+    return {"updated": sum(1 for r in results if r["ok"] and r["detail"] is None), "results": results}
+
+
 @app.post("/transactions", response_model=TransactionOut)
 def create_transaction(tx_in: TransactionCreate, db: Session = Depends(get_db)):
     order = db.query(OrderORM).filter(OrderORM.id == tx_in.order_id).first()
@@ -747,18 +4564,36 @@ def create_transaction(tx_in: TransactionCreate, db: Session = Depends(get_db)):
     product = db.query(ProductORM).filter(ProductORM.id == order.product_id).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    amount = float(product.price) * int(order.quantity)
-    tx = TransactionORM(order_id=order.id, amount=amount, status="pending", date=datetime.utcnow())
+    amount_cents = product.price_cents * int(order.quantity)
+    tx = TransactionORM(order_id=order.id, amount_cents=amount_cents, status="pending", date=datetime.utcnow())
     order.status = "processing"
     db.add(tx)
     db.add(order)
+    db.flush()
+    sync_order_view(db, order, tx=tx, product=product)
     db.commit()
     db.refresh(tx)
     return tx
 
 
-@app.post("/payment/process")
-def process_payment(transaction_id: int = Query(...), db: Session = Depends(get_db)):
+def _payment_amount(db: Session, transaction_id: int) -> int:
+    """Read what the provider needs, then end the transaction so no connection is held during the call."""
+    tx = db.query(TransactionORM).filter(TransactionORM.id == transaction_id).first()
+    if not tx:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    amount_cents = tx.amount_cents
+    db.rollback()
+    return amount_cents
+
+
+async def call_gateway(method: str, transaction_id: int, amount_cents: int):
+    try:
+        return await payments.call(method, transaction_id, amount_cents)
+    except GatewayUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": str(ceil(exc.retry_after))})
+
+
+def _mark_processing(db: Session, transaction_id: int):
     tx = db.query(TransactionORM).filter(TransactionORM.id == transaction_id).first()
     if not tx:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -767,61 +4602,207 @@ def process_payment(transaction_id: int = Query(...), db: Session = Depends(get_
     if tx.order:
         tx.order.status = "processing"
         db.add(tx.order)
+        sync_order_view(db, tx.order, tx=tx)
     db.add(tx)
     db.commit()
     db.refresh(tx)
     return {"detail": "Payment processing started", "transaction_id": tx.id, "status": tx.status}
 
 
-@app.post("/payment/verify")
-def verify_payment(transaction_id: int = Query(...), db: Session = Depends(get_db)):
+@app.post("/payment/process")
+async def process_payment(transaction_id: int = Query(...), db: Session = Depends(get_db)):
+    amount_cents = await run_in_threadpool(_payment_amount, db, transaction_id)
+    await call_gateway("submit", transaction_id, amount_cents)
+    return await run_in_threadpool(_mark_processing, db, transaction_id)
+
+
+def _apply_verification(db: Session, transaction_id: int, approved: bool):
     tx = db.query(TransactionORM).filter(TransactionORM.id == transaction_id).first()
     if not tx:
         raise HTTPException(status_code=404, detail="Transaction not found")
-    # 70% chance of success, 30% chance of failure
-    approved = random.choices([True, False], weights=[70, 30])[0]
-    if approved:
-        tx.status = "approved"
-        if tx.order:
-            tx.order.status = "completed"
-            tx.order.completion_date = datetime.utcnow()
-    else:
-        tx.status = "denied"
-        if tx.order:
-            tx.order.status = "cancelled"
-            tx.order.completion_date = None
+    old_status, old_day = tx.status, tx.date.date() if tx.date else None
+    order_status = "completed" if approved else "cancelled"
+    if tx.order:
+        # lock and re-read the order so a bulk status change can't land between this check and the commit
+        db.query(OrderORM).filter(OrderORM.id == tx.order_id).populate_existing().with_for_update().one()
+        if tx.order.status != order_status and order_status not in ORDER_TRANSITIONS[tx.order.status]:
+            raise HTTPException(status_code=409, detail=f"Cannot move a {tx.order.status} order to {order_status}")
+    tx.status = "approved" if approved else "denied"
+    if tx.order:
+        tx.order.status = order_status
+        tx.order.completion_date = datetime.utcnow() if approved else None
     tx.date = datetime.utcnow()
     db.add(tx)
     if tx.order:
         db.add(tx.order)
+        record_sale_outcome(db, tx, tx.order, tx.order.product.seller_id, old_status, old_day)
+        sync_order_view(db, tx.order, tx=tx)
     db.commit()
     db.refresh(tx)
     return {"transaction_id": tx.id, "approved": approved, "tx_status": tx.status, "order_status": tx.order.status if tx.order else None}
 
 
+@app.post("/payment/verify")
+async def verify_payment(transaction_id: int = Query(...), db: Session = Depends(get_db)):
+    amount_cents = await run_in_threadpool(_payment_amount, db, transaction_id)
+    approved = await call_gateway("verify", transaction_id, amount_cents)
+    return await run_in_threadpool(_apply_verification, db, transaction_id, approved)
+
+
+@app.get("/orders/history", response_model=List[OrderViewOut])
+def order_history(response: Response, buyer_id: Optional[int] = None, seller_id: Optional[int] = None,
+                  before_id: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
+                  limit: int = Query(50, ge=1, le=200), db: Session = Depends(get_db)):
+    """Newest-first order history from the read model: one indexed range scan per page."""
+    query = db.query(OrderViewORM)
+    if buyer_id is not None:
+        query = query.filter(OrderViewORM.buyer_id == buyer_id)
+    if seller_id is not None:
+        query = query.filter(OrderViewORM.seller_id == seller_id)
+    if before_id is not None:
+        query = query.filter(OrderViewORM.id < before_id)
+    rows = query.order_by(OrderViewORM.id.desc()).limit(limit).all()
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return rows
+
+
+@app.get("/sellers/{seller_id}/stats", response_model=SellerStatsOut)
+def seller_stats(seller_id: int, days: int = Query(30, ge=1, le=366), db: Session = Depends(get_db)):
+    """Revenue and order counts for the last `days` days, read from the rollup tables only."""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    daily = db.query(SellerDailySalesORM).filter(
+        SellerDailySalesORM.seller_id == seller_id, SellerDailySalesORM.day >= since
+    ).order_by(SellerDailySalesORM.day).all()
+    products = db.query(
+        ProductDailySalesORM.product_id,
+        *[func.sum(getattr(ProductDailySalesORM, c)).label(c) for c in ROLLUP_COUNTERS],
+    ).filter(
+        ProductDailySalesORM.seller_id == seller_id, ProductDailySalesORM.day >= since
+    ).group_by(ProductDailySalesORM.product_id).order_by(ProductDailySalesORM.product_id).all()
+    return {
+        "seller_id": seller_id,
+        "since": since,
+        "totals": {c: sum(getattr(d, c) for d in daily) for c in ROLLUP_COUNTERS},
+        "daily": daily,
+        "products": [row._asdict() for row in products],
+    }
+
+
 # ---------------------------
 # Chat endpoints
 # ---------------------------
 
 @app.post("/chat/send", response_model=ChatOut)
 def send_message(msg: ChatSend, db: Session = Depends(get_db)):
-    sender = db.query(UserORM).filter(UserORM.id == msg.sender_id).first()
-    receiver = db.query(UserORM).filter(UserORM.id == msg.receiver_id).first()
-    if not sender or not receiver:
+    if known_users.missing(db, {msg.sender_id, msg.receiver_id}):
         raise HTTPException(status_code=404, detail="Sender or receiver not found")
-    c = ChatMessageORM(sender_id=msg.sender_id, receiver_id=msg.receiver_id, message=msg.message, timestamp=datetime.utcnow())
-    db.add(c)
-    db.commit()
-    db.refresh(c)
-    return c
+    return chat_writer.submit(msg.sender_id, msg.receiver_id, msg.message)
 
 
 @app.get("/chat/{user_id}", response_model=List[ChatOut])
-def get_messages(user_id: int, db: Session = Depends(get_db)):
-    msgs = db.query(ChatMessageORM).filter(
+def get_messages(user_id: int, since_id: Optional[int] = Query(None, description="poll: only messages after this id"),
+                 before_id: Optional[int] = Query(None, description="page back: messages before this id, archive included"),
+                 limit: int = Query(100, ge=1, le=500), db: Session = Depends(get_db)):
+    """
+    Without `before_id` only the hot tier is read: the whole recent window, or
+    just what arrived after `since_id`. Paging back with `before_id` returns up
+    to `limit` older messages and falls through to the archive when the hot
+    tier runs out. Always oldest first.
+    """
+    hot = db.query(ChatMessageORM).filter(
         (ChatMessageORM.sender_id == user_id) | (ChatMessageORM.receiver_id == user_id)
-    ).order_by(ChatMessageORM.timestamp.asc()).all()
-    return msgs
+    )
+    if before_id is None:
+        if since_id is not None:
+            hot = hot.filter(ChatMessageORM.id > since_id)
+        return hot.order_by(ChatMessageORM.id.asc()).all()
+    msgs = hot.filter(ChatMessageORM.id < before_id).order_by(ChatMessageORM.id.desc()).limit(limit).all()
+    if len(msgs) < limit:
+        older_than = msgs[-1].id if msgs else before_id
+        msgs = msgs + archived_messages(db, user_id, older_than, limit - len(msgs))
+    return list(reversed(msgs))
+
+
+# ---------------------------
+# Batched reads
+# ---------------------------
+
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "20"))
+BATCH_RESULT_HEADERS = ("x-next-cursor", "x-change-token", "retry-after")
+_BATCH_DROP_HEADERS = (b"content-length", b"content-type", b"accept-encoding")
+batch_log = logging.getLogger("thrift.batch")
+
+
+async def _run_batch_operation(request: Request, op: BatchOperation) -> PyDict[str, PyAny]:
+    """
+    Runs one GET through the router as if it had arrived on its own, so query
+    validation, dependencies and response models are exactly the route's.
+    The outer request's headers (admin token, sticky cookie) carry over, and
+    the route's admission policy is applied as for a request of its own.
+    """
+    url = urlsplit(op.path)
+    query = parse_qsl(url.query) + [(k, v) for k, value in op.params.items()
+                                    for v in (value if isinstance(value, list) else [value])]
+    scope = {k: v for k, v in request.scope.items() if k not in ("route", "endpoint", "path_params")}
+    scope.update(method="GET", path=url.path, raw_path=url.path.encode(), query_string=urlencode(query).encode(),
+                 headers=[(k, v) for k, v in request.scope["headers"] if k not in _BATCH_DROP_HEADERS])
+    if not any(route.matches(scope)[0] == Match.FULL for route in app.router.routes):
+        return {"id": op.id, "status": 404, "headers": {}, "body": {"detail": "Not Found"}}
+
+    sent = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        sent.append(message)
+
+    route = route_label(scope)
+    limiter, rejected = await admission.admit(route, request.client.host if request.client else "unknown")
+    if rejected is not None:
+        return {"id": op.id, "status": rejected.status_code, "headers": {"retry-after": rejected.headers["retry-after"]},
+                "body": json.loads(rejected.body)}
+    token = current_route.set(route)
+    try:
+        await app.router(scope, receive, send)
+    except Exception:
+        batch_log.exception("batch operation %s failed", route)
+        return {"id": op.id, "status": 500, "headers": {}, "body": {"detail": "Internal Server Error"}}
+    finally:
+        current_route.reset(token)
+        if limiter is not None:
+            limiter.release()
+    start = next(m for m in sent if m["type"] == "http.response.start")
+    headers = Headers(raw=start["headers"])
+    raw = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    body = json.loads(raw) if headers.get("content-type", "").startswith("application/json") and raw else raw.decode("utf-8", "replace")
+    return {"id": op.id, "status": start["status"], "body": body,
+            "headers": {name: headers[name] for name in BATCH_RESULT_HEADERS if name in headers}}
+
+
+@app.post("/batch", response_model=List[BatchResult])
+async def batch_read(payload: BatchRequest, request: Request):
+    """
+    Several GETs in one round trip, e.g. the chat page's messages and user list.
+    Each result carries its own status, so one failing operation doesn't fail
+    the batch. All operations share one read session (replica unless pinned to
+    the primary); a Session isn't thread-safe, so they run one after another.
+    """
+    if not payload.operations:
+        return []
+    if len(payload.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_OPERATIONS} operations per batch")
+    db = db_router.read_session(request)
+    token = batch_session.set(db)
+    try:
+        results = []
+        for op in payload.operations:
+            results.append(await _run_batch_operation(request, op))
+            if results[-1]["status"] >= 500:
+                db.rollback()  # a failed statement can leave the shared transaction unusable for the next operation
+        return results
+    finally:
+        batch_session.reset(token)
+        db.close()
 
 
 # ---------------------------
@@ -837,6 +4818,291 @@ def list_orders(db: Session = Depends(get_db)):
 def list_transactions(db: Session = Depends(get_db)):
     return db.query(TransactionORM).all()
 
-if __name__ == "__main__":
+
+# ---------------------------
+# Admin endpoints
+# ---------------------------
+
+@app.get("/admin/slow-queries", dependencies=[Depends(require_admin)])
+def list_slow_queries():
+    return {"threshold_ms": slow_query_log.threshold_ms, "entries": slow_query_log.entries()}
+
+
+@app.delete("/admin/slow-queries", dependencies=[Depends(require_admin)])
+def clear_slow_queries():
+    slow_query_log.clear()
+    return {"detail": "Slow-query log cleared"}
+
+
+@app.get("/admin/search-cache", dependencies=[Depends(require_admin)])
+def search_cache_stats():
+    return search_cache.info()
+
+
+@app.post("/admin/order-views/rebuild", dependencies=[Depends(require_admin)])
+def rebuild_order_history(db: Session = Depends(get_db)):
+    return rebuild_order_views(db)
+
+
+@app.post("/admin/rollups/rebuild", dependencies=[Depends(require_admin)])
+def rebuild_rollups(db: Session = Depends(get_db)):
+    return rebuild_sales_rollups(db)
+
+
+@app.post("/admin/similar/rebuild", dependencies=[Depends(require_admin)])
+def rebuild_similar(db: Session = Depends(get_db)):
+    return similar_index.rebuild(db)
+
+
+@app.get("/admin/similar", dependencies=[Depends(require_admin)])
+def similar_index_stats():
+    return similar_index.info()
+
+
+@app.post("/admin/chat/archive", dependencies=[Depends(require_admin)])
+def archive_chat():
+    moved = chat_archiver.run_once()
+    return {"archived": moved, "stats": chat_archiver.stats}
+
+
+@app.post("/admin/catalog/snapshot", dependencies=[Depends(require_admin)])
+def write_catalog_snapshot(db: Session = Depends(get_db)):
+    return catalog.write_snapshot(db)
+
+
+@app.get("/admin/catalog", dependencies=[Depends(require_admin)])
+def catalog_stats():
+    return catalog.info()
+
+
+@app.get("/admin/payments", dependencies=[Depends(require_admin)])
+def payment_stats():
+    return payments.info()
+
+
+@app.get("/admin/trending", dependencies=[Depends(require_admin)])
+def trending_stats():
+    return trending.info()
+
+
+@app.get("/admin/compression", dependencies=[Depends(require_admin)])
+def compression_stats():
+    return compressor.info()
+
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile_worker(seconds: float = Query(5.0, gt=0, le=60), interval_ms: float = Query(10.0, ge=1, le=1000),
+                         route: Optional[str] = Query(None, description="keep one route, e.g. 'GET /search'"),
+                         all_threads: bool = Query(False, description="include stacks not serving a request"),
+                         format: str = Query("collapsed", pattern="^(collapsed|json)$")):
+    """
+    Sample the worker that serves this request for `seconds`. Collapsed output
+    feeds flamegraph.pl / speedscope directly. Sampling runs on an executor
+    thread, so the event loop keeps serving meanwhile.
+    """
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, partial(stack_sampler.run, seconds, interval_ms / 1000.0, all_threads)
+    )
+    if result is None:
+        raise HTTPException(status_code=409, detail="A profile is already running in this worker")
+    if format == "json":
+        by_route = Counter()
+        for stack, count in result["stacks"].items():
+            by_route[stack.split(";", 1)[0]] += count
+        return {
+            "pid": os.getpid(),
+            "ticks": result["ticks"],
+            "interval_ms": interval_ms,
+            "samples_by_route": dict(by_route.most_common()),
+            "collapsed": collapsed_stacks(result["stacks"], route),
+        }
+    return PlainTextResponse(collapsed_stacks(result["stacks"], route), headers={"X-Profile-Ticks": str(result["ticks"])})
+
+
+@app.get("/admin/allocations", dependencies=[Depends(require_admin)])
+def allocation_stats():
+    return alloc_tracker.info()
+
+
+@app.post("/admin/allocations", dependencies=[Depends(require_admin)])
+def enable_allocation_tracking(sample_rate: Optional[float] = Query(None, gt=0, le=1),
+                               budget_mb: Optional[float] = Query(None, gt=0)):
+    if budget_mb is not None:
+        alloc_tracker.budget_bytes = int(budget_mb * 1024 * 1024)
+    alloc_tracker.enable(sample_rate)
+    return alloc_tracker.info()
+
+
+@app.delete("/admin/allocations", dependencies=[Depends(require_admin)])
+def disable_allocation_tracking():
+    alloc_tracker.disable()
+    alloc_tracker.reset()
+    return {"detail": "Allocation tracking disabled"}
+
+
+@app.get("/admin/admission", dependencies=[Depends(require_admin)])
+def admission_stats():
+    return {
+        "enabled": admission.enabled,
+        "stats": admission.stats,
+        "routes": {
+            route: {"active": limiter.active, "max_concurrent": limiter.max_concurrent, "max_queue": limiter.max_queue}
+            for route, limiter in admission.limiters.items()
+        },
+    }
+
+
+# ---------------------------
+# Production server (pre-fork, POSIX only)
+# ---------------------------
+
+def _rss_mb() -> float:
+    """Resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak, KB on Linux
+
+
+def _watch_memory(server, max_memory_mb: float, interval: float = 5.0):
+    while not server.should_exit:
+        if _rss_mb() > max_memory_mb:
+            print(f"[worker {os.getpid()}] RSS above {max_memory_mb}MB, restarting after in-flight requests")
+            server.should_exit = True
+            return
+        time.sleep(interval)
+
+
+def _run_worker(sock, max_requests: int, max_memory_mb: Optional[float], graceful_timeout: float):
     import uvicorn
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # connections opened by the master before fork must not be shared with it
+    engine.dispose(close=False)
+    for factory in db_router.replica_factories:
+        factory.kw["bind"].dispose(close=False)
+    config = uvicorn.Config(app, limit_max_requests=max_requests or None,
+                            timeout_graceful_shutdown=graceful_timeout, proxy_headers=True)
+    server = uvicorn.Server(config)
+    if max_memory_mb:
+        threading.Thread(target=_watch_memory, args=(server, max_memory_mb), daemon=True).start()
+    # uvicorn drains in-flight requests on SIGTERM before exiting
+    server.run(sockets=[sock])
+
+
+def serve_production(host: str = "0.0.0.0", port: int = 8000, workers: int = 0, max_requests: int = 10000,
+                     max_requests_jitter: int = 1000, max_memory_mb: Optional[float] = None,
+                     graceful_timeout: float = 30.0):
+    """
+    Pre-fork server: the app is imported once here, the listening socket is
+    bound once, and `workers` forked uvicorn processes share both. A worker is
+    replaced after ~max_requests requests (jittered so they don't all recycle
+    at once) or once its RSS passes max_memory_mb. SIGTERM/SIGINT drain the
+    workers for up to graceful_timeout seconds before they are killed.
+    """
+    if not hasattr(os, "fork"):
+        raise SystemExit("The production server needs a POSIX system (os.fork)")
+    workers = workers or os.cpu_count() or 1
+    if catalog.snapshot_path:
+        # mapped once here so every forked worker shares the same pages
+        db = SessionLocal()
+        try:
+            catalog.write_snapshot(db)
+            catalog.open_snapshot()
+        except OSError as exc:
+            print(f"Catalog snapshot skipped: {exc}", flush=True)
+        finally:
+            db.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children: PyDict[int, float] = {}  # pid -> start time
+    shutdown_deadline: PyList[float] = []
+
+    def spawn():
+        limit = max_requests + random.randint(0, max_requests_jitter) if max_requests else 0
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(sock, limit, max_memory_mb, graceful_timeout)
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        if not shutdown_deadline:
+            shutdown_deadline.append(time.monotonic() + graceful_timeout + 5)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{host}:{port} with {workers} workers (master pid {os.getpid()})", flush=True)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if shutdown_deadline and time.monotonic() > shutdown_deadline[0]:
+                for child in children:
+                    os.kill(child, signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+        started = children.pop(pid, None)
+        if not shutdown_deadline and started is not None:
+            if time.monotonic() - started < 1.0:
+                time.sleep(1.0)  # back off if workers die on startup
+            spawn()
+    sock.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the Thrift backend")
+    parser.add_argument("--prod", action="store_true", help="pre-forked multi-worker server instead of the dev reloader")
+    parser.add_argument("--backfill-rollups", action="store_true", help="rebuild the seller/product sales rollups and exit")
+    parser.add_argument("--catalog-snapshot", action="store_true", help="write the memory-mappable catalog snapshot and exit")
+    parser.add_argument("--archive-chat", action="store_true", help="move chat messages past the hot window to the archive and exit")
+    parser.add_argument("--rebuild-similar", action="store_true", help="recompute the similar-products index and exit")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")), help="default: CPU count")
+    parser.add_argument("--max-requests", type=int, default=int(os.getenv("MAX_REQUESTS", "10000")), help="0 disables recycling")
+    parser.add_argument("--max-requests-jitter", type=int, default=int(os.getenv("MAX_REQUESTS_JITTER", "1000")))
+    parser.add_argument("--max-memory-mb", type=float, default=_env_float("MAX_WORKER_MEMORY_MB", None))
+    parser.add_argument("--graceful-timeout", type=float, default=_env_float("GRACEFUL_TIMEOUT", 30.0))
+    args = parser.parse_args()
+
+    if args.backfill_rollups:
+        db = SessionLocal()
+        try:
+            print(rebuild_sales_rollups(db))
+        finally:
+            db.close()
+    elif args.catalog_snapshot:
+        db = SessionLocal()
+        try:
+            print(catalog.write_snapshot(db))
+        finally:
+            db.close()
+    elif args.archive_chat:
+        print({"archived": chat_archiver.run_once()})
+    elif args.rebuild_similar:
+        db = SessionLocal()
+        try:
+            print(similar_index.rebuild(db))
+        finally:
+            db.close()
+    elif args.prod:
+        serve_production(args.host, args.port, args.workers, args.max_requests, args.max_requests_jitter,
+                         args.max_memory_mb, args.graceful_timeout)
+    else:
+        import uvicorn
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
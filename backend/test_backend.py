@@ -1,19 +1,46 @@
 import unittest
 import sys
 import os
-from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import io
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker, Session
 from fastapi.testclient import TestClient
 
 # Add the backend directory to the path
 sys.path.insert(0, os.path.dirname(__file__))
 
+os.environ.setdefault("ADMIN_TOKEN", "test-admin-token")
+os.environ.setdefault("IMAGE_STORE_DIR", tempfile.mkdtemp(prefix="thrift-images-"))
+os.environ.setdefault("CATALOG_SNAPSHOT_PATH", os.path.join(tempfile.mkdtemp(prefix="thrift-catalog-"), "catalog.snapshot"))
+os.environ.setdefault("SIMILAR_REFRESH_DELAY", "3600")  # tests flush the similar-products index explicitly
+os.environ.setdefault("SIMILAR_POLL_INTERVAL", "3600")
+os.environ.setdefault("TRENDING_FLUSH_INTERVAL", "0")  # tests flush the trending counters explicitly
+
 from main import app, Base, UserORM, ProductORM, OrderORM, TransactionORM, ChatMessageORM
+from main import SessionLocal, slow_query_log, ProductCellORM, update_product_cells, search_cache, known_users, chat_writer, db_router
+from main import admission, RouteLimiter, migrate_money_to_cents, alloc_tracker
+from main import SellerDailySalesORM, ProductDailySalesORM, rebuild_sales_rollups, upsert_add
+from main import catalog, ProductSimilarORM, SimilarIndexStateORM, SimilarityIndex, similar_index
+from main import ChatArchiveChunkORM, chat_archiver, ProductChangeORM, next_change_seq
+from main import ProductFacetORM, rebuild_product_facets, update_product_facets, OrderViewORM, rebuild_order_views
+from main import price_bucket, PRICE_BUCKET_EDGES_CENTS
+from main import compressor, negotiate_encoding
+from main import trending, TrendingBucketORM, image_store
+from main import payments, PaymentClient, SimulatedGateway, CircuitBreaker, GatewayUnavailable
+import numpy as np
+from unittest import mock
+from PIL import Image
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
 
+ADMIN_HEADERS = {"X-Admin-Token": os.environ["ADMIN_TOKEN"]}
+
 # Use DEV_DB_URL for testing
 DATABASE_URL = os.getenv("DEV_DB_URL")
 engine = create_engine(DATABASE_URL, echo=False)
@@ -41,13 +68,28 @@ class TestThriftBackend(unittest.TestCase):
         db = TestingSessionLocal()
         try:
             db.query(ChatMessageORM).delete()
+            db.query(ChatArchiveChunkORM).delete()
+            db.query(SellerDailySalesORM).delete()
+            db.query(ProductDailySalesORM).delete()
+            db.query(OrderViewORM).delete()
             db.query(TransactionORM).delete()
             db.query(OrderORM).delete()
             db.query(ProductORM).delete()
+            db.query(ProductCellORM).delete()
+            db.query(ProductFacetORM).delete()
+            db.query(ProductSimilarORM).delete()
+            db.query(SimilarIndexStateORM).delete()
+            db.query(ProductChangeORM).delete()
+            db.query(TrendingBucketORM).delete()
             db.query(UserORM).delete()
             db.commit()
         finally:
             db.close()
+        search_cache.clear()
+        known_users.clear()
+        catalog.invalidate()
+        trending.clear()
+        similar_index.reset()
     
     def tearDown(self):
         """Print test result after each test"""
@@ -371,6 +413,1101 @@ class TestThriftBackend(unittest.TestCase):
         
         print(f"{'12':<6} {'Chat with invalid user':<30} {'FAIL':<10}")
     
+    # ==================== PERFORMANCE FEATURES ====================
+    
+    def test_13_slow_query_log_captures_route_and_plan(self):
+        """
+        Test Case 13: Slow-query log records a /search query with its plan
+        Data: threshold 0 ms so every statement counts as slow
+        Expected: entry tagged 'GET /search' with a captured EXPLAIN plan
+        """
+        slow_query_log.clear()
+        slow_query_log.threshold_ms = 0.0
+        try:
+            response = client.get("/search", params={"lat": 40.0, "lon": -74.0, "radius": 5})
+            self.assertEqual(response.status_code, 200)
+            # a failing statement must not leave its start time behind
+            with SessionLocal() as db:
+                with self.assertRaises(Exception):
+                    db.execute(text("SELECT * FROM no_such_table"))
+                self.assertEqual(db.connection().info.get("slow_query_start"), [])
+        finally:
+            slow_query_log.threshold_ms = None
+        
+        response = client.get("/admin/slow-queries", headers=ADMIN_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        entries = [e for e in response.json()["entries"] if e["route"] == "GET /search"]
+        self.assertTrue(entries)
+        self.assertIn("products", entries[0]["sql"])
+        self.assertTrue(entries[0]["plan"])
+        
+        # admin endpoints reject callers without the token
+        self.assertEqual(client.get("/admin/slow-queries").status_code, 403)
+        
+        print(f"{'13':<6} {'Slow-query log':<30} {'PASS':<10}")
+    
+    def test_14_search_clusters_follow_product_writes(self):
+        """
+        Test Case 14: Map clusters aggregate products and track add/update/delete
+        Data: two products in one ~5km cell, one product in another city
+        Expected: one cell with count 2 near the seller; counts follow moves and deletes
+        """
+        seller_id = client.post("/register", json={"name": "Map Seller", "email": "map@example.com", "role": "seller"}).json()["id"]
+        ids = []
+        for name, lat, lon in [("Lamp", 40.7128, -74.0060), ("Chair", 40.7130, -74.0062), ("Desk", 34.0522, -118.2437)]:
+            product = {"name": name, "price": 10.0, "seller_id": seller_id, "lat": lat, "lon": lon}
+            ids.append(client.post("/products", json=product).json()["id"])
+        
+        params = {"lat": 40.7128, "lon": -74.0060, "radius": 10, "precision": 12}
+        clusters = client.get("/search/clusters", params=params).json()
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]["count"], 2)
+        self.assertEqual(clusters[0]["representative"]["id"], ids[0])
+        
+        # deleting the representative promotes the remaining product
+        client.delete(f"/products/{ids[0]}")
+        clusters = client.get("/search/clusters", params=params).json()
+        self.assertEqual(clusters[0]["count"], 1)
+        self.assertEqual(clusters[0]["representative"]["id"], ids[1])
+        
+        # moving the last product away empties the area
+        client.put(f"/products/{ids[1]}", json={"lat": 34.0522, "lon": -118.2437})
+        self.assertEqual(client.get("/search/clusters", params=params).json(), [])
+        clusters = client.get("/search/clusters", params={"lat": 34.0522, "lon": -118.2437, "radius": 10, "precision": 12}).json()
+        self.assertEqual(clusters[0]["count"], 2)
+        
+        # two products created at once in an empty cell: both counted, neither write fails
+        first, second = SessionLocal(), SessionLocal()
+        errors = []
+        def write_second():
+            try:
+                update_product_cells(second, None, {"id": -2, "lat": -33.9, "lon": 151.2})
+                second.commit()
+            except Exception as exc:
+                errors.append(exc)
+        try:
+            update_product_cells(first, None, {"id": -1, "lat": -33.9, "lon": 151.2})
+            writer = threading.Thread(target=write_second)
+            writer.start()
+            time.sleep(0.1)
+            first.commit()
+            writer.join()
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(errors, [])
+        db = TestingSessionLocal()
+        try:
+            cells = db.query(ProductCellORM).filter(ProductCellORM.rep_product_id == -1).all()
+            self.assertTrue(cells)
+            self.assertTrue(all(c.count == 2 for c in cells))
+        finally:
+            db.close()
+        
+        print(f"{'14':<6} {'Map clusters':<30} {'PASS':<10}")
+    
+    def test_15_search_k_nearest_with_cursor(self):
+        """
+        Test Case 15: k-NN search returns the closest products in distance order
+        Data: products ~0km, ~3km and ~3900km from the query point, k=2
+        Expected: first page has the two closest with distances; cursor yields the third
+        """
+        seller_id = client.post("/register", json={"name": "Knn Seller", "email": "knn@example.com", "role": "seller"}).json()["id"]
+        for name, lat, lon in [("Far", 34.0522, -118.2437), ("Near", 40.7128, -74.0060), ("Mid", 40.7400, -74.0000)]:
+            client.post("/products", json={"name": name, "price": 5.0, "seller_id": seller_id, "lat": lat, "lon": lon})
+        
+        response = client.get("/search", params={"lat": 40.7128, "lon": -74.0060, "k": 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([p["name"] for p in page], ["Near", "Mid"])
+        self.assertLess(page[0]["distance_km"], page[1]["distance_km"])
+        cursor = response.headers["X-Next-Cursor"]
+        
+        response = client.get("/search", params={"lat": 40.7128, "lon": -74.0060, "k": 2, "cursor": cursor})
+        page = response.json()
+        self.assertEqual([p["name"] for p in page], ["Far"])
+        self.assertGreater(page[0]["distance_km"], 3000)
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        
+        print(f"{'15':<6} {'k-NN search with cursor':<30} {'PASS':<10}")
+    
+    def test_16_search_cache_hits_and_invalidation(self):
+        """
+        Test Case 16: Nearby /search calls share a cache entry until a product is written
+        Data: two queries a few metres apart, then a new product in range
+        Expected: second query is a cache hit; the new product shows up afterwards
+        """
+        seller_id = client.post("/register", json={"name": "Cache Seller", "email": "cache@example.com", "role": "seller"}).json()["id"]
+        client.post("/products", json={"name": "Kettle", "price": 8.0, "seller_id": seller_id, "lat": 40.7128, "lon": -74.0060})
+        
+        hits = search_cache.info()["hits"]
+        first = client.get("/search", params={"lat": 40.7121, "lon": -74.0051, "radius": 3}).json()
+        second = client.get("/search", params={"lat": 40.7123, "lon": -74.0053, "radius": 4}).json()
+        self.assertEqual([p["name"] for p in first], ["Kettle"])
+        self.assertEqual([p["name"] for p in second], ["Kettle"])
+        self.assertEqual(search_cache.info()["hits"], hits + 1)
+        
+        client.post("/products", json={"name": "Toaster", "price": 9.0, "seller_id": seller_id, "lat": 40.7130, "lon": -74.0050})
+        names = sorted(p["name"] for p in client.get("/search", params={"lat": 40.7123, "lon": -74.0053, "radius": 4}).json())
+        self.assertEqual(names, ["Kettle", "Toaster"])
+        
+        print(f"{'16':<6} {'Search cache invalidation':<30} {'PASS':<10}")
+    
+    def test_17_search_cache_coalesces_concurrent_misses(self):
+        """
+        Test Case 17: Identical concurrent cache misses run a single query
+        Data: 8 threads asking for the same cell while the load is slow
+        Expected: one load, every caller gets its result
+        """
+        loads = []
+        
+        def slow_load(db, lat, lon, radius):
+            loads.append((lat, lon))
+            time.sleep(0.2)
+            return [{"id": 1}]
+        
+        original = search_cache._load
+        search_cache._load = slow_load
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(search_cache.candidates(None, 12.97, 77.59, 5)))
+                       for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            search_cache._load = original
+        
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, [[{"id": 1}]] * 8)
+        
+        print(f"{'17':<6} {'Search cache coalescing':<30} {'PASS':<10}")
+    
+    def test_18_chat_group_commit_batches_messages(self):
+        """
+        Test Case 18: Concurrent chat sends are committed together
+        Data: 10 threads sending at once with a 50ms batching window
+        Expected: every message gets its own id, fewer commits than messages
+        """
+        alice = client.post("/register", json={"name": "Alice G", "email": "aliceg@example.com", "role": "buyer"}).json()["id"]
+        bob = client.post("/register", json={"name": "Bob G", "email": "bobg@example.com", "role": "seller"}).json()["id"]
+        
+        max_delay, chat_writer.max_delay = chat_writer.max_delay, 0.05
+        batches = chat_writer.stats["batches"]
+        try:
+            rows = []
+            threads = [threading.Thread(target=lambda i=i: rows.append(chat_writer.submit(alice, bob, f"msg {i}")))
+                       for i in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            chat_writer.max_delay = max_delay
+        
+        self.assertEqual(len({r.id for r in rows}), 10)
+        self.assertTrue(all(r.timestamp is not None for r in rows))
+        self.assertLess(chat_writer.stats["batches"] - batches, 10)
+        self.assertEqual(len(client.get(f"/chat/{alice}").json()), 10)
+        
+        print(f"{'18':<6} {'Chat group commit':<30} {'PASS':<10}")
+    
+    def test_19_reads_go_to_replica_until_own_write(self):
+        """
+        Test Case 19: GETs are served by the replica; a client that wrote reads the primary
+        Data: a second SQLite file standing in for a (lagging) replica
+        Expected: /users reads the replica, then the primary right after a POST
+        """
+        replica_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_replica.db")
+        if os.path.exists(replica_path):
+            os.remove(replica_path)
+        replica_factory = db_router.add_replica(f"sqlite:///{replica_path}")
+        try:
+            Base.metadata.create_all(bind=replica_factory.kw["bind"])
+            replica_db = replica_factory()
+            replica_db.add(UserORM(name="Replica Only", email="replica@example.com", role="buyer"))
+            replica_db.commit()
+            replica_db.close()
+            
+            self.assertEqual([u["name"] for u in client.get("/users").json()], ["Replica Only"])
+            
+            client.post("/register", json={"name": "Primary User", "email": "primary@example.com", "role": "buyer"})
+            self.assertEqual([u["name"] for u in client.get("/users").json()], ["Primary User"])
+            
+            # the SPA runs on another origin, so the cookie needs credentialed CORS
+            preflight = client.options("/users", headers={"Origin": "http://localhost:5173", "Access-Control-Request-Method": "GET"})
+            self.assertEqual(preflight.headers["access-control-allow-origin"], "http://localhost:5173")
+            self.assertEqual(preflight.headers["access-control-allow-credentials"], "true")
+            # no CORS_ORIGINS configured: a deployed frontend is echoed back too, not locked out
+            deployed = client.get("/users", headers={"Origin": "https://se-thrift.vercel.app"})
+            self.assertEqual(deployed.headers["access-control-allow-origin"], "https://se-thrift.vercel.app")
+        finally:
+            db_router.replica_factories.remove(replica_factory)
+            replica_factory.kw["bind"].dispose()
+            client.cookies.clear()
+            os.remove(replica_path)
+        
+        print(f"{'19':<6} {'Read replica routing':<30} {'PASS':<10}")
+    
+    def test_20_rate_limit_returns_429_with_retry_after(self):
+        """
+        Test Case 20: Per-client token bucket rejects a burst with Retry-After
+        Data: GET /users limited to a burst of 2
+        Expected: third request gets 429 with Retry-After; other routes unaffected
+        """
+        admission.set_policy("GET /users", max_concurrent=4, max_queue=4, rate=0.01, burst=2)
+        try:
+            codes = [client.get("/users").status_code for _ in range(3)]
+            self.assertEqual(codes, [200, 200, 429])
+            response = client.get("/users")
+            self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+            self.assertEqual(client.get("/orders").status_code, 200)
+        finally:
+            admission.remove_policy("GET /users")
+        
+        print(f"{'20':<6} {'Rate limiting':<30} {'PASS':<10}")
+    
+    def test_21_route_limiter_sheds_when_queue_full(self):
+        """
+        Test Case 21: Concurrency limiter queues up to its bound and sheds the rest
+        Data: 1 slot, queue of 1, 3 simultaneous requests
+        Expected: first runs, second waits for the slot, third is rejected immediately
+        """
+        async def scenario():
+            limiter = RouteLimiter(max_concurrent=1, max_queue=1, queue_timeout=1.0)
+            self.assertTrue(await limiter.acquire())
+            queued = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(await limiter.acquire())
+            limiter.release()
+            self.assertTrue(await queued)
+            limiter.release()
+            self.assertEqual(limiter.active, 0)
+        
+        asyncio.run(scenario())
+        
+        print(f"{'21':<6} {'Load shedding':<30} {'PASS':<10}")
+    
+    def test_22_money_is_exact_integer_cents(self):
+        """
+        Test Case 22: Prices and transaction amounts are integer cents
+        Data: price 0.10, quantity 3 (0.1 * 3 != 0.3 in float math)
+        Expected: price_cents=10, transaction amount_cents=30, amount=0.3
+        """
+        buyer_id = client.post("/register", json={"name": "Cents Buyer", "email": "centsb@example.com", "role": "buyer"}).json()["id"]
+        seller_id = client.post("/register", json={"name": "Cents Seller", "email": "centss@example.com", "role": "seller"}).json()["id"]
+        product = client.post("/products", json={"name": "Sticker", "price": 0.10, "seller_id": seller_id}).json()
+        self.assertEqual(product["price_cents"], 10)
+        self.assertEqual(product["price"], 0.1)
+        
+        order_id = client.post("/orders", json={"buyer_id": buyer_id, "product_id": product["id"], "quantity": 3}).json()["id"]
+        tx = client.post("/transactions", json={"order_id": order_id}).json()
+        self.assertEqual(tx["amount_cents"], 30)
+        self.assertEqual(tx["amount"], 0.3)
+        
+        updated = client.put(f"/products/{product['id']}", json={"price": 19.99}).json()
+        self.assertEqual(updated["price_cents"], 1999)
+        
+        # non-finite and negative prices are rejected by validation, not a 500
+        for price in ("NaN", "Infinity", "-1.5"):
+            body = f'{{"name": "Bad", "price": {price}, "seller_id": {seller_id}}}'
+            response = client.post("/products", content=body, headers={"Content-Type": "application/json"})
+            self.assertEqual(response.status_code, 422, price)
+        self.assertEqual(client.put(f"/products/{product['id']}", json={"price": -3}).status_code, 422)
+        self.assertEqual(client.get("/products/browse", params={"min_price": "inf"}).status_code, 422)
+        
+        print(f"{'22':<6} {'Integer cents money':<30} {'PASS':<10}")
+    
+    def test_23_migrate_numeric_money_columns(self):
+        """
+        Test Case 23: Legacy Numeric price/amount columns migrate to cents
+        Data: SQLite database with the old products/transactions schema
+        Expected: price_cents/amount_cents backfilled exactly, old columns dropped
+        """
+        legacy = create_engine("sqlite://")
+        with legacy.begin() as conn:
+            conn.execute(text("CREATE TABLE products (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, price NUMERIC(12, 2) NOT NULL)"))
+            conn.execute(text("CREATE TABLE transactions (id INTEGER PRIMARY KEY, order_id INTEGER, amount NUMERIC(12, 2) NOT NULL)"))
+            conn.execute(text("INSERT INTO products (name, price) VALUES ('Old Lamp', 19.99), ('Old Rug', 0.29)"))
+            conn.execute(text("INSERT INTO transactions (order_id, amount) VALUES (1, 59.97)"))
+        
+        migrate_money_to_cents(legacy)
+        migrate_money_to_cents(legacy)  # second run is a no-op
+        
+        with legacy.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT price_cents FROM products ORDER BY id")).scalars().all(), [1999, 29])
+            self.assertEqual(conn.execute(text("SELECT amount_cents FROM transactions")).scalar(), 5997)
+        self.assertNotIn("price", {c["name"] for c in inspect(legacy).get_columns("products")})
+        
+        print(f"{'23':<6} {'Money column migration':<30} {'PASS':<10}")
+    
+    def test_24_seller_stats_from_rollups(self):
+        """
+        Test Case 24: verify_payment maintains seller rollups; backfill rebuilds the same numbers
+        Data: two orders of a 5.00 product, one approved (qty 2), one denied
+        Expected: revenue 1000 cents, 1 approved, 1 denied; identical after rebuild
+        """
+        buyer_id = client.post("/register", json={"name": "Stats Buyer", "email": "statsb@example.com", "role": "buyer"}).json()["id"]
+        seller_id = client.post("/register", json={"name": "Stats Seller", "email": "statss@example.com", "role": "seller"}).json()["id"]
+        product_id = client.post("/products", json={"name": "Vase", "price": 5.00, "seller_id": seller_id}).json()["id"]
+        
+        for quantity, approved in ((2, True), (1, False)):
+            order_id = client.post("/orders", json={"buyer_id": buyer_id, "product_id": product_id, "quantity": quantity}).json()["id"]
+            tx_id = client.post("/transactions", json={"order_id": order_id}).json()["id"]
+            with mock.patch("main.random.choices", return_value=[approved]):
+                client.post("/payment/verify", params={"transaction_id": tx_id})
+        
+        stats = client.get(f"/sellers/{seller_id}/stats").json()
+        self.assertEqual(stats["totals"], {"orders_approved": 1, "orders_denied": 1, "units_sold": 2, "revenue_cents": 1000})
+        self.assertEqual(stats["products"][0]["product_id"], product_id)
+        self.assertEqual(stats["products"][0]["revenue_cents"], 1000)
+        
+        db = TestingSessionLocal()
+        try:
+            rebuild_sales_rollups(db, batch_size=1)
+        finally:
+            db.close()
+        self.assertEqual(client.get(f"/sellers/{seller_id}/stats").json(), stats)
+        
+        # two writers creating the same (seller, day) row: the second waits and adds instead of colliding
+        key = {"seller_id": seller_id, "day": datetime.utcnow().date() + timedelta(days=1)}
+        first, second = SessionLocal(), SessionLocal()
+        errors = []
+        def bump_second():
+            try:
+                upsert_add(second, SellerDailySalesORM, key, ["seller_id", "day"], {"orders_approved": 1})
+                second.commit()
+            except Exception as exc:
+                errors.append(exc)
+        try:
+            upsert_add(first, SellerDailySalesORM, key, ["seller_id", "day"], {"orders_approved": 1})
+            writer = threading.Thread(target=bump_second)
+            writer.start()
+            time.sleep(0.1)
+            first.commit()
+            writer.join()
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(errors, [])
+        db = TestingSessionLocal()
+        try:
+            self.assertEqual(db.query(SellerDailySalesORM).filter_by(**key).one().orders_approved, 2)
+        finally:
+            db.close()
+        
+        print(f"{'24':<6} {'Seller sales rollups':<30} {'PASS':<10}")
+    
+    def test_25_image_upload_dedup_and_thumbnails(self):
+        """
+        Test Case 25: Uploaded images are content-addressed and get cached thumbnails
+        Data: a 1000x500 PNG uploaded twice, then used as a product image
+        Expected: same URL both times; 200px JPEG thumbnail with immutable caching; ProductOut lists it
+        """
+        buf = io.BytesIO()
+        Image.new("RGB", (1000, 500), (200, 30, 30)).save(buf, "PNG")
+        first = client.post("/images", content=buf.getvalue(), headers={"Content-Type": "image/png"}).json()
+        second = client.post("/images", content=buf.getvalue(), headers={"Content-Type": "image/png"}).json()
+        self.assertEqual(first["url"], second["url"])
+        self.assertTrue(first["url"].endswith(f"/images/{first['digest']}.png"))
+        
+        original = client.get(first["url"])
+        self.assertEqual(original.content, buf.getvalue())
+        self.assertIn("immutable", original.headers["Cache-Control"])
+        
+        thumb = client.get(first["thumbnails"]["200"])
+        self.assertEqual(thumb.status_code, 200)
+        self.assertEqual(thumb.headers["content-type"], "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(thumb.content)).size, (200, 100))
+        self.assertEqual(client.get(first["thumbnails"]["200"], headers={"If-None-Match": thumb.headers["ETag"]}).status_code, 304)
+        
+        seller_id = client.post("/register", json={"name": "Img Seller", "email": "img@example.com", "role": "seller"}).json()["id"]
+        product = client.post("/products", json={"name": "Poster", "price": 3.0, "seller_id": seller_id, "image_url": first["url"]}).json()
+        self.assertEqual(product["thumbnails"], first["thumbnails"])
+        
+        self.assertEqual(client.post("/images", content=b"not an image", headers={"Content-Type": "text/plain"}).status_code, 415)
+        self.assertEqual(client.post("/images", content=b"not an image", headers={"Content-Type": "image/png"}).status_code, 415)
+        self.assertEqual(client.post("/images", content=buf.getvalue(), headers={"Content-Type": "image/jpeg"}).status_code, 415)
+        # an undecodable original already in the store: thumbnails answer 415, not 500
+        bad = "ab" * 32
+        os.makedirs(os.path.dirname(image_store.original_path(bad, "png")), exist_ok=True)
+        with open(image_store.original_path(bad, "png"), "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(client.get(f"/images/thumbs/200/{bad}.jpg").status_code, 415)
+        
+        print(f"{'25':<6} {'Image store and thumbnails':<30} {'PASS':<10}")
+    
+    def test_26_browse_columnar_catalog(self):
+        """
+        Test Case 26: /products/browse combines filters and sorts, and tracks writes after load
+        Data: four products across two categories, one with coordinates far away
+        Expected: correct totals and order for price/distance sorts; update and delete reflected
+        """
+        seller_id = client.post("/register", json={"name": "Browse Seller", "email": "browse@example.com", "role": "seller"}).json()["id"]
+        specs = [
+            ("Red Lamp", 12.0, "home", 40.0, -74.0),
+            ("Blue Lamp", 8.0, "home", 40.01, -74.0),
+            ("Lamp Shade", 3.0, "home", None, None),
+            ("Red Scarf", 5.0, "clothing", 41.0, -74.0),
+        ]
+        ids = {}
+        for name, price, category, lat, lon in specs:
+            body = {"name": name, "price": price, "category": category, "seller_id": seller_id, "lat": lat, "lon": lon}
+            ids[name] = client.post("/products", json=body).json()["id"]
+        
+        page = client.get("/products/browse", params={"category": "home", "sort": "price", "min_price": 4}).json()
+        self.assertEqual(page["total"], 2)
+        self.assertEqual([p["name"] for p in page["items"]], ["Blue Lamp", "Red Lamp"])
+        
+        page = client.get("/products/browse", params={"q": "LAMP", "sort": "-price", "limit": 1, "offset": 1}).json()
+        self.assertEqual(page["total"], 3)
+        self.assertEqual([p["name"] for p in page["items"]], ["Blue Lamp"])
+        
+        near = client.get("/products/browse", params={"lat": 40.0, "lon": -74.0, "radius": 10, "sort": "distance"}).json()
+        self.assertEqual([p["name"] for p in near["items"]], ["Red Lamp", "Blue Lamp"])
+        self.assertEqual(client.get("/products/browse", params={"sort": "distance"}).status_code, 400)
+        
+        # writes after the snapshot is loaded are patched in on commit
+        self.assertEqual(client.put(f"/products/{ids['Red Scarf']}", json={"price": 1.0, "category": "home"}).status_code, 200)
+        self.assertEqual(client.delete(f"/products/{ids['Blue Lamp']}").status_code, 200)
+        page = client.get("/products/browse", params={"category": "home", "sort": "price"}).json()
+        self.assertEqual([p["name"] for p in page["items"]], ["Red Scarf", "Lamp Shade", "Red Lamp"])
+        self.assertEqual([p["category"] for p in page["items"]], ["home"] * 3)
+        self.assertEqual(page["items"][0]["price_cents"], 100)
+        
+        # seller and price filters narrow on the fields they name
+        other_id = client.post("/register", json={"name": "Other Browse", "email": "browse2@example.com", "role": "seller"}).json()["id"]
+        client.post("/products", json={"name": "Other Lamp", "price": 6.0, "category": "home", "seller_id": other_id})
+        mine = client.get("/products/browse", params={"seller_id": seller_id, "q": "lamp"}).json()
+        self.assertEqual(mine["total"], 2)
+        self.assertTrue(all(p["seller_id"] == seller_id for p in mine["items"]))
+        theirs = client.get("/products/browse", params={"seller_id": other_id}).json()
+        self.assertEqual([p["name"] for p in theirs["items"]], ["Other Lamp"])
+        priced = client.get("/products/browse", params={"min_price": 2, "max_price": 6, "sort": "price"}).json()
+        self.assertEqual([p["price_cents"] for p in priced["items"]], [300, 600])
+        
+        # equal prices across page boundaries: pages follow id order within the tie, nothing skipped or repeated
+        tie_seller = client.post("/register", json={"name": "Tie Seller", "email": "tie@example.com", "role": "seller"}).json()["id"]
+        dearer = [client.post("/products", json={"name": f"Dear {i}", "price": 20.0, "seller_id": tie_seller}).json()["id"] for i in range(10)]
+        tied = [client.post("/products", json={"name": f"Tie {i}", "price": 9.0, "seller_id": tie_seller}).json()["id"] for i in range(10)]
+        seen = []
+        for offset in range(0, 20, 3):
+            page = client.get("/products/browse", params={"seller_id": tie_seller, "sort": "price", "offset": offset, "limit": 3}).json()
+            seen += [p["id"] for p in page["items"]]
+        self.assertEqual(seen, tied + dearer)
+        
+        print(f"{'26':<6} {'Columnar catalog browse':<30} {'PASS':<10}")
+    
+    def test_27_similar_products_index(self):
+        """
+        Test Case 27: Similar products are precomputed and refreshed incrementally on writes
+        Data: three lamps and a scarf; a fourth lamp added later; one lamp deleted
+        Expected: lamps rank each other first; the new lamp enters existing lists; deleted one leaves them
+        """
+        seller_id = client.post("/register", json={"name": "Sim Seller", "email": "sim@example.com", "role": "seller"}).json()["id"]
+        def add(name, description, price, category):
+            body = {"name": name, "description": description, "price": price, "category": category, "seller_id": seller_id}
+            return client.post("/products", json=body).json()["id"]
+        brass = add("Brass desk lamp", "vintage brass lamp with green shade", 40.0, "home")
+        floor_lamp = add("Floor lamp", "tall brass floor lamp", 55.0, "home")
+        scarf = add("Wool scarf", "warm knitted wool scarf", 12.0, "clothing")
+        similar_index.flush()
+        
+        similar = client.get(f"/products/{brass}/similar").json()
+        self.assertEqual([p["id"] for p in similar], [floor_lamp, scarf])
+        self.assertGreater(similar[0]["score"], similar[1]["score"])
+        
+        reading = add("Brass reading lamp", "brass lamp, green glass shade", 35.0, "home")
+        self.assertGreaterEqual(similar_index.flush(), 3)  # the new lamp and the lists it enters
+        self.assertEqual(client.get(f"/products/{brass}/similar").json()[0]["id"], reading)
+        self.assertIn(reading, [p["id"] for p in client.get(f"/products/{floor_lamp}/similar").json()])
+        
+        client.delete(f"/products/{reading}")
+        similar_index.flush()
+        self.assertNotIn(reading, [p["id"] for p in client.get(f"/products/{brass}/similar", params={"limit": 5}).json()])
+        self.assertEqual(client.get(f"/products/{reading}/similar").status_code, 404)
+        
+        # a write made by another worker reaches the maintainer through product_changes
+        db = TestingSessionLocal()
+        try:
+            db.query(ProductORM).filter(ProductORM.id == scarf).update(
+                {"name": "Brass table lamp", "description": "vintage brass lamp with green shade", "category": "home", "price_cents": 4000})
+            db.add(ProductChangeORM(seq=next_change_seq(db), product_id=scarf))
+            db.commit()
+        finally:
+            db.close()
+        self.assertGreaterEqual(similar_index.flush(), 1)
+        self.assertEqual(client.get(f"/products/{brass}/similar").json()[0]["id"], scarf)
+        
+        # only one process maintains the index; the others leave it alone
+        worker = SimilarityIndex(SessionLocal)
+        self.assertEqual(worker.flush(), 0)
+        db = TestingSessionLocal()
+        try:
+            generation = db.query(SimilarIndexStateORM.generation).scalar()
+            worker.ensure(db)
+            self.assertEqual(db.query(SimilarIndexStateORM.generation).scalar(), generation)
+            db.query(SimilarIndexStateORM).delete()
+            db.commit()
+            worker.ensure(db)  # even with no index built yet
+            self.assertIsNone(db.query(SimilarIndexStateORM.id).first())
+            similar_index.ensure(db)
+            self.assertGreater(db.query(SimilarIndexStateORM.generation).scalar(), 0)
+        finally:
+            db.close()
+        
+        db = TestingSessionLocal()
+        try:
+            incremental = client.get(f"/products/{floor_lamp}/similar").json()
+            similar_index.rebuild(db)
+            self.assertEqual([p["id"] for p in client.get(f"/products/{floor_lamp}/similar").json()],
+                             [p["id"] for p in incremental])
+        finally:
+            db.close()
+        
+        print(f"{'27':<6} {'Similar products index':<30} {'PASS':<10}")
+    
+    def test_28_chat_hot_cold_archive(self):
+        """
+        Test Case 28: Old chat messages move to the compressed archive; paging back reads it
+        Data: 6 messages, the first 4 backdated 60 days; archiver batch size 3
+        Expected: hot read returns the 2 recent ones; before_id pages reach all 6 in order
+        """
+        alice = client.post("/register", json={"name": "Arch A", "email": "archa@example.com", "role": "buyer"}).json()["id"]
+        bob = client.post("/register", json={"name": "Arch B", "email": "archb@example.com", "role": "seller"}).json()["id"]
+        ids = [client.post("/chat/send", json={"sender_id": alice, "receiver_id": bob, "message": f"m{i}"}).json()["id"] for i in range(6)]
+        db = TestingSessionLocal()
+        try:
+            db.query(ChatMessageORM).filter(ChatMessageORM.id.in_(ids[:4])).update(
+                {ChatMessageORM.timestamp: datetime.utcnow() - timedelta(days=60)}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        
+        batch_size, chat_archiver.batch_size = chat_archiver.batch_size, 3
+        try:
+            self.assertEqual(chat_archiver.run_once(), 4)
+        finally:
+            chat_archiver.batch_size = batch_size
+        
+        self.assertEqual([m["message"] for m in client.get(f"/chat/{alice}").json()], ["m4", "m5"])
+        self.assertEqual([m["message"] for m in client.get(f"/chat/{bob}", params={"since_id": ids[4]}).json()], ["m5"])
+        page = client.get(f"/chat/{alice}", params={"before_id": ids[5], "limit": 3}).json()
+        self.assertEqual([m["message"] for m in page], ["m2", "m3", "m4"])
+        page = client.get(f"/chat/{bob}", params={"before_id": page[0]["id"], "limit": 10}).json()
+        self.assertEqual([m["message"] for m in page], ["m0", "m1"])
+        
+        db = TestingSessionLocal()
+        try:
+            self.assertEqual(db.query(ChatArchiveChunkORM).count(), 4)  # 2 batches x 2 participants
+        finally:
+            db.close()
+        
+        print(f"{'28':<6} {'Chat hot/cold archive':<30} {'PASS':<10}")
+    
+    def test_29_catalog_snapshot_mmap_and_catch_up(self):
+        """
+        Test Case 29: Workers map the catalog snapshot and replay only later changes
+        Data: 3 products snapshotted; then one added, one renamed, one deleted
+        Expected: mapped (copy-on-write) columns; browse reflects all three later writes
+        """
+        seller_id = client.post("/register", json={"name": "Snap Seller", "email": "snap@example.com", "role": "seller"}).json()["id"]
+        ids = [client.post("/products", json={"name": f"Snap {i}", "price": 1.0 + i, "seller_id": seller_id}).json()["id"] for i in range(3)]
+        stamp = client.post("/admin/catalog/snapshot", headers=ADMIN_HEADERS).json()
+        self.assertEqual((stamp["count"], stamp["max_product_id"]), (3, ids[-1]))
+        try:
+            new_id = client.post("/products", json={"name": "Snap new", "price": 9.0, "seller_id": seller_id}).json()["id"]
+            client.put(f"/products/{ids[0]}", json={"name": "Renamed teapot"})
+            client.delete(f"/products/{ids[1]}")
+            
+            catalog.invalidate()  # as a freshly started worker
+            page = client.get("/products/browse", params={"sort": "price"}).json()
+            self.assertEqual([p["id"] for p in page["items"]], [ids[0], ids[2], new_id])
+            self.assertEqual(client.get("/products/browse", params={"q": "teapot"}).json()["total"], 1)
+            info = client.get("/admin/catalog", headers=ADMIN_HEADERS).json()
+            self.assertEqual(info["source"], "snapshot")
+            self.assertTrue(info["mapped"])
+            self.assertEqual(info["rows"], 3)
+            self.assertIsInstance(catalog.prices, np.memmap)
+        finally:
+            os.remove(catalog.snapshot_path)
+            catalog.invalidate()
+        
+        print(f"{'29':<6} {'Catalog snapshot mmap':<30} {'PASS':<10}")
+    
+    def test_30_product_change_feed(self):
+        """
+        Test Case 30: /products/changes returns deltas after a token
+        Data: token from /products; then add A, add B, update A, delete B; paged with limit=2
+        Expected: A upserted with new price, B as a tombstone; empty delta at the final token
+        """
+        seller_id = client.post("/register", json={"name": "Feed Seller", "email": "feed@example.com", "role": "seller"}).json()["id"]
+        token = client.get("/products").headers["X-Change-Token"]
+        a = client.post("/products", json={"name": "A", "price": 1.0, "seller_id": seller_id}).json()["id"]
+        b = client.post("/products", json={"name": "B", "price": 2.0, "seller_id": seller_id}).json()["id"]
+        client.put(f"/products/{a}", json={"price": 3.0})
+        client.delete(f"/products/{b}")
+        
+        first = client.get("/products/changes", params={"since": token, "limit": 2}).json()
+        self.assertTrue(first["has_more"])
+        rest = client.get("/products/changes", params={"since": first["token"]}).json()
+        self.assertFalse(rest["has_more"])
+        self.assertEqual([(c["id"], c["deleted"]) for c in rest["changes"]], [(a, False), (b, True)])
+        self.assertEqual(rest["changes"][0]["product"]["price_cents"], 300)
+        self.assertIsNone(rest["changes"][1]["product"])
+        
+        self.assertEqual(client.get("/products/changes", params={"since": rest["token"]}).json()["changes"], [])
+        self.assertEqual(client.get("/products/changes").json()["token"], rest["token"])
+        self.assertEqual(client.get("/products/changes", params={"since": "nope"}).status_code, 400)
+        
+        # overlapping writers: the second can't take a seq until the first commits
+        first_writer = SessionLocal()
+        seqs = {}
+        def second_writer():
+            db = SessionLocal()
+            try:
+                seqs["second"] = next_change_seq(db)
+                db.add(ProductChangeORM(seq=seqs["second"], product_id=a))
+                db.commit()
+            finally:
+                db.close()
+        try:
+            seqs["first"] = next_change_seq(first_writer)
+            first_writer.add(ProductChangeORM(seq=seqs["first"], product_id=b, deleted=True))
+            writer = threading.Thread(target=second_writer)
+            writer.start()
+            writer.join(0.3)
+            self.assertTrue(writer.is_alive())
+            self.assertEqual(client.get("/products/changes", params={"since": rest["token"]}).json()["changes"], [])
+            first_writer.commit()
+        finally:
+            first_writer.close()
+        writer.join()
+        self.assertEqual(seqs["second"], seqs["first"] + 1)
+        late = client.get("/products/changes", params={"since": rest["token"]}).json()
+        self.assertEqual([(c["id"], c["deleted"]) for c in late["changes"]], [(b, True), (a, False)])
+        
+        print(f"{'30':<6} {'Product change feed':<30} {'PASS':<10}")
+    
+    def test_31_product_facets(self):
+        """
+        Test Case 31: Facet counts and price histograms follow product writes
+        Data: 3 books and 1 lamp, one book ~200km away and one without coordinates; then edits
+        Expected: global and 20km-radius counts; histogram per category; same after a rebuild
+        """
+        seller_id = client.post("/register", json={"name": "Facet Seller", "email": "facet@example.com", "role": "seller"}).json()["id"]
+        def add(name, price, category, lat=None, lon=None):
+            body = {"name": name, "price": price, "category": category, "seller_id": seller_id, "lat": lat, "lon": lon}
+            return client.post("/products", json=body).json()["id"]
+        add("Novel", 4.0, "books", 40.0, -74.0)
+        atlas = add("Atlas", 30.0, "books", 41.8, -74.0)
+        add("Comic", 7.5, "books")
+        lamp = add("Lamp", 30.0, "home", 40.01, -74.01)
+        
+        facets = client.get("/products/facets").json()
+        self.assertEqual(facets["total"], 4)
+        self.assertEqual(facets["categories"], [{"category": "books", "count": 3}, {"category": "home", "count": 1}])
+        buckets = {b["min_cents"]: b["count"] for b in facets["price_histogram"] if b["count"]}
+        self.assertEqual(buckets, {0: 1, 500: 1, 2500: 2})
+        books = client.get("/products/facets", params={"category": "books"}).json()
+        self.assertEqual({b["min_cents"]: b["count"] for b in books["price_histogram"] if b["count"]}, {0: 1, 500: 1, 2500: 1})
+        
+        near = client.get("/products/facets", params={"lat": 40.0, "lon": -74.0, "radius": 20}).json()
+        self.assertEqual(near["categories"], [{"category": "books", "count": 1}, {"category": "home", "count": 1}])
+        self.assertGreater(near["precision"], 0)
+        self.assertEqual(client.get("/products/facets", params={"radius": 5}).status_code, 400)
+        
+        client.put(f"/products/{lamp}", json={"category": "books", "price": 120.0})
+        client.delete(f"/products/{atlas}")
+        facets = client.get("/products/facets").json()
+        self.assertEqual(facets["categories"], [{"category": "books", "count": 3}])
+        self.assertEqual({b["min_cents"]: b["count"] for b in facets["price_histogram"] if b["count"]}, {0: 1, 500: 1, 10000: 1})
+        
+        db = TestingSessionLocal()
+        try:
+            rebuild_product_facets(db)
+        finally:
+            db.close()
+        self.assertEqual(client.get("/products/facets").json(), facets)
+        # legacy negative prices land in the lowest bucket, not the top one
+        self.assertEqual([price_bucket(c) for c in (-100, 0, 499, 250000)], [0, 0, 0, len(PRICE_BUCKET_EDGES_CENTS) - 1])
+        
+        # two writers making the first entry in the same bucket: both counted, neither fails
+        state = {"id": 0, "category": "racing", "price_cents": 700, "lat": 10.0, "lon": 10.0}
+        first, second = SessionLocal(), SessionLocal()
+        errors = []
+        def write_second():
+            try:
+                update_product_facets(second, None, dict(state, id=1))
+                second.commit()
+            except Exception as exc:
+                errors.append(exc)
+        try:
+            update_product_facets(first, None, state)
+            writer = threading.Thread(target=write_second)
+            writer.start()
+            time.sleep(0.1)
+            first.commit()
+            writer.join()
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(errors, [])
+        racing = client.get("/products/facets").json()
+        self.assertIn({"category": "racing", "count": 2}, racing["categories"])
+        
+        print(f"{'31':<6} {'Product facets':<30} {'PASS':<10}")
+    
+    def test_32_order_history_read_model(self):
+        """
+        Test Case 32: Order history is served from the denormalised read model
+        Data: buyer orders 3 x 'Teapot' (4.50) from 'Tea Seller', pays (approved); a second order stays unpaid
+        Expected: rows carry product/seller names, amount and payment status; paging by cursor; rebuild matches
+        """
+        buyer_id = client.post("/register", json={"name": "Hist Buyer", "email": "histb@example.com", "role": "buyer"}).json()["id"]
+        seller_id = client.post("/register", json={"name": "Tea Seller", "email": "hists@example.com", "role": "seller"}).json()["id"]
+        product_id = client.post("/products", json={"name": "Teapot", "price": 4.50, "seller_id": seller_id}).json()["id"]
+        paid = client.post("/orders", json={"buyer_id": buyer_id, "product_id": product_id, "quantity": 3}).json()["id"]
+        tx_id = client.post("/transactions", json={"order_id": paid}).json()["id"]
+        client.post("/payment/process", params={"transaction_id": tx_id})
+        with mock.patch("main.random.choices", return_value=[True]):
+            client.post("/payment/verify", params={"transaction_id": tx_id})
+        unpaid = client.post("/orders", json={"buyer_id": buyer_id, "product_id": product_id, "quantity": 1}).json()["id"]
+        
+        first = client.get("/orders/history", params={"buyer_id": buyer_id, "limit": 1})
+        self.assertEqual([o["id"] for o in first.json()], [unpaid])
+        self.assertIsNone(first.json()[0]["transaction_status"])
+        rest = client.get("/orders/history", params={"buyer_id": buyer_id, "before_id": first.headers["X-Next-Cursor"]}).json()
+        self.assertEqual(len(rest), 1)
+        order = rest[0]
+        self.assertEqual((order["product_name"], order["seller_name"], order["buyer_name"]), ("Teapot", "Tea Seller", "Hist Buyer"))
+        self.assertEqual((order["unit_price_cents"], order["amount_cents"], order["amount"]), (450, 1350, 13.5))
+        self.assertEqual((order["status"], order["transaction_status"]), ("completed", "approved"))
+        self.assertEqual(len(client.get("/orders/history", params={"seller_id": seller_id}).json()), 2)
+        
+        history = client.get("/orders/history", params={"seller_id": seller_id}).json()
+        db = TestingSessionLocal()
+        try:
+            self.assertEqual(rebuild_order_views(db, batch_size=1), {"orders": 2})  # one keyset batch per order
+        finally:
+            db.close()
+        self.assertEqual(client.get("/orders/history", params={"seller_id": seller_id}).json(), history)
+        
+        print(f"{'32':<6} {'Order history read model':<30} {'PASS':<10}")
+    
+    def test_33_response_compression_and_cache(self):
+        """
+        Test Case 33: Large JSON is gzip-compressed; catalog bodies are compressed once per version
+        Data: 30 products; /products fetched twice, then after a write; identity and small responses
+        Expected: Content-Encoding gzip + Vary; second fetch is a cache hit; a write causes a miss
+        """
+        self.assertEqual(negotiate_encoding("br;q=0, gzip;q=0.5"), "gzip")
+        self.assertIsNone(negotiate_encoding("identity"))
+        self.assertIsNone(negotiate_encoding("gzip;q=0"))
+        
+        seller_id = client.post("/register", json={"name": "Zip Seller", "email": "zip@example.com", "role": "seller"}).json()["id"]
+        for i in range(30):
+            client.post("/products", json={"name": f"Zip item {i}", "description": "plain cotton shirt", "price": 5.0, "seller_id": seller_id})
+        gzip_only = {"Accept-Encoding": "gzip"}
+        
+        hits, misses = compressor.stats["cache_hits"], compressor.stats["cache_misses"]
+        first = client.get("/products", headers=gzip_only)
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", first.headers["Vary"])
+        self.assertEqual(len(first.json()), 30)  # httpx decodes transparently
+        second = client.get("/products", headers=gzip_only)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual((compressor.stats["cache_hits"] - hits, compressor.stats["cache_misses"] - misses), (1, 1))
+        
+        client.post("/products", json={"name": "Zip item new", "price": 5.0, "seller_id": seller_id})
+        self.assertEqual(len(client.get("/products", headers=gzip_only).json()), 31)
+        self.assertEqual(compressor.stats["cache_misses"] - misses, 2)
+        
+        self.assertNotIn("Content-Encoding", client.get("/products", headers={"Accept-Encoding": "identity"}).headers)
+        self.assertNotIn("Content-Encoding", client.get(f"/products/{seller_id}/similar", headers=gzip_only).headers)
+        stats = client.get("/admin/compression", headers=ADMIN_HEADERS).json()
+        self.assertLess(stats["ratio"], 0.5)
+        
+        print(f"{'33':<6} {'Response compression':<30} {'PASS':<10}")
+    
+    def test_34_sampling_profiler(self):
+        """
+        Test Case 34: /admin/profile samples live request threads and tags stacks by route
+        Data: a background thread hammering /products/browse during a 0.5s profile at 2ms
+        Expected: collapsed stacks rooted at 'GET /products/browse'; route filter; admin only
+        """
+        seller_id = client.post("/register", json={"name": "Prof Seller", "email": "prof@example.com", "role": "seller"}).json()["id"]
+        for i in range(20):
+            client.post("/products", json={"name": f"Prof item {i}", "price": 1.0 + i, "seller_id": seller_id})
+        stop = threading.Event()
+        def load():
+            while not stop.is_set():
+                client.get("/products/browse", params={"q": "item", "sort": "price"})
+        worker = threading.Thread(target=load)
+        worker.start()
+        try:
+            response = client.get("/admin/profile", params={"seconds": 0.5, "interval_ms": 2}, headers=ADMIN_HEADERS)
+            filtered = client.get("/admin/profile", params={"seconds": 0.3, "interval_ms": 2, "route": "GET /nothing", "format": "json"},
+                                  headers=ADMIN_HEADERS).json()
+        finally:
+            stop.set()
+            worker.join()
+        
+        self.assertEqual(response.status_code, 200)
+        lines = response.text.strip().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any(line.startswith("GET /products/browse;") for line in lines))
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertGreater(filtered["ticks"], 10)
+        self.assertEqual(filtered["collapsed"].strip(), "")
+        self.assertEqual(client.get("/admin/profile", params={"seconds": 0.1}).status_code, 403)
+        
+        print(f"{'34':<6} {'Sampling profiler':<30} {'PASS':<10}")
+    
+    def test_35_allocation_tracking(self):
+        """
+        Test Case 35: opt-in tracemalloc accounting per route with a memory budget
+        Data: tracking enabled at sample rate 1 with a tiny budget, then several /products listings
+        Expected: per-route peak/net stats, top sites and over-budget events; disabling clears them
+        """
+        seller_id = client.post("/register", json={"name": "Alloc Seller", "email": "alloc@example.com", "role": "seller"}).json()["id"]
+        for i in range(10):
+            client.post("/products", json={"name": f"Alloc item {i}", "price": 2.0 + i, "seller_id": seller_id})
+        
+        self.assertEqual(client.post("/admin/allocations", params={"sample_rate": 1}).status_code, 403)
+        enabled = client.post("/admin/allocations", params={"sample_rate": 1, "budget_mb": 0.001}, headers=ADMIN_HEADERS).json()
+        self.assertTrue(enabled["enabled"])
+        try:
+            for _ in range(3):
+                self.assertEqual(client.get("/products").status_code, 200)
+            info = client.get("/admin/allocations", headers=ADMIN_HEADERS).json()
+        finally:
+            client.delete("/admin/allocations", headers=ADMIN_HEADERS)
+        
+        route = info["routes"]["GET /products"]
+        self.assertEqual(route["requests"], 3)
+        self.assertGreater(route["max_peak_bytes"], 1024)
+        self.assertGreaterEqual(route["max_peak_bytes"], route["avg_peak_bytes"])
+        self.assertEqual(route["over_budget"], 3)
+        self.assertTrue(route["top_sites"])
+        self.assertTrue(any(e["route"] == "GET /products" for e in info["over_budget"]))
+        after = client.get("/admin/allocations", headers=ADMIN_HEADERS).json()
+        self.assertFalse(after["enabled"])
+        self.assertEqual(after["routes"], {})
+        
+        # tracing stopped between the sampling decision and begin(): nothing measured, lock left free
+        self.assertIsNone(alloc_tracker.begin())
+        self.assertFalse(alloc_tracker._busy.locked())
+        
+        print(f"{'35':<6} {'Allocation tracking':<30} {'PASS':<10}")
+    
+    def test_36_batch_reads(self):
+        """
+        Test Case 36: POST /batch runs several GETs through their routes in one round trip
+        Data: chat messages + user list + browse page, plus an unknown path and invalid limits
+        Expected: per-operation results match the standalone routes; errors stay per operation
+        """
+        alice = client.post("/register", json={"name": "Batch Alice", "email": "batch.alice@example.com", "role": "buyer"}).json()["id"]
+        bob = client.post("/register", json={"name": "Batch Bob", "email": "batch.bob@example.com", "role": "seller"}).json()["id"]
+        client.post("/chat/send", json={"sender_id": alice, "receiver_id": bob, "message": "batched hello"})
+        
+        response = client.post("/batch", json={"operations": [
+            {"id": "messages", "path": f"/chat/{alice}"},
+            {"id": "users", "path": "/users"},
+            {"id": "browse", "path": "/products/browse?sort=price", "params": {"limit": 2}},
+            {"id": "history", "path": "/orders/history", "params": {"buyer_id": alice, "limit": 10000}},
+            {"id": "missing", "path": "/nothing/here"},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        results = {r["id"]: r for r in response.json()}
+        self.assertEqual(results["messages"]["status"], 200)
+        self.assertEqual(results["messages"]["body"], client.get(f"/chat/{alice}").json())
+        self.assertEqual(results["users"]["body"], client.get("/users").json())
+        self.assertLessEqual(len(results["browse"]["body"]["items"]), 2)
+        self.assertEqual(results["history"]["status"], 422)
+        self.assertEqual(results["missing"]["status"], 404)
+        
+        # admission applies per operation, and a failure stays in its own result
+        admission.set_policy("GET /users", max_concurrent=4, max_queue=4, rate=0.01, burst=1)
+        try:
+            limited = client.post("/batch", json={"operations": [{"path": "/users"}, {"path": "/users"}, {"path": f"/chat/{alice}"}]}).json()
+        finally:
+            admission.remove_policy("GET /users")
+        self.assertEqual([r["status"] for r in limited], [200, 429, 200])
+        self.assertIn("retry-after", limited[1]["headers"])
+        with mock.patch("main.archived_messages", side_effect=RuntimeError("secret detail")), \
+                mock.patch.object(Session, "rollback", autospec=True) as rollback, self.assertLogs("thrift.batch", "ERROR"):
+            failed = client.post("/batch", json={"operations": [
+                {"path": f"/chat/{alice}", "params": {"before_id": 10 ** 9}}, {"path": "/users"},
+            ]}).json()
+        self.assertEqual((failed[0]["status"], failed[0]["body"]), (500, {"detail": "Internal Server Error"}))
+        self.assertEqual(failed[1]["status"], 200)
+        self.assertTrue(rollback.called)
+        
+        too_many = client.post("/batch", json={"operations": [{"path": "/users"}] * 1000})
+        self.assertEqual(too_many.status_code, 400)
+        
+        print(f"{'36':<6} {'Batch reads':<30} {'PASS':<10}")
+    
+    def test_37_trending_products(self):
+        """
+        Test Case 37: /products/trending ranks products by orders in the sliding window
+        Data: orders 3/1/2 for two nearby products and one far away; flush and reload; window expiry
+        Expected: ranking by order count, radius filter, counts restored from trending_buckets, expiry
+        """
+        seller_id = client.post("/register", json={"name": "Trend Seller", "email": "trend.seller@example.com", "role": "seller"}).json()["id"]
+        buyer_id = client.post("/register", json={"name": "Trend Buyer", "email": "trend.buyer@example.com", "role": "buyer"}).json()["id"]
+        ids = [
+            client.post("/products", json={"name": f"Trend item {i}", "price": 5.0, "seller_id": seller_id, "lat": lat, "lon": lon}).json()["id"]
+            for i, (lat, lon) in enumerate([(10.0, 10.0), (10.0, 10.01), (50.0, 50.0)])
+        ]
+        for product_id, n in zip(ids, (3, 1, 2)):
+            for _ in range(n):
+                self.assertEqual(client.post("/orders", json={"buyer_id": buyer_id, "product_id": product_id}).status_code, 200)
+        
+        def ranking(**params):
+            response = client.get("/products/trending", params={"limit": 50, **params})
+            self.assertEqual(response.status_code, 200)
+            return [(p["id"], p["orders"]) for p in response.json() if p["id"] in ids]
+        
+        expected = [(ids[0], 3), (ids[2], 2), (ids[1], 1)]
+        self.assertEqual(ranking(), expected)
+        self.assertEqual(ranking(lat=10.0, lon=10.0, radius=5), [(ids[0], 3), (ids[1], 1)])
+        self.assertEqual(client.get("/products/trending", params={"radius": 5}).status_code, 400)
+        
+        # restart: memory is lost, flushed counts come back from trending_buckets
+        trending.flush()
+        trending.clear()
+        self.assertEqual(ranking(), [])
+        trending.flush()
+        self.assertEqual(ranking(), expected)
+        self.assertFalse([i for i, _ in trending.top(50, now=time.time() + 3700) if i in ids])
+        trending.flush()
+        self.assertEqual(client.delete(f"/products/{ids[0]}").status_code, 200)
+        self.assertEqual(ranking(), expected[1:])
+        self.assertEqual(client.get("/admin/trending", headers=ADMIN_HEADERS).json()["window_minutes"], 60)
+        
+        # an order seen after the product lost its location moves it out of the cell lists
+        trending.record(ids[1], None, None)
+        self.assertEqual(ranking(lat=10.0, lon=10.0, radius=5), [])
+        trending.record(ids[1], 10.0, 10.01)
+        self.assertEqual(ranking(lat=10.0, lon=10.0, radius=5), [(ids[1], 3)])
+        with mock.patch.dict(trending._locations, {ids[1]: None}):  # stale cell list entry
+            self.assertEqual(ranking(lat=10.0, lon=10.0, radius=5), [])
+        
+        print(f"{'37':<6} {'Trending products':<30} {'PASS':<10}")
+    
+    def test_38_payment_gateway(self):
+        """
+        Test Case 38: payment provider calls go through a bulkheaded client with timeouts, retries and a breaker
+        Data: simulated gateways that are healthy, always failing, slow, and a pool of one
+        Expected: verify approves via the gateway; failures give 503 + Retry-After and open the circuit;
+                  slow calls time out; a saturated pool rejects instead of queueing
+        """
+        buyer_id = client.post("/register", json={"name": "Pay Buyer", "email": "pay.buyer@example.com", "role": "buyer"}).json()["id"]
+        seller_id = client.post("/register", json={"name": "Pay Seller", "email": "pay.seller@example.com", "role": "seller"}).json()["id"]
+        product_id = client.post("/products", json={"name": "Kettle", "price": 12.0, "seller_id": seller_id}).json()["id"]
+        order_id = client.post("/orders", json={"buyer_id": buyer_id, "product_id": product_id}).json()["id"]
+        tx_id = client.post("/transactions", json={"order_id": order_id}).json()["id"]
+        
+        failing = SimulatedGateway(error_rate=1.0)
+        with mock.patch.object(payments, "gateway", failing), mock.patch.object(payments, "breaker", CircuitBreaker(3, 60)), \
+                mock.patch.object(payments, "backoff", 0.001):
+            response = client.post("/payment/process", params={"transaction_id": tx_id})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("Retry-After", response.headers)
+            self.assertEqual(payments.breaker.state, "open")
+            # fails fast while open, and the transaction is untouched
+            self.assertIn("circuit open", client.post("/payment/verify", params={"transaction_id": tx_id}).json()["detail"])
+            self.assertGreater(int(client.post("/payment/verify", params={"transaction_id": tx_id}).headers["Retry-After"]), 1)
+        self.assertEqual(client.get("/transactions").json()[-1]["status"], "pending")
+        
+        self.assertEqual(client.post("/payment/process", params={"transaction_id": tx_id}).json()["status"], "processing")
+        with mock.patch.object(payments, "gateway", SimulatedGateway(approve_rate=1.0)):
+            verified = client.post("/payment/verify", params={"transaction_id": tx_id}).json()
+        self.assertTrue(verified["approved"])
+        self.assertEqual(verified["order_status"], "completed")
+        self.assertEqual(client.post("/payment/verify", params={"transaction_id": 10**9}).status_code, 404)
+        
+        # timeouts, retries and the bulkhead, on a dedicated client
+        slow = PaymentClient(SimulatedGateway(latency_ms=300, latency_sigma=0.01), pool_size=1, max_queue=0,
+                             timeout=0.05, retries=1, backoff=0.001, breaker=CircuitBreaker(10, 60))
+        async def race():
+            return await asyncio.gather(slow.call("verify", 1, 100), slow.call("verify", 2, 100), return_exceptions=True)
+        started = time.monotonic()
+        first, second = asyncio.run(race())
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertIsInstance(first, GatewayUnavailable)
+        self.assertIn("saturated", str(second))
+        self.assertEqual(slow.stats["timeouts"], 1)
+        self.assertEqual(slow.stats["rejected"], 2)  # the retry still finds the timed-out call holding the slot
+        slow.shutdown()
+        self.assertEqual(client.get("/admin/payments", headers=ADMIN_HEADERS).json()["gateway"], "SimulatedGateway")
+        
+        print(f"{'38':<6} {'Payment gateway client':<30} {'PASS':<10}")
+    
+    def test_39_bulk_order_status(self):
+        """
+        Test Case 39: POST /orders/status moves many orders along the order state machine at once
+        Data: four orders of one seller, one of another seller and a missing id
+        Expected: valid transitions applied with completion dates and order views in step;
+                  invalid, foreign and missing orders reported per id and left alone;
+                  verifying a payment for a cancelled order is refused with 409
+        """
+        buyer_id = client.post("/register", json={"name": "Bulk Buyer", "email": "bulk.buyer@example.com", "role": "buyer"}).json()["id"]
+        seller_id = client.post("/register", json={"name": "Bulk Seller", "email": "bulk.seller@example.com", "role": "seller"}).json()["id"]
+        other_id = client.post("/register", json={"name": "Other Seller", "email": "bulk.other@example.com", "role": "seller"}).json()["id"]
+        mine = client.post("/products", json={"name": "Crate", "price": 3.0, "seller_id": seller_id}).json()["id"]
+        theirs = client.post("/products", json={"name": "Barrel", "price": 4.0, "seller_id": other_id}).json()["id"]
+        o1, o2, o3, o4 = [client.post("/orders", json={"buyer_id": buyer_id, "product_id": mine}).json()["id"] for _ in range(4)]
+        foreign = client.post("/orders", json={"buyer_id": buyer_id, "product_id": theirs}).json()["id"]
+        
+        def move(ids, status, seller=seller_id):
+            return client.post("/orders/status", json={"seller_id": seller, "order_ids": ids, "status": status})
+        
+        self.assertEqual(move([o1, o2, o3], "processing").json()["updated"], 3)
+        self.assertEqual(move([o3], "cancelled").json()["updated"], 1)
+        body = move([o1, o2, o3, o4, foreign, 10**9, o1], "completed").json()
+        self.assertEqual(body["updated"], 2)
+        results = {r["id"]: r for r in body["results"]}
+        self.assertEqual(len(body["results"]), 6)
+        self.assertTrue(results[o1]["ok"] and results[o2]["ok"])
+        self.assertEqual(results[o3]["detail"], "Cannot move a cancelled order to completed")
+        self.assertEqual(results[o4]["status"], "created")
+        self.assertFalse(results[o4]["ok"])
+        self.assertEqual(results[foreign]["detail"], "Order belongs to another seller")
+        self.assertEqual(results[10**9]["detail"], "Order not found")
+        
+        orders = {o["id"]: o for o in client.get("/orders").json()}
+        self.assertEqual([orders[i]["status"] for i in (o1, o2, o3, o4, foreign)], ["completed", "completed", "cancelled", "created", "created"])
+        self.assertIsNotNone(orders[o1]["completion_date"])
+        self.assertIsNone(orders[o3]["completion_date"])
+        views = {v["id"]: v for v in client.get("/orders/history", params={"seller_id": seller_id}).json()}
+        self.assertEqual(views[o2]["status"], "completed")
+        self.assertEqual(views[o3]["status"], "cancelled")
+        
+        again = move([o1], "completed").json()
+        self.assertEqual((again["updated"], again["results"][0]["ok"]), (0, True))
+        self.assertEqual(move([o4], "shipped").status_code, 400)
+        self.assertEqual(move([o4], "processing", seller=buyer_id).status_code, 403)
+        
+        # a payment verified after the seller cancelled must not resurrect the order
+        tx_id = client.post("/transactions", json={"order_id": o4}).json()["id"]
+        client.post("/payment/process", params={"transaction_id": tx_id})
+        self.assertEqual(move([o4], "cancelled").json()["updated"], 1)
+        with mock.patch.object(payments, "gateway", SimulatedGateway(approve_rate=1.0)):
+            verified = client.post("/payment/verify", params={"transaction_id": tx_id})
+        self.assertEqual(verified.status_code, 409)
+        self.assertEqual(verified.json()["detail"], "Cannot move a cancelled order to completed")
+        self.assertEqual({o["id"]: o["status"] for o in client.get("/orders").json()}[o4], "cancelled")
+        views = {v["id"]: v for v in client.get("/orders/history", params={"seller_id": seller_id}).json()}
+        self.assertEqual(views[o4]["status"], "cancelled")
+        self.assertEqual({t["id"]: t["status"] for t in client.get("/transactions").json()}[tx_id], "processing")
+        
+        print(f"{'39':<6} {'Bulk order status':<30} {'PASS':<10}")
+    
     @classmethod
     def tearDownClass(cls):
         """Clean up after all tests"""
@@ -481,6 +1618,222 @@ def print_test_summary():
             "expected": "404 Not Found",
             "actual": "404 Not Found - Sender or receiver not found",
             "status": "FAIL"
+        },
+        {
+            "serial": 13,
+            "description": "Slow-query log",
+            "data": "threshold=0ms, GET /search",
+            "expected": "Entry tagged 'GET /search' with EXPLAIN plan",
+            "actual": "Entry recorded with plan",
+            "status": "PASS"
+        },
+        {
+            "serial": 14,
+            "description": "Map clusters",
+            "data": "3 products, precision=12, delete + move",
+            "expected": "Cell counts/representatives follow product writes",
+            "actual": "Clusters updated incrementally",
+            "status": "PASS"
+        },
+        {
+            "serial": 15,
+            "description": "k-NN search with cursor",
+            "data": "3 products, k=2, then cursor",
+            "expected": "Nearest two by distance, then the remaining one",
+            "actual": "Pages ordered by distance",
+            "status": "PASS"
+        },
+        {
+            "serial": 16,
+            "description": "Search cache invalidation",
+            "data": "two nearby queries, then a product write in range",
+            "expected": "Cache hit, then fresh result after the write",
+            "actual": "Hit recorded, new product returned",
+            "status": "PASS"
+        },
+        {
+            "serial": 17,
+            "description": "Search cache coalescing",
+            "data": "8 concurrent identical misses",
+            "expected": "Single load shared by all callers",
+            "actual": "One load",
+            "status": "PASS"
+        },
+        {
+            "serial": 18,
+            "description": "Chat group commit",
+            "data": "10 concurrent sends, 50ms batching window",
+            "expected": "Distinct ids, fewer commits than messages",
+            "actual": "Messages committed in batches",
+            "status": "PASS"
+        },
+        {
+            "serial": 19,
+            "description": "Read replica routing",
+            "data": "replica SQLite file, GET /users around a POST /register",
+            "expected": "Replica before the write, primary right after it",
+            "actual": "Reads routed with read-your-writes stickiness",
+            "status": "PASS"
+        },
+        {
+            "serial": 20,
+            "description": "Rate limiting",
+            "data": "GET /users with burst=2",
+            "expected": "429 with Retry-After on the third request",
+            "actual": "429 Too Many Requests",
+            "status": "PASS"
+        },
+        {
+            "serial": 21,
+            "description": "Load shedding",
+            "data": "1 slot, queue of 1, 3 concurrent acquires",
+            "expected": "One runs, one waits, one rejected",
+            "actual": "Excess request shed",
+            "status": "PASS"
+        },
+        {
+            "serial": 22,
+            "description": "Integer cents money",
+            "data": "price=0.10, quantity=3",
+            "expected": "amount_cents=30, amount=0.3",
+            "actual": "Exact integer totals",
+            "status": "PASS"
+        },
+        {
+            "serial": 23,
+            "description": "Money column migration",
+            "data": "legacy NUMERIC price/amount columns",
+            "expected": "Cents columns backfilled, old columns dropped",
+            "actual": "Migration applied idempotently",
+            "status": "PASS"
+        },
+        {
+            "serial": 24,
+            "description": "Seller sales rollups",
+            "data": "one approved (qty 2 x 5.00), one denied order",
+            "expected": "revenue_cents=1000; same after backfill",
+            "actual": "Rollups match backfill",
+            "status": "PASS"
+        },
+        {
+            "serial": 25,
+            "description": "Image store and thumbnails",
+            "data": "1000x500 PNG uploaded twice",
+            "expected": "Deduplicated URL, 200px thumbnail, immutable caching",
+            "actual": "Thumbnail served with ETag/304",
+            "status": "PASS"
+        },
+        {
+            "serial": 26,
+            "description": "Columnar catalog browse",
+            "data": "4 products, 2 categories; price/q/radius filters; update + delete",
+            "expected": "Correct totals and ordering; writes reflected without reload",
+            "actual": "Filters, sorts and patches match",
+            "status": "PASS"
+        },
+        {
+            "serial": 27,
+            "description": "Similar products index",
+            "data": "3 lamps + 1 scarf; lamp added then deleted",
+            "expected": "Lamps rank each other first; incremental refresh matches rebuild",
+            "actual": "Neighbour lists updated on flush",
+            "status": "PASS"
+        },
+        {
+            "serial": 28,
+            "description": "Chat hot/cold archive",
+            "data": "6 messages, 4 backdated 60 days, batch size 3",
+            "expected": "Hot read has 2; paging back merges hot and archive",
+            "actual": "Archive chunks read only when paging back",
+            "status": "PASS"
+        },
+        {
+            "serial": 29,
+            "description": "Catalog snapshot mmap",
+            "data": "3 products snapshotted; 1 added, 1 renamed, 1 deleted after",
+            "expected": "Mapped columns; change log replay brings browse up to date",
+            "actual": "Snapshot + catch-up matches database",
+            "status": "PASS"
+        },
+        {
+            "serial": 30,
+            "description": "Product change feed",
+            "data": "add A, add B, update A, delete B after token; limit=2",
+            "expected": "A upsert at new price, B tombstone, paged with has_more",
+            "actual": "Deltas and tokens as expected",
+            "status": "PASS"
+        },
+        {
+            "serial": 31,
+            "description": "Product facets",
+            "data": "3 books + 1 lamp across locations; update + delete",
+            "expected": "Category counts and histograms, global and in radius",
+            "actual": "Incremental facets match rebuild",
+            "status": "PASS"
+        },
+        {
+            "serial": 32,
+            "description": "Order history read model",
+            "data": "approved order of 3 x 4.50 plus an unpaid order",
+            "expected": "Names, amount 1350 cents, statuses; cursor paging",
+            "actual": "Read model rows match rebuild",
+            "status": "PASS"
+        },
+        {
+            "serial": 33,
+            "description": "Response compression",
+            "data": "31 products; gzip / identity Accept-Encoding",
+            "expected": "gzip + Vary; cached bytes reused until the catalog changes",
+            "actual": "1 hit, misses only on new catalog version",
+            "status": "PASS"
+        },
+        {
+            "serial": 34,
+            "description": "Sampling profiler",
+            "data": "0.5s profile at 2ms while /products/browse is under load",
+            "expected": "Collapsed stacks rooted at the route; filter; admin only",
+            "actual": "Route-tagged samples returned",
+            "status": "PASS"
+        },
+        {
+            "serial": 35,
+            "description": "Allocation tracking",
+            "data": "Tracking at sample rate 1 with a 1KB budget over three /products calls",
+            "expected": "Per-route peak/net stats, top sites, over-budget events",
+            "actual": "Route stats and budget events recorded",
+            "status": "PASS"
+        },
+        {
+            "serial": 36,
+            "description": "Batch reads",
+            "data": "Chat, users and browse in one POST /batch, plus bad operations",
+            "expected": "Results match standalone routes; errors per operation",
+            "actual": "One round trip, per-operation statuses",
+            "status": "PASS"
+        },
+        {
+            "serial": 37,
+            "description": "Trending products",
+            "data": "3/1/2 orders on two nearby and one distant product",
+            "expected": "Ranked by orders, radius filter, survives flush/reload, expires",
+            "actual": "Window counts ranked and restored",
+            "status": "PASS"
+        },
+        {
+            "serial": 38,
+            "description": "Payment gateway client",
+            "data": "Healthy, failing and slow simulated gateways; pool of one",
+            "expected": "503 + Retry-After, circuit opens, timeouts, bulkhead rejects",
+            "actual": "Provider calls isolated from request threads",
+            "status": "PASS"
+        },
+        {
+            "serial": 39,
+            "description": "Bulk order status",
+            "data": "Several orders of one seller, a foreign order and a missing id",
+            "expected": "Valid transitions applied; others reported per order",
+            "actual": "Guarded set-based updates with per-order results",
+            "status": "PASS"
         }
     ]
     
@@ -490,9 +1843,9 @@ def print_test_summary():
         print(f"{tc['serial']:<5} {tc['description']:<35} {tc['status']:<8}")
     
     print("\n" + "-"*100)
-    print(f"\nTotal Tests: 12")
-    print(f"Passed: 6")
-    print(f"Failed: 6")
+    print(f"\nTotal Tests: {len(test_cases)}")
+    print(f"Passed: {sum(1 for tc in test_cases if tc['status'] == 'PASS')}")
+    print(f"Failed: {sum(1 for tc in test_cases if tc['status'] == 'FAIL')}")
     print("\nDetailed Information:")
     print("-"*100)
     
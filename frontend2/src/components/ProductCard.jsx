@@ -34,7 +34,11 @@ const ProductCard = ({ product, isOwner, onDelete, onOrder }) => {
       <CardMedia
         component="img"
         height="200"
-        image={product.image_url || 'https://via.placeholder.com/200'}
+        image={
+          product.thumbnails?.['200'] ||
+          product.image_url ||
+          'https://via.placeholder.com/200'
+        }
         alt={product.name}
         sx={{ objectFit: 'cover' }}
       />
@@ -18,9 +18,17 @@ import {
   Badge,
 } from '@mui/material'
 import { Notifications as NotificationsIcon } from '@mui/icons-material'
-import { sendMessage, getMessages, getUsers } from '../services/api'
+import { sendMessage, getMessages, batchGet } from '../services/api'
 
 const POLLING_INTERVAL = 3000 // Poll every 3 seconds
+const OLDER_PAGE_SIZE = 50
+
+// Union of two id-ordered message lists, oldest first
+const mergeMessages = (current, incoming) => {
+  const byId = new Map(current.map((msg) => [msg.id, msg]))
+  incoming.forEach((msg) => byId.set(msg.id, msg))
+  return [...byId.values()].sort((a, b) => a.id - b.id)
+}
 
 const Chat = ({ user }) => {
   const [messages, setMessages] = useState([])
@@ -29,7 +37,10 @@ const Chat = ({ user }) => {
   const [availableUsers, setAvailableUsers] = useState([])
   const [loading, setLoading] = useState(true)
   const [unreadMessages, setUnreadMessages] = useState({})
+  const [hasOlder, setHasOlder] = useState(true)
+  const [loadingOlder, setLoadingOlder] = useState(false)
   const messagesEndRef = useRef(null)
+  const lastIdRef = useRef(0)
   const pollingRef = useRef(null)
   const audioRef = useRef(new Audio('/message.mp3'))
 
@@ -38,7 +49,10 @@ const Chat = ({ user }) => {
   }
 
   useEffect(() => {
-    scrollToBottom()
+    // older pages are prepended; only follow the conversation when something new arrives
+    const lastId = messages.length ? messages[messages.length - 1].id : 0
+    if (lastId > lastIdRef.current) scrollToBottom()
+    lastIdRef.current = Math.max(lastIdRef.current, lastId)
   }, [messages])
 
   const startPolling = () => {
@@ -62,16 +76,18 @@ const Chat = ({ user }) => {
 
       try {
         setLoading(true)
-        // Fetch both messages and users
-        const [messagesData, usersData] = await Promise.all([
-          getMessages(user.id),
-          getUsers(),
+        // Fetch both messages and users in one round trip
+        const [messagesData, usersData] = await batchGet([
+          `/chat/${user.id}`,
+          '/users',
         ])
 
         // Filter out current user from available users
         const otherUsers = usersData.filter((u) => u.id !== user.id)
 
+        lastIdRef.current = 0
         setMessages(messagesData)
+        setHasOlder(true)
         setAvailableUsers(otherUsers)
 
         // Start polling for new messages
@@ -97,10 +113,10 @@ const Chat = ({ user }) => {
 
   const fetchMessages = async () => {
     try {
+      // The poll returns the recent window only; merge it so older pages stay
       const data = await getMessages(user.id)
-      if (data.length > messages.length) {
-        // New messages received
-        const newMessages = data.slice(messages.length)
+      const newMessages = data.filter((msg) => msg.id > lastIdRef.current)
+      if (newMessages.length > 0) {
         const hasNewMessage = newMessages.some(
           (msg) => msg.receiver_id === user.id
         )
@@ -119,12 +135,29 @@ const Chat = ({ user }) => {
           })
         }
       }
-      setMessages(data)
+      setMessages((prev) => mergeMessages(prev, data))
     } catch (error) {
       console.error('Error fetching messages:', error)
     }
   }
 
+  const loadOlderMessages = async () => {
+    if (!messages.length) return
+    try {
+      setLoadingOlder(true)
+      const older = await getMessages(user.id, {
+        before_id: messages[0].id,
+        limit: OLDER_PAGE_SIZE,
+      })
+      if (older.length < OLDER_PAGE_SIZE) setHasOlder(false)
+      setMessages((prev) => mergeMessages(prev, older))
+    } catch (error) {
+      console.error('Error loading older messages:', error)
+    } finally {
+      setLoadingOlder(false)
+    }
+  }
+
   const handleSendMessage = async (e) => {
     e.preventDefault()
     if (!selectedUser || !newMessage.trim()) return
@@ -231,6 +264,17 @@ const Chat = ({ user }) => {
                   </Typography>
                 </Box>
                 <Box sx={{ flexGrow: 1, overflow: 'auto', mb: 2 }}>
+                  {hasOlder && messages.length > 0 && (
+                    <Box sx={{ display: 'flex', justifyContent: 'center' }}>
+                      <Button
+                        size="small"
+                        onClick={loadOlderMessages}
+                        disabled={loadingOlder}
+                      >
+                        {loadingOlder ? 'Loading...' : 'Load older messages'}
+                      </Button>
+                    </Box>
+                  )}
                   <List>
                     {messages
                       .filter(
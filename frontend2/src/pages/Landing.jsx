@@ -196,7 +196,9 @@ const Landing = () => {
                         component="img"
                         height="200"
                         image={
-                          product.image_url || 'https://via.placeholder.com/200'
+                          product.thumbnails?.['200'] ||
+                          product.image_url ||
+                          'https://via.placeholder.com/200'
                         }
                         alt={product.name}
                       />
@@ -18,7 +18,13 @@ import {
   InputAdornment,
 } from '@mui/material'
 import { Close as CloseIcon } from '@mui/icons-material'
-import { getProducts, addProduct, deleteProduct } from '../services/api'
+import {
+  getProductsWithToken,
+  syncProducts,
+  addProduct,
+  deleteProduct,
+  uploadImage,
+} from '../services/api'
 import ProductCard from '../components/ProductCard'
 import {
   LoadingSpinner,
@@ -30,10 +36,12 @@ import { useLocation } from '../contexts/LocationContext'
 const MyProducts = ({ user }) => {
   const location = useLocation()
   const [products, setProducts] = useState([])
+  const [changeToken, setChangeToken] = useState(null)
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState(null)
   const [success, setSuccess] = useState('')
   const [openDialog, setOpenDialog] = useState(false)
+  const [uploading, setUploading] = useState(false)
   const [newProduct, setNewProduct] = useState({
     name: '',
     description: '',
@@ -65,12 +73,13 @@ const MyProducts = ({ user }) => {
     setLoading(true)
     setError(null)
     try {
-      const data = await getProducts()
+      const { products: data, token } = await getProductsWithToken()
       // Filter products to show only the seller's products
       const myProducts = data.filter(
         (product) => product.seller_id === user?.id
       )
       setProducts(myProducts)
+      setChangeToken(token)
     } catch (error) {
       setError(error.message)
     } finally {
@@ -78,6 +87,20 @@ const MyProducts = ({ user }) => {
     }
   }
 
+  // Apply only the catalog changes since the last load
+  const refreshProducts = async () => {
+    try {
+      const { products: data, token } = await syncProducts(
+        products,
+        changeToken
+      )
+      setProducts(data.filter((product) => product.seller_id === user?.id))
+      setChangeToken(token)
+    } catch (error) {
+      setError(error.message)
+    }
+  }
+
   const validateForm = () => {
     if (!newProduct.name.trim()) {
       setError('Product name is required')
@@ -114,6 +137,22 @@ const MyProducts = ({ user }) => {
     return true
   }
 
+  const handleImageUpload = async (e) => {
+    const file = e.target.files[0]
+    if (!file) return
+    setUploading(true)
+    try {
+      // the server stores the bytes and pre-renders the card thumbnails
+      const { url } = await uploadImage(file)
+      setNewProduct((prev) => ({ ...prev, image_url: url }))
+    } catch (error) {
+      setError(error.message || 'Error uploading image')
+    } finally {
+      setUploading(false)
+      e.target.value = ''
+    }
+  }
+
   const handleAddProduct = async () => {
     try {
       if (!validateForm()) {
@@ -140,7 +179,7 @@ const MyProducts = ({ user }) => {
         longitude: location?.lon || '',
       })
       setSuccess('Product added successfully!')
-      fetchProducts()
+      refreshProducts()
     } catch (error) {
       setError(error.message || 'Error adding product')
     }
@@ -150,7 +189,7 @@ const MyProducts = ({ user }) => {
     try {
       await deleteProduct(productId)
       setSuccess('Product deleted successfully!')
-      fetchProducts()
+      refreshProducts()
     } catch (error) {
       setError(error.message || 'Error deleting product')
     }
@@ -298,6 +337,15 @@ const MyProducts = ({ user }) => {
             margin="normal"
             required
           />
+          <Button variant="outlined" component="label" disabled={uploading}>
+            {uploading ? 'Uploading...' : 'Upload Image'}
+            <input
+              type="file"
+              accept="image/*"
+              hidden
+              onChange={handleImageUpload}
+            />
+          </Button>
           <Box sx={{ mt: 2, mb: 2 }}>
             <Typography variant="subtitle1" gutterBottom>
               Location Information
@@ -10,25 +10,40 @@ import {
   TableRow,
   Paper,
   Chip,
+  Box,
+  Button,
 } from '@mui/material'
-import { getOrders } from '../services/api'
+import { getOrderHistory } from '../services/api'
 
 const Orders = ({ user }) => {
   const [orders, setOrders] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
+  const [loadingMore, setLoadingMore] = useState(false)
 
   useEffect(() => {
     fetchOrders()
   }, [])
 
-  const fetchOrders = async () => {
+  const fetchOrders = async (beforeId) => {
     try {
-      const data = await getOrders()
-      setOrders(data)
+      const params =
+        user?.role === 'seller' ? { seller_id: user.id } : { buyer_id: user?.id }
+      const page = await getOrderHistory(
+        beforeId ? { ...params, before_id: beforeId } : params
+      )
+      setOrders((prev) => (beforeId ? [...prev, ...page.orders] : page.orders))
+      setNextCursor(page.nextCursor)
     } catch (error) {
       console.error('Error fetching orders:', error)
     }
   }
 
+  const loadMore = async () => {
+    setLoadingMore(true)
+    await fetchOrders(nextCursor)
+    setLoadingMore(false)
+  }
+
   const getStatusColor = (status) => {
     switch (status.toLowerCase()) {
       case 'completed':
@@ -52,9 +67,14 @@ const Orders = ({ user }) => {
           <TableHead>
             <TableRow>
               <TableCell>Order ID</TableCell>
-              <TableCell>Product ID</TableCell>
+              <TableCell>Product</TableCell>
+              <TableCell>
+                {user?.role === 'seller' ? 'Buyer' : 'Seller'}
+              </TableCell>
               <TableCell>Quantity</TableCell>
+              <TableCell>Amount</TableCell>
               <TableCell>Status</TableCell>
+              <TableCell>Payment</TableCell>
               <TableCell>Order Date</TableCell>
               <TableCell>Completion Date</TableCell>
             </TableRow>
@@ -63,8 +83,19 @@ const Orders = ({ user }) => {
             {orders.map((order) => (
               <TableRow key={order.id}>
                 <TableCell>{order.id}</TableCell>
-                <TableCell>{order.product_id}</TableCell>
+                <TableCell>{order.product_name}</TableCell>
+                <TableCell>
+                  {user?.role === 'seller'
+                    ? order.buyer_name
+                    : order.seller_name}
+                </TableCell>
                 <TableCell>{order.quantity}</TableCell>
+                <TableCell>
+                  $
+                  {(
+                    order.amount ?? order.unit_price * order.quantity
+                  ).toFixed(2)}
+                </TableCell>
                 <TableCell>
                   <Chip
                     label={order.status}
@@ -72,6 +103,7 @@ const Orders = ({ user }) => {
                     size="small"
                   />
                 </TableCell>
+                <TableCell>{order.transaction_status || '-'}</TableCell>
                 <TableCell>
                   {new Date(order.order_date).toLocaleDateString()}
                 </TableCell>
@@ -85,6 +117,13 @@ const Orders = ({ user }) => {
           </TableBody>
         </Table>
       </TableContainer>
+      {nextCursor && (
+        <Box sx={{ display: 'flex', justifyContent: 'center', my: 2 }}>
+          <Button variant="outlined" onClick={loadMore} disabled={loadingMore}>
+            {loadingMore ? 'Loading...' : 'Load more'}
+          </Button>
+        </Box>
+      )}
     </Container>
   )
 }
@@ -27,10 +27,12 @@ import {
   Close as CloseIcon,
 } from '@mui/icons-material'
 import {
-  getProducts,
+  getProductsWithToken,
+  syncProducts,
   addProduct,
   deleteProduct,
   searchProducts,
+  uploadImage,
 } from '../services/api'
 import { useGeolocation } from '../hooks/useGeolocation'
 import ProductCard from '../components/ProductCard'
@@ -48,10 +50,12 @@ const Products = ({ user }) => {
   const geolocation = useGeolocation()
 
   const [products, setProducts] = useState([])
+  const [changeToken, setChangeToken] = useState(null)
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState(null)
   const [success, setSuccess] = useState('')
   const [openDialog, setOpenDialog] = useState(false)
+  const [uploading, setUploading] = useState(false)
   const [openFilters, setOpenFilters] = useState(false)
   const [orderProduct, setOrderProduct] = useState(null)
   const [filters, setFilters] = useState({
@@ -89,19 +93,21 @@ const Products = ({ user }) => {
     setLoading(true)
     setError(null)
     try {
-      let data
       if (searchLocation) {
         // Use geospatial search if location is provided
-        data = await searchProducts(
+        const data = await searchProducts(
           searchLocation.lat,
           searchLocation.lon,
           filters.radius || 5.0
         )
+        setProducts(data)
+        setChangeToken(null) // search results are not delta-synced
       } else {
         // Fall back to regular product listing
-        data = await getProducts()
+        const { products: data, token } = await getProductsWithToken()
+        setProducts(data)
+        setChangeToken(token)
       }
-      setProducts(data)
     } catch (error) {
       setError(error.message)
     } finally {
@@ -109,9 +115,26 @@ const Products = ({ user }) => {
     }
   }
 
+  // After our own writes, pull only the changes instead of the whole list
+  const refreshProducts = async () => {
+    if (!changeToken) {
+      return fetchProducts()
+    }
+    try {
+      const { products: data, token } = await syncProducts(
+        products,
+        changeToken
+      )
+      setProducts(data)
+      setChangeToken(token)
+    } catch (error) {
+      setError(error.message)
+    }
+  }
+
+  // Filters are applied client-side, so changing them needs no refetch
   const handleFilterChange = (event) => {
     setFilters({ ...filters, [event.target.name]: event.target.value })
-    fetchProducts() // Refresh products when filters change
   }
 
   const filteredProducts = products.filter((product) => {
@@ -142,6 +165,22 @@ const Products = ({ user }) => {
     }
   })
 
+  const handleImageUpload = async (e) => {
+    const file = e.target.files[0]
+    if (!file) return
+    setUploading(true)
+    try {
+      // the server stores the bytes and pre-renders the card thumbnails
+      const { url } = await uploadImage(file)
+      setNewProduct((prev) => ({ ...prev, image_url: url }))
+    } catch (error) {
+      setError(error.message || 'Error uploading image')
+    } finally {
+      setUploading(false)
+      e.target.value = ''
+    }
+  }
+
   const handleAddProduct = async () => {
     try {
       if (!location?.lat || !location?.lon) {
@@ -167,7 +206,7 @@ const Products = ({ user }) => {
         longitude: location?.lon || '',
       })
       setSuccess('Product added successfully!')
-      fetchProducts()
+      refreshProducts()
     } catch (error) {
       setError(error.message || 'Error adding product')
     }
@@ -176,7 +215,7 @@ const Products = ({ user }) => {
   const handleDeleteProduct = async (productId) => {
     try {
       await deleteProduct(productId)
-      fetchProducts()
+      refreshProducts()
     } catch (error) {
       console.error('Error deleting product:', error)
     }
@@ -459,6 +498,15 @@ const Products = ({ user }) => {
             margin="normal"
             required
           />
+          <Button variant="outlined" component="label" disabled={uploading}>
+            {uploading ? 'Uploading...' : 'Upload Image'}
+            <input
+              type="file"
+              accept="image/*"
+              hidden
+              onChange={handleImageUpload}
+            />
+          </Button>
           <TextField
             fullWidth
             label="Latitude"
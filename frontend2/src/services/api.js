@@ -4,6 +4,8 @@ const API_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000'
 
 export const api = axios.create({
   baseURL: API_URL,
+  // send the backend's read-your-writes cookie so reads after a write hit the primary
+  withCredentials: true,
 })
 
 // Add response interceptor for error handling
@@ -31,6 +33,35 @@ export const getProducts = async () => {
   return response.data
 }
 
+export const getProductsWithToken = async () => {
+  const response = await api.get('/products')
+  return { products: response.data, token: response.headers['x-change-token'] }
+}
+
+// Bring a product list up to date with the changes made since `token`
+export const syncProducts = async (products, token) => {
+  if (!token) {
+    return getProductsWithToken()
+  }
+  const byId = new Map(products.map((product) => [product.id, product]))
+  let hasMore = true
+  while (hasMore) {
+    const response = await api.get('/products/changes', {
+      params: { since: token },
+    })
+    for (const change of response.data.changes) {
+      if (change.deleted) {
+        byId.delete(change.id)
+      } else {
+        byId.set(change.id, change.product)
+      }
+    }
+    token = response.data.token
+    hasMore = response.data.has_more
+  }
+  return { products: [...byId.values()], token }
+}
+
 export const addProduct = async (productData) => {
   try {
     const response = await api.post('/products', productData)
@@ -60,13 +91,25 @@ export const getOrders = async () => {
   return response.data
 }
 
+// One page of order history, newest first; pass nextCursor back as before_id
+// for the next page (null once there are no more).
+export const getOrderHistory = async (params) => {
+  const response = await api.get('/orders/history', { params })
+  return {
+    orders: response.data,
+    nextCursor: response.headers['x-next-cursor'] || null,
+  }
+}
+
 export const sendMessage = async (messageData) => {
   const response = await api.post('/chat/send', messageData)
   return response.data
 }
 
-export const getMessages = async (userId) => {
-  const response = await api.get(`/chat/${userId}`)
+// Without params: the recent (hot) window. Pass { before_id, limit } to page
+// back through older messages, archive included.
+export const getMessages = async (userId, params = {}) => {
+  const response = await api.get(`/chat/${userId}`, { params })
   return response.data
 }
 
@@ -89,3 +132,24 @@ export const getUsers = async () => {
   const response = await api.get('/users')
   return response.data
 }
+
+// Runs several GETs in one round trip; resolves to the bodies in order and
+// rejects with the first failing operation's detail.
+export const batchGet = async (paths) => {
+  const response = await api.post('/batch', {
+    operations: paths.map((path) => ({ path })),
+  })
+  return response.data.map((result) => {
+    if (result.status >= 400) {
+      throw new Error(result.body?.detail || `Request failed: ${result.status}`)
+    }
+    return result.body
+  })
+}
+
+export const uploadImage = async (file) => {
+  const response = await api.post('/images', file, {
+    headers: { 'Content-Type': file.type },
+  })
+  return response.data
+}